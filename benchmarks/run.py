@@ -0,0 +1,329 @@
+"""Benchmarks of the reader, code generation, the JIT and the runtime.
+
+Run from a checkout with `python benchmarks/run.py`. Results can be written
+as JSON with --output, and compared against an earlier result file with
+--baseline, in which case the exit status is 1 if any benchmark got slower
+by more than the threshold.
+"""
+
+from collections import OrderedDict
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llvmlite
+import llvmlite.ir as ir
+
+from paltry import PaltryVM
+from paltry import fasl
+from paltry.codegen import codegen, codegen_prologue
+from paltry.datatypes import PtObject
+from paltry.heap import heap
+from paltry.reader import read_all
+import paltry.llvm_types as llvm_types
+
+
+# Benchmarks by name, with a description of the unit of work
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, unit):
+    """Register a benchmark. The function takes a scale factor, does its setup
+    and returns a function running the benchmark once, together with the
+    number of units of work done in one run and the value a run returns. A run
+    returning anything else has failed, and is not timed.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = (func, unit)
+        return func
+    return decorator
+
+
+def _random_form(rng, depth=0):
+    kind = rng.random()
+    if depth > 4 or kind < 0.3:
+        return rng.choice([
+            str(rng.randint(-10**6, 10**6)),
+            '{:.4f}'.format(rng.uniform(-100, 100)),
+            '"str{}"'.format(rng.randint(0, 100)),
+            rng.choice(['alpha', 'beta-gamma', 'x', '+', '<=']),
+            '0x{:x}'.format(rng.randint(0, 1 << 32)),
+        ])
+    if kind < 0.35:
+        return "'" + _random_form(rng, depth + 1)
+    elements = [_random_form(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+    return '({})'.format(' '.join(elements))
+
+
+def _generated_source(size, seed=0):
+    rng = random.Random(seed)
+    forms, total = [], 0
+    while total < size:
+        forms.append(_random_form(rng) + ' ; comment\n')
+        total += len(forms[-1])
+    return ''.join(forms)
+
+
+def _arith_forms(count, seed=0):
+    """Generate forms doing some arithmetic, and their values."""
+    rng = random.Random(seed)
+    ret = []
+    for _ in range(count):
+        a, b, c = rng.randint(0, 1000), rng.randint(0, 1000), rng.randint(0, 1000)
+        code = '(let ((a {}) (b {})) (if (< a b) (+ a (* b 2)) (list a b {})))'.format(a, b, c)
+        value = PtObject(a + 2 * b) if a < b else PtObject.list([PtObject(a), PtObject(b), PtObject(c)])
+        ret.append((code, value))
+    return ret
+
+
+def _nested(depth):
+    code = 'x{}'.format(depth)
+    for i in range(depth, 0, -1):
+        code = '(let ((x{} (+ x{} 1))) (if (< x{} 0) nil {}))'.format(i, i - 1, i, code)
+    return '(let ((x0 0)) {})'.format(code)
+
+
+@benchmark('reader', 'byte')
+def reader_throughput(scale):
+    source = _generated_source(int(scale * (1 << 20)))
+    return lambda: len(read_all(source)), len(source), source.count('\n')
+
+
+@benchmark('fasl', 'byte')
+def fasl_throughput(scale):
+    source = _generated_source(int(scale * (1 << 20)))
+    data = fasl.dumps(read_all(source))
+    return lambda: len(list(fasl.load(data))), len(source), source.count('\n')
+
+
+@benchmark('codegen', 'form')
+def codegen_latency(scale):
+    forms = [read_all(code)[0] for code, _ in _arith_forms(int(scale * 200))]
+    vm = PaltryVM()
+
+    def run():
+        for form in forms:
+            module = ir.Module('bench')
+            func = ir.Function(module, llvm_types.PtFunction, '##bench##init')
+            bld = ir.IRBuilder(func.append_basic_block('entry'))
+            lib = {
+                'size_t': ir.IntType(64), 'heap': heap, 'fixnums': False,
+                'allocs': ir.GlobalVariable(module, ir.IntType(64), 'allocs'),
+                'constants': vm.constants, 'functions': vm.functions,
+            }
+            codegen_prologue(bld, lib)
+            codegen(form, bld, module, lib, {}, tailpos=True)
+            vm.constants.rollback()
+            vm.functions.rollback()
+        return len(forms)
+    return run, len(forms), len(forms)
+
+
+@benchmark('jit', 'form')
+def jit_latency(scale):
+    forms = _arith_forms(int(scale * 50), seed=1)
+    codes = [read_all(code) for code, _ in forms]
+    vm = PaltryVM()
+    return lambda: [vm.eval_compiled(code) for code in codes], len(forms), [value for _, value in forms]
+
+
+@benchmark('interpreter', 'form')
+def interpreter_latency(scale):
+    forms = _arith_forms(int(scale * 1000), seed=2)
+    codes = [read_all(code) for code, _ in forms]
+    vm = PaltryVM(tiered=True, promote_threshold=1 << 30)
+    return lambda: [vm.eval_code(code) for code in codes], len(forms), [value for _, value in forms]
+
+
+@benchmark('alloc-lists', 'cons')
+def alloc_lists(scale):
+    vm = PaltryVM()
+    vm.eval_code(read_all('(define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))'))
+    n = int(scale * 1000000)
+    form = read_all('(car (build {} nil))'.format(n))
+    return lambda: vm.eval_code(form), n, PtObject(1)
+
+
+@benchmark('callbacks', 'call')
+def callbacks(scale):
+    vm = PaltryVM()
+    vm.eval_code(read_all('(define (walk n x acc) (if (= n 0) acc (walk (- n 1) x (car (cdr x)))))'))
+    n = int(scale * 20000)
+    form = read_all('(walk {} (list 1 2) nil)'.format(n))
+    return lambda: vm.eval_code(form), 2 * n, PtObject(2)
+
+
+@benchmark('typed-callbacks', 'call')
+def typed_callbacks(scale):
+    vm = PaltryVM()
+    vm.eval_code(read_all('(define (roots n acc) (if (= n 0) acc (roots (- n 1) (+ acc (sqrt 2.0)))))'))
+    n = int(scale * 20000)
+    form = read_all('(roots {} 0.0)'.format(n))
+    acc = 0.0
+    for _ in range(n):
+        acc += math.sqrt(2.0)
+    return lambda: vm.eval_code(form), n, PtObject(acc)
+
+
+@benchmark('intern', 'call')
+def intern_calls(scale):
+    vm = PaltryVM()
+    vm.eval_code(read_all('(define (interns n x) (if (= n 0) x (interns (- n 1) (intern "some-symbol"))))'))
+    n = int(scale * 20000)
+    form = read_all('(interns {} nil)'.format(n))
+    return lambda: vm.eval_code(form), n, PtObject.intern('some-symbol')
+
+
+@benchmark('compiled-call', 'call')
+def compiled_call(scale):
+    f = PaltryVM().compile('(+ (* x x) 1)', params=['x'])
+    n = int(scale * 10000)
+
+    def run():
+        for i in range(n):
+            value = f(i)
+        return value
+    return run, n, (n - 1) ** 2 + 1
+
+
+@benchmark('compiled-map', 'row')
+def compiled_map(scale):
+    f = PaltryVM().compile('(+ (* x x) 1)', params=['x'])
+    inputs = list(range(int(scale * 200000)))
+    return lambda: f.map(inputs, dtype=int), len(inputs), [x * x + 1 for x in inputs]
+
+
+@benchmark('list-convert', 'element')
+def list_convert(scale):
+    vm = PaltryVM()
+    values = list(range(int(scale * 1000000)))
+    return lambda: vm.from_list(vm.to_list(values), dtype=int), len(values), values
+
+
+@benchmark('deep-nesting', 'level')
+def deep_nesting(scale):
+    depth = int(scale * 50)
+    form = read_all(_nested(depth))
+    vm = PaltryVM()
+    return lambda: vm.eval_compiled(form), depth, PtObject(depth)
+
+
+def measure(name, scale, repeat):
+    """Run a benchmark and return a dict of results. Times are in seconds per
+    run, and the median is also given per unit of work. Raises an error if a
+    run does not return the expected value.
+    """
+    func, unit = BENCHMARKS[name]
+    run, units, expected = func(scale)
+
+    def check(value):
+        if value != expected:
+            raise click.ClickException('Benchmark {} failed: got {}'.format(name, _summary(value)))
+
+    check(run())
+    times = []
+    for _ in range(repeat):
+        heap.collect()
+        start = perf_counter()
+        value = run()
+        times.append(perf_counter() - start)
+        check(value)
+    median = statistics.median(times)
+    return OrderedDict([
+        ('unit', unit),
+        ('units', units),
+        ('min', min(times)),
+        ('median', median),
+        ('stdev', statistics.stdev(times) if len(times) > 1 else 0.0),
+        ('per_unit', median / units),
+        ('times', times),
+    ])
+
+
+def _summary(value, limit=80):
+    text = str(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return OrderedDict([
+        ('commit', commit),
+        ('python', platform.python_version()),
+        ('llvmlite', llvmlite.__version__),
+        ('machine', platform.machine()),
+        ('platform', platform.platform()),
+    ])
+
+
+def compare(results, baseline, threshold):
+    """Compare results with a baseline by median time per unit of work. Returns
+    a list of (name, baseline, current, relative change) tuples, and the names
+    of the benchmarks that regressed by more than the threshold.
+    """
+    rows, regressions = [], []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = result['per_unit'] / base['per_unit'] - 1
+        rows.append((name, base['per_unit'], result['per_unit'], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+@click.command()
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Write results to a JSON file.')
+@click.option('--baseline', '-b', type=click.Path(exists=True, dir_okay=False),
+              help='Compare against results from an earlier run.')
+@click.option('--threshold', type=float, default=0.1, help='Relative slowdown counted as a regression.')
+@click.option('--scale', type=float, default=1.0, help='Scale factor for the amount of work.')
+@click.option('--repeat', '-r', type=click.IntRange(min=1), default=5)
+@click.argument('names', nargs=-1, type=click.Choice(list(BENCHMARKS)))
+@click.pass_context
+def main(ctx, output, baseline, threshold, scale, repeat, names):
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        results[name] = result = measure(name, scale, repeat)
+        print('{:<14} {:>10.3f} ms  {:>12.3f} us/{}'.format(
+            name, 1000 * result['median'], 1e6 * result['per_unit'], result['unit'],
+        ))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'metadata': _metadata(), 'scale': scale, 'results': results}, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            base = json.load(f)
+        if base.get('scale') != scale:
+            print('Warning: baseline was run with scale {}'.format(base.get('scale')))
+        rows, regressions = compare(results, base['results'], threshold)
+        print()
+        for name, before, after, change in rows:
+            print('{:<14} {:>12.3f} -> {:>12.3f} us  {:>+7.1%}{}'.format(
+                name, 1e6 * before, 1e6 * after, change, '  REGRESSION' if name in regressions else '',
+            ))
+        if regressions:
+            ctx.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,31 @@
+from array import array
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 import ctypes as ct
+import os
+from time import perf_counter
 import llvmlite.ir as ir
 import llvmlite.binding as llvm
 
-from paltry.codegen import codegen
-from paltry.datatypes import PtObject, PtFunction
+from paltry.aot import bind_library, init_functions
+from paltry.cache import ObjectCache
+from paltry.codegen import (
+    codegen, codegen_prologue, ConstantPool, FunctionTable,
+    codegen_batch, codegen_entry, codegen_fill, codegen_unpack, codegen_intern, codegen_symbol_name,
+    CODEGEN_VERSION, external_address, relocations, imports, is_transient,
+)
+from paltry.compiled import BatchLoop, CompiledFunction, entry_type, numpy
+from paltry.convert import FillList, UnpackList, number_array, to_object
+from paltry.datatypes import PtType, PtObject, PtContents, PtFunction
+from paltry.elf import is_elf, is_relocatable, symbols, undefined_symbols
+import paltry.image as image
+from paltry.heap import heap
+from paltry.interpreter import EvalError, Interpreter, PROMOTE_THRESHOLD
+from paltry.optimize import get_opt_level, create_pass_manager
+from paltry.perf import PerfMap
+from paltry.reader import read_all
 import paltry.llvm_types as llvm_types
+import paltry.runtime as runtime
 
 
 llvm.initialize()
@@ -13,56 +33,832 @@ llvm.initialize_native_target()
 llvm.initialize_native_asmprinter()
 
 _size_t = ir.IntType(8 * ct.sizeof(ct.c_size_t))
-_ptr = ir.IntType(8).as_pointer()
 
 
-class PaltryVM:
+# The phases of reading, compiling and running a form, in order
+PHASES = ('read', 'codegen', 'serialize', 'parse', 'verify', 'optimize', 'finalize', 'run')
+
+BatchResult = namedtuple('BatchResult', ['values', 'forms', 'overhead_saved'])
+BatchResult.__doc__ = """The result of evaluating a batch of toplevel forms. The
+values are those of the forms that were run, and the overhead saved is an
+estimate in seconds of the fixed cost of the modules that were not compiled.
+"""
+
+# Symbol bindings and heap objects are shared by all VMs, and may point to
+# function objects and constants in JIT compiled code, so execution engines
+# are never freed
+_engines = []
+
+# Shared libraries compiled ahead of time are never unloaded either
+_libraries = []
+
+# Number of transient modules compiled in a scratch engine before it is freed
+SCRATCH_MODULES = 64
+
+# Function objects of the native runtime functions, once compiled
+_runtime_functions = []
+
+
+def _install_runtime(target):
+    """Compile the runtime functions that have native versions, and bind them in
+    place of the Python callbacks. Done once per process, since symbols and
+    the heap are shared by all VMs.
+    """
+    if _runtime_functions:
+        return
+    module = ir.Module('runtime')
+    target_machine = target.create_target_machine()
+    module.triple = target_machine.triple
+    module.data_layout = str(target_machine.target_data)
+    allocs = ir.GlobalVariable(module, ir.IntType(64), '##runtime##allocs')
+    allocs.initializer = ir.Constant(ir.IntType(64), 0)
+
+    # Values may be fixnums or not, depending on the VM
+    lib = {'size_t': _size_t, 'heap': heap, 'fixnums': True, 'allocs': allocs}
+    functions = {
+        'intern': codegen_intern(module, lib, '##runtime##intern'),
+        'symbol-name': codegen_symbol_name(
+            module, lib, '##runtime##symbol-name', runtime.symbol_name.function,
+        ),
+    }
+
+    refmod = llvm.parse_assembly(str(module))
+    refmod.verify()
+    for sym, addr in relocations(module, heap).items():
+        llvm.add_symbol(sym, addr)
+    engine = llvm.create_mcjit_compiler(refmod, target_machine)
+    engine.finalize_object()
+    _engines.append(engine)
+
+    for name, func in functions.items():
+        address = engine.get_function_address(func.name)
+        obj = PtObject(PtType.function, PtContents(function=address))
+        _runtime_functions.append(obj)
+        PtObject.intern(name).contents.symbol.contents.binding = ct.pointer(obj)
+
+
+class CodeStats:
+    """Accounting of JIT compiled code. Sizes are those of the object files
+    emitted for each module, in bytes.
+
+    Modules that define functions or constants are kept for the lifetime of the
+    VM. Transient modules are unloaded after they have run, and their memory is
+    freed together with the scratch engine they were compiled in.
+    """
 
     def __init__(self):
-        target = llvm.Target.from_default_triple()
-        target_machine = target.create_target_machine()
-        self.engine = llvm.create_mcjit_compiler(llvm.parse_assembly(''), target_machine)
+        self.modules = 0
+        self.module_bytes = 0
+        self.transient_modules = 0
+        self.transient_bytes = 0
+        self.freed_bytes = 0
+        self.engines_freed = 0
+
+    @property
+    def live_bytes(self):
+        return self.module_bytes + self.transient_bytes - self.freed_bytes
+
+    def __repr__(self):
+        return (
+            '<CodeStats modules={} module_bytes={} transient_modules={} '
+            'live_bytes={} freed_bytes={}>'
+        ).format(
+            self.modules, self.module_bytes, self.transient_modules,
+            self.live_bytes, self.freed_bytes,
+        )
+
+
+def _instruction_count(module):
+    return sum(len(block.instructions) for func in module.functions for block in func.blocks)
+
+
+class VMStats:
+    """A snapshot of the counters of a VM. Times are in seconds.
+
+    The timings are accumulated per phase, and the last timings are those of
+    the most recent form read and module compiled and run. Instructions are
+    counted in the generated IR, before optimization. Allocations are the
+    objects allocated by compiled code, while the heap counters include
+    objects allocated by the runtime and the interpreter, in all VMs.
+    """
+
+    def __init__(self, vm):
+        self.timings = OrderedDict(vm.timings)
+        self.last_timings = OrderedDict(vm.last_timings)
+        self.forms = vm.forms_evaluated
+        self.modules = vm.code_stats.modules
+        self.transient_modules = vm.code_stats.transient_modules
+        self.cached_modules = vm.cache.hits if vm.cache is not None else 0
+        self.ir_instructions = vm.ir_instructions
+        self.last_ir_instructions = vm.last_ir_instructions
+        self.allocations = sum(vm.module_allocations.values()) + vm.transient_allocations
+        self.heap_bytes_allocated = vm.heap.bytes_allocated
+        self.code_bytes = vm.code_stats.live_bytes
+        self.gc_collections = vm.gc_stats.collections
+        self.gc_pause = vm.gc_stats.total_pause
+        interpreter = vm.interpreter
+        self.functions_promoted = interpreter.functions_promoted if interpreter else 0
+        self.forms_promoted = interpreter.forms_promoted if interpreter else 0
+
+    def as_dict(self):
+        """Return the counters as a flat dict, with one entry per phase."""
+        ret = OrderedDict()
+        for phase, t in self.timings.items():
+            ret['time_' + phase] = t
+        for phase, t in self.last_timings.items():
+            ret['last_time_' + phase] = t
+        ret.update((key, value) for key, value in vars(self).items() if 'timings' not in key)
+        return ret
+
+    def __str__(self):
+        lines = ['{:<20} {:>12} {:>12}'.format('phase', 'last (ms)', 'total (ms)')]
+        for phase, t in self.timings.items():
+            lines.append('{:<20} {:>12.3f} {:>12.3f}'.format(phase, 1000 * self.last_timings[phase], 1000 * t))
+        for key, value in self.as_dict().items():
+            if not key.startswith(('time_', 'last_time_')):
+                lines.append('{:<20} {:>25}'.format(key, round(value, 6)))
+        return '\n'.join(lines)
+
+
+class PaltryVM:
+
+    def __init__(self, opt_level=2, fixnums=False, cache_dir=None, tiered=False,
+                 promote_threshold=PROMOTE_THRESHOLD, perf_map=None):
+        self.opt_level = get_opt_level(opt_level)
+        self.fixnums = fixnums
+        self._target = llvm.Target.from_default_triple()
+        _install_runtime(self._target)
+        self.target_machine, self.engine = self._create_engine()
+        _engines.append(self.engine)
+        self.pass_manager = create_pass_manager(self.opt_level)
+        self.constants = ConstantPool(fixnums=fixnums)
+        self.functions = FunctionTable()
+        self.heap = heap
         self._count = 0
+        self._module_overhead = None
+        self.forms_evaluated = 0
+        self.ir_instructions = 0
+        self.last_ir_instructions = 0
+
+        # Compiled modules are stored in the cache, keyed by their source and by
+        # the key of the previous module, since code generation depends on the
+        # constants and functions defined earlier. The chain is None once a
+        # module could not be cached.
+        self.cache = None
+        self._cache_chain = None
+        if cache_dir is not None:
+            self.cache = ObjectCache(cache_dir)
+            self._cache_chain = ''
+
+        # Transient modules, by name, with the engine they are loaded in. The
+        # scratch engine is replaced after SCRATCH_MODULES modules.
+        self.code_stats = CodeStats()
+        self._transient = {}
+        self._scratch = None
+        self._scratch_modules = 0
+        self._scratch_bytes = 0
+
+        # Modules kept in the main engine, in order, as (name, object file,
+        # metadata) tuples. The object file and metadata are None for modules
+        # that can not be loaded from a file.
+        self.loaded_modules = []
+
+        # Allocation counters of each module kept in an engine, and of the last
+        # module compiled. Transient modules are forgotten when unloaded, and
+        # their counts added to transient_allocations.
+        self._alloc_counters = OrderedDict()
+        self._last_counter = None
+        self.transient_allocations = 0
+
+        # Native entry points for calls from Python, by argument types, and
+        # loops calling functions over arrays, by parameter count and element
+        # types
+        self._entry_points = {}
+        self._batch_loops = {}
+
+        # Native functions converting lists to and from arrays, by number type
+        self._list_fillers = {}
+        self._list_unpackers = {}
+
+        # Compiled functions are registered in a perf map if one is given, either
+        # as a path or as True for the default path
+        self.perf_map = None
+        if perf_map:
+            self.perf_map = PerfMap(perf_map if isinstance(perf_map, str) else None)
+
+        # With tiered execution, toplevel forms are interpreted until they or the
+        # functions they call are hot enough to be compiled
+        self.interpreter = None
+        if tiered:
+            self.interpreter = Interpreter(self, threshold=promote_threshold)
+
+        # Wall time per phase, for the most recent module and accumulated
+        self.last_timings = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.timings = OrderedDict((phase, 0.0) for phase in PHASES)
+
+    def _create_engine(self):
+        """Create an execution engine with its own target machine. The object files
+        it emits are collected in self._objects.
+        """
+        target_machine = self._target.create_target_machine(opt=self.opt_level.codegen_level)
+        engine = llvm.create_mcjit_compiler(llvm.parse_assembly(''), target_machine)
+        engine.finalize_object()
+        objects = self._objects = getattr(self, '_objects', [])
+        engine.set_object_cache(notify_func=lambda mod, buf: objects.append(buf))
+        return target_machine, engine
+
+    def _scratch_engine(self):
+        if self._scratch is None or self._scratch_modules >= SCRATCH_MODULES:
+            if self._scratch is not None:
+                self.code_stats.freed_bytes += self._scratch_bytes
+                self.code_stats.engines_freed += 1
+            self._scratch = self._create_engine()[1]
+            self._scratch_modules = 0
+            self._scratch_bytes = 0
+        self._scratch_modules += 1
+        return self._scratch
 
     @contextmanager
-    def module(self, name, show_ir=False):
+    def _timed(self, phase):
+        start = perf_counter()
+        yield
+        elapsed = perf_counter() - start
+        self.last_timings[phase] += elapsed
+        self.timings[phase] += elapsed
+
+    @property
+    def compile_time(self):
+        """Total time spent compiling the most recent module."""
+        return sum(t for phase, t in self.last_timings.items() if phase not in ('read', 'run'))
+
+    @property
+    def stats(self):
+        """A snapshot of the timings and counters of this VM."""
+        return VMStats(self)
+
+    def read(self, forms):
+        """Iterate over the forms produced by a reader, such as a Reader object or
+        read_file, recording the time spent reading each of them.
+        """
+        forms = iter(forms)
+        while True:
+            start = perf_counter()
+            form = next(forms, None)
+            elapsed = perf_counter() - start
+            self.last_timings['read'] = elapsed
+            self.timings['read'] += elapsed
+            if form is None:
+                return
+            yield form
+
+    @property
+    def gc_stats(self):
+        """Garbage collector statistics of the shared heap."""
+        return self.heap.stats
+
+    @property
+    def module_allocations(self):
+        """Number of objects allocated by the code in each module kept in an
+        engine. Transient modules are counted in transient_allocations.
+        """
+        return OrderedDict((name, counter.value) for name, counter in self._alloc_counters.items())
+
+    @property
+    def last_allocations(self):
+        """Number of objects allocated by the code in the last module compiled."""
+        return self._last_counter.value if self._last_counter is not None else 0
+
+    @property
+    def memory_usage(self):
+        """Bytes of memory used by JIT compiled code and by the shared heap."""
+        return OrderedDict([
+            ('code', self.code_stats.live_bytes),
+            ('heap', self.heap.heap_size),
+        ])
+
+    def _record_object(self, transient):
+        size = sum(len(obj) for obj in self._objects)
+        if transient:
+            self.code_stats.transient_modules += 1
+            self.code_stats.transient_bytes += size
+            self._scratch_bytes += size
+        else:
+            self.code_stats.modules += 1
+            self.code_stats.module_bytes += size
+
+    def _reset_timings(self):
+        # Forms are read before they are compiled, so the read time is kept
+        for phase in PHASES[1:]:
+            self.last_timings[phase] = 0.0
+
+    def _cache_key(self, name, ast):
+        if self._cache_chain is None:
+            return None
+        return ObjectCache.key(
+            ast, CODEGEN_VERSION, self.target_machine.triple, self.opt_level.name,
+            self.fixnums, self._cache_chain, name, self.functions.count,
+        )
+
+    def _load_cached(self, name, key):
+        """Load a module from the object cache. Returns False if it is not cached."""
+        entry = self.cache.load(key)
+        if entry is None or not self._add_object(name, *entry):
+            return False
+        self._cache_chain = key
+        return True
+
+    def _add_object(self, name, obj, meta):
+        """Load a module from an object file and its metadata, as stored in the
+        object cache. Returns False if it refers to objects that do not exist.
+        """
+        # Typed callbacks are registered by name, and may not exist in this process
+        addresses = {sym: external_address(sym, self.heap) for sym in meta['relocations']}
+        if None in addresses.values():
+            return False
+
+        self._reset_timings()
+        with self._timed('finalize'):
+            for sym, addr in addresses.items():
+                llvm.add_symbol(sym, addr)
+            self.engine.add_object_file(llvm.ObjectFileRef.from_data(obj))
+            self.engine.finalize_object()
+        self.code_stats.modules += 1
+        self.code_stats.module_bytes += len(obj)
+        if self.perf_map is not None:
+            self.perf_map.add_object(obj, self.engine.get_function_address)
+        self.constants.import_pending(meta['constants'])
+        self.functions.import_pending(meta['functions'])
+        self.constants.commit()
+        self.functions.commit()
+        addr = self.engine.get_global_value_address('##{}##allocs'.format(name))
+        self._alloc_counters[name] = self._last_counter = ct.c_int64.from_address(addr)
+        self.loaded_modules.append((name, obj, meta))
+        return True
+
+    def _new_ir_module(self, name, constants, functions):
+        """Create an IR module with an init function, and return it together with
+        a builder positioned in the init function and the library for code
+        generation.
+        """
         module = ir.Module(name)
+        module.triple = self.target_machine.triple
+        module.data_layout = str(self.target_machine.target_data)
+
+        allocs = ir.GlobalVariable(module, ir.IntType(64), '##{}##allocs'.format(name))
+        allocs.initializer = ir.Constant(ir.IntType(64), 0)
 
         stdlib = {
             'size_t': _size_t,
-            'malloc': ir.Function(module, ir.FunctionType(_ptr, (_size_t,)), name='malloc')
+            'heap': self.heap,
+            'fixnums': self.fixnums,
+            'allocs': allocs,
+            'constants': constants,
+            'functions': functions,
         }
 
-        func = ir.Function(module, llvm_types.PtFunction, '##{}##init'.format(name))
-        block = func.append_basic_block('entry')
-        bld = ir.IRBuilder(block)
+        func = ir.Function(module, llvm_types.PtFunction, self._init_name(name))
+        bld = ir.IRBuilder(func.append_basic_block('entry'))
+        codegen_prologue(bld, stdlib)
+        return module, bld, stdlib
+
+    @contextmanager
+    def module(self, name, show_ir=False, cache_key=None):
+        """Compile a module. Code generation for the init function happens in the
+        body of the with statement. If a cache key is given, the compiled object
+        file is stored in the object cache.
+        """
+        self._reset_timings()
+        module, bld, stdlib = self._new_ir_module(name, self.constants, self.functions)
+        allocs = stdlib['allocs']
 
-        yield bld, module, stdlib
+        try:
+            with self._timed('codegen'):
+                yield bld, module, stdlib
+            self.last_ir_instructions = _instruction_count(module)
+            self.ir_instructions += self.last_ir_instructions
 
-        if show_ir:
-            print(str(module))
+            if show_ir:
+                print(str(module))
 
-        refmod = llvm.parse_assembly(str(module))
-        refmod.verify()
-        self.engine.add_module(refmod)
-        self.engine.finalize_object()
+            with self._timed('serialize'):
+                text = str(module)
+            with self._timed('parse'):
+                refmod = llvm.parse_assembly(text)
+            with self._timed('verify'):
+                refmod.verify()
+            if self.pass_manager is not None:
+                with self._timed('optimize'):
+                    self.pass_manager.run(refmod)
+            with self._timed('finalize'):
+                relocs = relocations(module, self.heap)
+                for sym, addr in relocs.items():
+                    llvm.add_symbol(sym, addr)
+                transient = is_transient(module)
+                engine = self.engine
+                if transient:
+                    # Names are only unique within a VM, but these are resolved
+                    # before anything else is compiled
+                    engine = self._scratch_engine()
+                    for sym in imports(module, self.heap):
+                        llvm.add_symbol(sym, self.engine.get_global_value_address(sym))
+                del self._objects[:]
+                engine.add_module(refmod)
+                engine.finalize_object()
+        except BaseException:
+            self.constants.rollback()
+            self.functions.rollback()
+            raise
+        self._record_object(transient)
+        if self.perf_map is not None:
+            for obj in self._objects:
+                self.perf_map.add_object(obj, engine.get_function_address)
+
+        # Modules can be stored if they consist of one object file, and do not
+        # refer to objects by address
+        meta = None
+        if len(self._objects) == 1 and not any(sym.startswith('##obj##') for sym in relocs):
+            meta = {
+                'relocations': list(relocs),
+                'constants': self.constants.export_pending(),
+                'functions': self.functions.export_pending(),
+            }
+        if not transient:
+            self.loaded_modules.append((name, self._objects[0] if meta else None, meta))
+        if cache_key is not None:
+            self._store_cached(cache_key, meta)
+        self.constants.commit()
+        self.functions.commit()
+        addr = engine.get_global_value_address(allocs.name)
+        self._alloc_counters[name] = self._last_counter = ct.c_int64.from_address(addr)
+        if transient:
+            self._transient[name] = (engine, refmod)
+
+    def unload(self, name):
+        """Remove a transient module from its engine. Its memory is freed when the
+        scratch engine is replaced. Modules that are not transient are kept.
+        """
+        entry = self._transient.pop(name, None)
+        if entry is None:
+            return
+        engine, refmod = entry
+        counter = self._alloc_counters.pop(name)
+        self.transient_allocations += counter.value
+        if counter is self._last_counter:
+            self._last_counter = ct.c_int64(counter.value)
+        engine.remove_module(refmod)
+
+    def _store_cached(self, key, meta):
+        if meta is None:
+            self._cache_chain = None
+            return
+        self.cache.store(key, self._objects[0], meta)
+        self._cache_chain = key
 
-    def run_init(self, name):
-        addr = self.engine.get_function_address('##{}##init'.format(name))
+    @property
+    def module_overhead(self):
+        """Estimated fixed cost in seconds of compiling a module, independent of the
+        code in it. Measured once, by compiling empty modules without loading
+        them.
+        """
+        if self._module_overhead is None:
+            samples = []
+            for _ in range(3):
+                start = perf_counter()
+                module = ir.Module('##overhead')
+                module.triple = self.target_machine.triple
+                module.data_layout = str(self.target_machine.target_data)
+                func = ir.Function(module, llvm_types.PtFunction, '##overhead##init')
+                ir.IRBuilder(func.append_basic_block('entry')).ret(
+                    ir.Constant(llvm_types.PtObject.as_pointer(), None)
+                )
+                refmod = llvm.parse_assembly(str(module))
+                refmod.verify()
+                if self.pass_manager is not None:
+                    self.pass_manager.run(refmod)
+                self.target_machine.emit_object(refmod)
+                samples.append(perf_counter() - start)
+            self._module_overhead = min(samples)
+        return self._module_overhead
+
+    @staticmethod
+    def _init_name(name, index=0):
+        if index == 0:
+            return '##{}##init'.format(name)
+        return '##{}##init##{}'.format(name, index)
+
+    def run_init(self, name, index=0):
+        engine = self._transient.get(name, (self.engine,))[0]
+        addr = engine.get_function_address(self._init_name(name, index))
         func = PtFunction(addr)
-        value = func(0, None)
+        with self._timed('run'):
+            value = func(0, None)
         if value:
-            value = ct.cast(value, ct.POINTER(PtObject))
-            return value.contents
+            return PtObject.deref(ct.cast(value, ct.POINTER(PtObject)))
 
-    def eval_code(self, ast, show_ir=False):
+    def _new_module(self, forms, show_ir):
+        """Pick a name for a new module compiled from the given forms. Returns the
+        name, the cache key if any, and whether the module was loaded from the
+        cache.
+        """
         name = 'anonymous_{}'.format(self._count)
         self._count += 1
 
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(name, forms)
+            if key is not None and not show_ir and self._load_cached(name, key):
+                return name, key, True
+            if key is None:
+                self._cache_chain = None
+        return name, key, False
+
+    def eval_code(self, ast, show_ir=False):
+        """Evaluate toplevel forms and return the value of the last one, or None if
+        one of them fails. With tiered execution, the forms are interpreted,
+        unless the IR should be shown.
+        """
+        self.forms_evaluated += len(ast)
+        if self.interpreter is None or show_ir:
+            return self.eval_compiled(ast, show_ir=show_ir)
+        self._reset_timings()
+        with self._timed('run'):
+            return self.interpreter.eval(ast)
+
+    def eval_compiled(self, ast, show_ir=False):
+        """Compile toplevel forms into a module, run it and return the value of the
+        last form, or None if one of them fails.
+        """
         ast = ast or [PtObject.nil]
-        with self.module(name, show_ir=show_ir) as (bld, *rest):
-            for node in ast:
-                retval = codegen(node, bld, *rest, {})
-            bld.ret(retval)
+        name, key, loaded = self._new_module(ast, show_ir)
+        if not loaded:
+            with self.module(name, show_ir=show_ir, cache_key=key) as (bld, mod, lib):
+                for node in ast[:-1]:
+                    codegen(node, bld, mod, lib, {})
+                codegen(ast[-1], bld, mod, lib, {}, tailpos=True)
+
+        value = self.run_init(name)
+        self.unload(name)
+        return value
+
+    def compile(self, source, params=()):
+        """Compile a function taking the given parameters, whose body is Paltry
+        source code or a list of forms, and return it as a CompiledFunction to be
+        called from Python.
+        """
+        forms = read_all(source) if isinstance(source, str) else list(source)
+        params = [str(param) for param in params]
+        form = PtObject.list([
+            PtObject.intern('lambda'),
+            PtObject.list([PtObject.intern(param) for param in params]),
+        ] + forms)
+        function = self.eval_compiled([form])
+        if function is None:
+            raise EvalError('Compilation failed')
+        return CompiledFunction(self, function, params)
+
+    def _native_module(self, prefix, generate):
+        """Compile a module with a native function emitted by `generate`, called
+        with the module, its library and the function name. Returns the address.
+        """
+        name = '{}_{}'.format(prefix, self._count)
+        self._count += 1
+        with self.module(name) as (bld, mod, lib):
+            func = generate(mod, lib, self.functions.new_name(prefix))
+            codegen(PtObject.nil, bld, mod, lib, {}, tailpos=True)
+        return self.engine.get_function_address(func.name)
+
+    def entry_point(self, types):
+        """Return a native function calling function objects from Python with
+        arguments of the given types, compiled on first use. See codegen_entry.
+        """
+        types = tuple(types)
+        if types not in self._entry_points:
+            address = self._native_module('entry', lambda *args: codegen_entry(*args, types))
+            self._entry_points[types] = entry_type(types)(address)
+        return self._entry_points[types]
+
+    def batch_loop(self, nparams, in_type, out_type):
+        """Return a native loop calling functions of `nparams` parameters over an
+        array of numbers of type `in_type`, storing results of type `out_type`.
+        Loops are compiled on first use. See codegen_batch for the signature.
+        """
+        key = nparams, in_type, out_type
+        if key not in self._batch_loops:
+            address = self._native_module(
+                'batch', lambda *args: codegen_batch(*args, nparams, in_type, out_type),
+            )
+            self._batch_loops[key] = BatchLoop(address)
+        return self._batch_loops[key]
+
+    def compile_object(self, forms, name='aot'):
+        """Compile toplevel forms ahead of time into a position independent object
+        file, and return its contents. Each form gets its own init function, as
+        in eval_batch. The code does not depend on anything compiled earlier in
+        this VM.
+
+        Runtime objects are referenced through weak undefined symbols, so that
+        the object file can be linked into a shared library with
+        paltry.aot.link_shared. Either can be loaded with `load_compiled`.
+        Raises ValueError if the code refers to objects that only exist in this
+        process, such as functions defined in Python.
+        """
+        forms = list(forms) or [PtObject.nil]
+        constants, functions = ConstantPool(fixnums=self.fixnums), FunctionTable()
+        module, bld, lib = self._new_ir_module(name, constants, functions)
+        for index, form in enumerate(forms):
+            if index > 0:
+                func = ir.Function(module, llvm_types.PtFunction, self._init_name(name, index))
+                bld = ir.IRBuilder(func.append_basic_block('entry'))
+                lib = dict(lib)
+                codegen_prologue(bld, lib)
+            codegen(form, bld, module, lib, {}, tailpos=True)
+
+        externals = relocations(module, self.heap)
+        unbound = imports(module, self.heap) + [sym for sym in externals if sym.startswith('##obj##')]
+        if unbound:
+            raise ValueError('Code refers to objects that can not be linked: {}'.format(', '.join(unbound)))
+        for sym in externals:
+            module.get_global(sym).linkage = 'extern_weak'
+
+        refmod = llvm.parse_assembly(str(module))
+        refmod.verify()
+        if self.pass_manager is not None:
+            self.pass_manager.run(refmod)
+        target_machine = self._target.create_target_machine(opt=self.opt_level.codegen_level, reloc='pic')
+        return target_machine.emit_object(refmod)
+
+    def load_compiled(self, path):
+        """Load code compiled by `compile_object`, from an object file or a shared
+        library, and run its toplevel forms in order. Returns the value of the
+        last form, or None if one of them fails.
+
+        Shared libraries are loaded by the system's dynamic loader, so LLVM is
+        not involved at all. Object files are linked by MCJIT, without code
+        generation.
+        Raises KeyError if the code uses typed callbacks that do not exist.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not is_elf(data):
+            raise ValueError('Not a compiled file: {}'.format(path))
+        resolve = lambda sym: external_address(sym, self.heap)
+
+        self._reset_timings()
+        with self._timed('finalize'):
+            if is_relocatable(data):
+                # Each object file gets its own engine, since the names of its
+                # functions may clash with those of other modules
+                for sym in undefined_symbols(data):
+                    addr = resolve(sym)
+                    if sym.startswith('##') and addr is None:
+                        raise KeyError(sym)
+                    if addr is not None:
+                        llvm.add_symbol(sym, addr)
+                engine = self._create_engine()[1]
+                _engines.append(engine)
+                engine.add_object_file(llvm.ObjectFileRef.from_data(data))
+                engine.finalize_object()
+                address = engine.get_function_address
+            else:
+                library = ct.CDLL(os.path.abspath(path))
+                address = bind_library(data, library, resolve)
+                _libraries.append(library)
+        self.code_stats.modules += 1
+        self.code_stats.module_bytes += len(data)
+        if self.perf_map is not None:
+            self.perf_map.add_object(data, address)
+
+        inits = init_functions(data)
+        value = None
+        with self._timed('run'):
+            for init in inits:
+                value = PtFunction(address(init))(0, None)
+                if not value:
+                    return None
+        self.forms_evaluated += len(inits)
+        return PtObject.deref(ct.cast(value, ct.POINTER(PtObject)))
+
+    def save_image(self, path):
+        """Save an image of the global state: the compiled modules, the interned
+        symbols and everything reachable from their bindings. A fresh VM can be
+        started from it with `load_image`. See paltry.image.
+
+        Interpreted functions are compiled first. Raises ValueError if some of
+        the state can not be saved, such as modules referring to objects by
+        address, or functions defined in Python that are not bound to a symbol.
+        """
+        if self.interpreter is not None:
+            for function in image.interpreted_functions():
+                if not self.interpreter.promote(function):
+                    raise ValueError('Failed to compile function: {}'.format(function))
+        if any(obj is None for _, obj, _ in self.loaded_modules):
+            raise ValueError('Some compiled modules refer to objects that can not be saved')
+
+        globals_ = {}
+        for _, obj, _ in self.loaded_modules:
+            for name, _, shndx, _, _ in symbols(obj):
+                if shndx != 0 and name.startswith('##'):
+                    globals_[self.engine.get_global_value_address(name)] = name
+        header = {
+            'codegen': CODEGEN_VERSION,
+            'triple': self.target_machine.triple,
+            'fixnums': self.fixnums,
+            'count': self._count,
+        }
+        image.save(path, header, self.loaded_modules, globals_)
+
+    def load_image(self, path):
+        """Restore the state saved in an image. The image file is mapped into
+        memory and its modules are loaded without code generation. Only a VM
+        that has not compiled anything yet can load an image, and it must use
+        the same fixnum representation as the one that saved it.
+        """
+        if self.loaded_modules or self._count:
+            raise ValueError('Images can only be loaded into a fresh VM')
+        meta, modules = image.read(path)
+        if (meta['codegen'], meta['triple'], meta['fixnums']) != (CODEGEN_VERSION, self.target_machine.triple, self.fixnums):
+            raise ValueError('Image was saved by an incompatible VM')
+
+        for name, obj, module_meta in modules:
+            if not self._add_object(name, obj, module_meta):
+                raise ValueError('Image refers to typed callbacks that do not exist')
+        self._count = meta['count']
+        image.restore(meta, self.engine.get_global_value_address)
+
+    def to_list(self, values):
+        """Create a list on the heap from a sequence of Python values or a
+        one-dimensional NumPy array. Elements are converted with `to_object`.
+
+        Lists of numbers of a single type are built in bulk: the number and cons
+        cells are allocated as one block and filled in by a native loop.
+        """
+        numbers = number_array(values)
+        if numbers is None:
+            values = values.tolist() if hasattr(values, 'tolist') else values
+            return heap.list([to_object(value) for value in values])
+        if not numbers:
+            return PtObject.nil
+
+        type_ = PtType.integer if numbers.typecode == 'q' else PtType.double
+        if type_ not in self._list_fillers:
+            address = self._native_module('fill', lambda *args: codegen_fill(*args, type_))
+            self._list_fillers[type_] = FillList(address)
+        block = heap.allocate_block(2 * len(numbers))
+        address = self._list_fillers[type_](block, numbers.buffer_info()[0], len(numbers))
+        return PtObject.from_address(address)
+
+    def from_list(self, obj, dtype=float, as_array=False):
+        """Copy the elements of a list of numbers to a list of Python numbers of
+        type `dtype`, which is int or float, using a native loop. With
+        `as_array`, return a NumPy array instead if NumPy is available, or
+        otherwise an array from the array module.
+
+        Raises TypeError if the list is improper or has elements of other types.
+        """
+        type_ = PtType.integer if dtype is int else PtType.double
+        if type_ not in self._list_unpackers:
+            address = self._native_module('unpack', lambda *args: codegen_unpack(*args, type_))
+            self._list_unpackers[type_] = UnpackList(address)
+        unpack = self._list_unpackers[type_]
+
+        length = unpack(ct.addressof(obj), None, 0)
+        if length < 0:
+            kind = 'an integer' if dtype is int else 'a number'
+            raise TypeError('Element {} is not {}'.format(-length - 1, kind))
+        if as_array and numpy is not None:
+            output = numpy.empty(length, dtype=dtype)
+            unpack(ct.addressof(obj), output.ctypes.data, length)
+            return output
+        output = array('q' if dtype is int else 'd', bytes(8 * length))
+        unpack(ct.addressof(obj), output.buffer_info()[0], length)
+        return output if as_array else output.tolist()
+
+    def eval_batch(self, forms, show_ir=False):
+        """Compile toplevel forms into a single module and run them in order. Each
+        form gets its own init function, so its value is returned separately.
+        Running stops at the first form that fails, whose value is None.
+
+        Returns a BatchResult.
+        """
+        forms = list(forms)
+        if not forms:
+            return BatchResult([], 0, 0.0)
+        self.forms_evaluated += len(forms)
+        name, key, loaded = self._new_module(forms, show_ir)
+        if not loaded:
+            with self.module(name, show_ir=show_ir, cache_key=key) as (bld, mod, lib):
+                for index, form in enumerate(forms):
+                    if index > 0:
+                        func = ir.Function(mod, llvm_types.PtFunction, self._init_name(name, index))
+                        bld = ir.IRBuilder(func.append_basic_block('entry'))
+                        lib = dict(lib)
+                        codegen_prologue(bld, lib)
+                    codegen(form, bld, mod, lib, {}, tailpos=True)
 
-        return self.run_init(name)
+        values = []
+        for index in range(len(forms)):
+            values.append(self.run_init(name, index))
+            if values[-1] is None:
+                break
+        self.unload(name)
+        return BatchResult(values, len(forms), (len(forms) - 1) * self.module_overhead)
@@ -1,24 +1,63 @@
+import os
+import sys
+
 import click
-from itertools import count
+from itertools import count, islice
 
-from paltry import PaltryVM
+from paltry import PaltryVM, BatchResult
+from paltry.aot import link_shared
 from paltry.datatypes import PtObject
 from paltry.codegen import codegen
-from paltry.parser import PaltryParser, PaltrySemantics
+from paltry.optimize import OPT_LEVELS
+from paltry.elf import is_elf
+import paltry.fasl as fasl
+from paltry.reader import Reader, ReadError, read_file
+
+
+def print_stats(vm):
+    for line in str(vm.stats).splitlines():
+        print('; ' + line)
+
 
+def print_timings(vm):
+    print('; ' + ', '.join(
+        '{}: {:.3f} ms'.format(phase, 1000 * t)
+        for phase, t in vm.last_timings.items()
+    ))
 
-@click.command()
+
+@click.group(invoke_without_command=True)
 @click.option('--show-ir/--no-show-ir', default=False)
-def main(show_ir):
-    vm = PaltryVM()
-    parser = PaltryParser(
-        parseinfo=True,
-        semantics=PaltrySemantics()
-    )
+@click.option('--opt-level', '-O', type=click.Choice(list(OPT_LEVELS)), default='2')
+@click.option('--show-timings/--no-show-timings', default=False)
+@click.option('--stats/--no-stats', default=False,
+              help='Print timings and counters after each input, or after running a script.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None)
+@click.option('--tiered/--no-tiered', default=True,
+              help='Interpret code until it is hot enough to be compiled.')
+@click.option('--perf-map/--no-perf-map', default=False,
+              help='Write the names of compiled functions to /tmp/perf-<pid>.map for perf.')
+@click.option('--image', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Start from an image made by the save-image command.')
+@click.pass_context
+def main(ctx, show_ir, opt_level, show_timings, stats, cache_dir, tiered, perf_map, image):
+    vm = PaltryVM(opt_level=opt_level, cache_dir=cache_dir, tiered=tiered, perf_map=perf_map)
+    if image is not None:
+        try:
+            vm.load_image(image)
+        except ValueError as err:
+            raise click.ClickException(str(err))
+    ctx.obj = {'vm': vm, 'show_ir': show_ir, 'show_timings': show_timings, 'stats': stats}
+    if ctx.invoked_subcommand is not None:
+        return
 
     for num in count():
         inp = input('> ')
-        ast = parser.parse(inp, 'toplevel')
+        try:
+            ast = list(vm.read(Reader(inp)))
+        except ReadError as err:
+            print(err)
+            continue
 
         value = vm.eval_code(ast, show_ir=show_ir)
         if value is None:
@@ -26,6 +65,122 @@ def main(show_ir):
         else:
             print(value)
 
+        if show_timings:
+            print_timings(vm)
+        if stats:
+            print_stats(vm)
+
+
+@main.command()
+@click.option('--batch-size', '-b', type=click.IntRange(min=0), default=1,
+              help='Number of forms compiled into each module, or 0 for all.')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.pass_obj
+def run(opts, batch_size, filename):
+    """Run a script, executing toplevel forms as soon as they have been read. Use
+    - to read from standard input. Forms are only interpreted if the batch size
+    is 1. Object files and shared libraries made by the compile command are
+    loaded and run.
+    """
+    vm = opts['vm']
+    if filename != '-':
+        with open(filename, 'rb') as f:
+            compiled = is_elf(f.read(16))
+        if compiled:
+            if vm.load_compiled(filename) is None:
+                raise click.ClickException('Error in compiled code')
+            if opts['stats']:
+                print_stats(vm)
+            return
+
+    forms = vm.read(Reader(sys.stdin.buffer) if filename == '-' else read_file(filename))
+    done = 0
+    try:
+        while True:
+            batch = list(islice(forms, batch_size or None))
+            if not batch:
+                break
+            if batch_size == 1:
+                result = BatchResult([vm.eval_code(batch, show_ir=opts['show_ir'])], 1, 0.0)
+            else:
+                result = vm.eval_batch(batch, show_ir=opts['show_ir'])
+            if result.values[-1] is None:
+                raise click.ClickException('Error in toplevel form {}'.format(done + len(result.values)))
+            done += result.forms
+            if opts['show_timings']:
+                print_timings(vm)
+                if result.forms > 1:
+                    print('; {} forms in one module, saved {:.3f} ms'.format(
+                        result.forms, 1000 * result.overhead_saved,
+                    ))
+    except ReadError as err:
+        raise click.ClickException(str(err))
+    finally:
+        if opts['stats']:
+            print_stats(vm)
+
+
+@main.command()
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Output file. Shared library unless it ends in .o. Defaults to FILENAME with .so.')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def compile(opts, output, filename):
+    """Compile a script ahead of time into an object file or a shared library,
+    which can be run without JIT compilation.
+    """
+    vm = opts['vm']
+    output = output or os.path.splitext(filename)[0] + '.so'
+    try:
+        obj = vm.compile_object(vm.read(read_file(filename)))
+    except (ReadError, ValueError) as err:
+        raise click.ClickException(str(err))
+    if output.endswith('.o'):
+        with open(output, 'wb') as f:
+            f.write(obj)
+    else:
+        try:
+            link_shared(obj, output)
+        except RuntimeError as err:
+            raise click.ClickException(str(err))
+
+
+@main.command('write-fasl')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Output file. Defaults to FILENAME with .pfasl.')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def write_fasl(opts, output, filename):
+    """Read a script and write its forms in binary form, which can be run and
+    compiled like the source but loads without reading it again.
+    """
+    vm = opts['vm']
+    output = output or os.path.splitext(filename)[0] + '.pfasl'
+    try:
+        fasl.dump(vm.read(read_file(filename)), output)
+    except (ReadError, ValueError) as err:
+        raise click.ClickException(str(err))
+
+
+@main.command('save-image')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Output file. Defaults to FILENAME with .image.')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def save_image(opts, output, filename):
+    """Run a script and save the resulting state in an image, from which later
+    runs can start with the --image option.
+    """
+    vm = opts['vm']
+    output = output or os.path.splitext(filename)[0] + '.image'
+    try:
+        for num, form in enumerate(vm.read(read_file(filename)), start=1):
+            if vm.eval_code([form], show_ir=opts['show_ir']) is None:
+                raise click.ClickException('Error in toplevel form {}'.format(num))
+        vm.save_image(output)
+    except (ReadError, ValueError) as err:
+        raise click.ClickException(str(err))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,88 @@
+"""Ahead of time compilation to shared libraries, and loading them without LLVM.
+
+Code compiled ahead of time refers to runtime objects, such as nil, the heap
+and interned symbols, through weak undefined symbols. A shared library built
+from it can therefore be loaded by the system's dynamic loader, which leaves
+those symbols null. They are then bound by writing the addresses of the
+runtime objects to the locations named by the library's dynamic relocations,
+which are kept writable by linking without RELRO.
+"""
+
+import ctypes as ct
+import os
+import re
+import subprocess
+import tempfile
+
+from paltry.elf import SHT_DYNSYM, STT_FUNC, import_relocations, function_symbols, symbols
+
+
+# Command used to link shared libraries
+LINKER = os.environ.get('CC', 'cc')
+
+
+def link_shared(obj, path):
+    """Link a position independent object file into a shared library. The library
+    is written to a temporary file first and then moved into place, so that
+    processes that have loaded an earlier version are not affected. Note that
+    the dynamic loader only loads a library once per process and path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(suffix='.o', dir=directory)
+    output = tmp[:-2] + '.so'
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(obj)
+        result = subprocess.run(
+            [LINKER, '-shared', '-nostdlib', '-Wl,-z,norelro', '-Wl,-z,now', '-o', output, tmp],
+            capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError('Linking failed: {}'.format(result.stderr.strip()))
+        os.replace(output, path)
+    finally:
+        for name in (tmp, output):
+            if os.path.exists(name):
+                os.unlink(name)
+
+
+def init_functions(data):
+    """Return the names of the init functions in a compiled file, in the order in
+    which they must be run.
+    """
+    inits = []
+    for name in function_symbols(data):
+        match = re.fullmatch(r'##.*##init(?:##(\d+))?', name)
+        if match:
+            inits.append((int(match.group(1) or 0), name))
+    return [name for _, name in sorted(inits)]
+
+
+def bind_library(data, library, resolve):
+    """Bind the runtime objects referenced by a shared library loaded with ctypes.
+    The data is the contents of the library file, and `resolve` maps symbol
+    names to addresses, or None for unknown names. Raises KeyError for runtime
+    objects that can not be resolved. Other symbols, such as those from the C
+    library, are left to the dynamic loader.
+
+    Returns a function mapping the names of functions defined by the library to
+    their addresses.
+    """
+    def address(name):
+        return ct.cast(library[name], ct.c_void_p).value
+
+    # The library is mapped at an offset from the addresses in the file
+    name, value = next(
+        (name, value) for name, info, shndx, value, _ in symbols(data, SHT_DYNSYM)
+        if shndx != 0 and info & 0xf == STT_FUNC
+    )
+    base = address(name) - value
+
+    for offset, name, addend in import_relocations(data):
+        if not name.startswith('##'):
+            continue
+        target = resolve(name)
+        if target is None:
+            raise KeyError(name)
+        ct.c_uint64.from_address(base + offset).value = target + addend
+    return address
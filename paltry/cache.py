@@ -0,0 +1,90 @@
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+
+from paltry.datatypes import PtType
+
+
+def _update(digest, node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        digest.update(struct.pack('<i', node.type))
+        if node.type == PtType.integer:
+            digest.update(struct.pack('<q', node.contents.integer))
+        elif node.type == PtType.double:
+            digest.update(struct.pack('<d', node.contents.double))
+        elif node.type in (PtType.bytestring, PtType.symbol):
+            data = node.contents.bytestring if node.type == PtType.bytestring else str(node).encode('utf-8')
+            digest.update(struct.pack('<q', len(data)))
+            digest.update(data)
+        elif node.type == PtType.cons:
+            digest.update(b'\1' if bool(node) else b'\0')
+            if bool(node):
+                stack.extend((node.cdr, node.car))
+        else:
+            raise ValueError('Can not hash object of type {}'.format(node.type))
+
+
+class ObjectCache:
+    """An on-disk cache of compiled modules.
+
+    Each entry is the object file emitted by MCJIT for a module, together with
+    the metadata needed to load it without running code generation: the names
+    of the runtime objects it references, and the constants and functions it
+    defines for use by later modules.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(forms, *parts):
+        """Compute the key of a module compiled from the given toplevel forms. The
+        other parts should identify everything else the generated code depends
+        on. Returns None if the forms can not be hashed.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(repr(part).encode('utf-8'))
+            digest.update(b'\0')
+        try:
+            for form in forms:
+                _update(digest, form)
+        except ValueError:
+            return None
+        return digest.hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def load(self, key):
+        """Return the object file and metadata stored under a key, or None."""
+        try:
+            with open(self._path(key, '.o'), 'rb') as f:
+                obj = f.read()
+            with open(self._path(key, '.meta'), 'rb') as f:
+                meta = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return obj, meta
+
+    def store(self, key, obj, meta):
+        """Store an object file and its metadata under a key. The metadata is
+        written last, so that partially written entries are never loaded.
+        """
+        self._write(self._path(key, '.o'), obj)
+        self._write(self._path(key, '.meta'), pickle.dumps(meta))
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -1,9 +1,14 @@
 import ctypes as ct
 from functools import partial
+import struct
 import llvmlite.ir as ir
 
-from paltry.datatypes import PtType, PtObject
+from paltry.datatypes import (
+    PtType, PtObject, PtContents, PtSymbol, is_fixnum, fixnum_tag, callback_error,
+    FNV_OFFSET, FNV_PRIME,
+)
 import paltry.llvm_types as llvm_types
+import paltry.runtime as runtime
 
 
 _type_map = {
@@ -19,17 +24,359 @@ _i64 = ir.IntType(64)
 _i8c = partial(ir.Constant, _i8)
 _i32c = partial(ir.Constant, _i32)
 _i64c = partial(ir.Constant, _i64)
+_obj_ptr_t = llvm_types.PtObject.as_pointer()
+
+# Must be bumped whenever the generated code changes, since it is part of the
+# key of cached object files
+CODEGEN_VERSION = 5
+
+# Byte offset of the binding in a symbol record
+_BINDING = PtSymbol.binding.offset
+
+
+def _constant_type(*members):
+    """Create a struct type with the same layout as PtObject, where the contents
+    union is replaced by the given members followed by padding.
+    """
+    size = ct.sizeof(ct.c_void_p) * len(members)
+    padding = ir.ArrayType(_i8, ct.sizeof(PtContents) - size)
+    return ir.LiteralStructType((_i32,) + members + (padding,))
+
+
+def _constant_key(node):
+    """Return a hashable key identifying the value of an immutable object."""
+    if node.type == PtType.integer:
+        return (PtType.integer, node.contents.integer)
+    elif node.type == PtType.double:
+        return (PtType.double, struct.pack('<d', node.contents.double))
+    elif node.type == PtType.bytestring:
+        return (PtType.bytestring, node.contents.bytestring)
+    elif node.type == PtType.cons and bool(node):
+        return (PtType.cons, _constant_key(node.car), _constant_key(node.cdr))
+    return (node.type, ct.addressof(node))
+
+
+class ConstantPool:
+    """A table of immutable objects emitted as static global data. Each constant is
+    defined in the first module that needs it, and declared as external in every
+    later module, so identical constants are shared by all modules compiled in
+    the same VM.
+    """
+
+    def __init__(self, fixnums=False):
+        self.fixnums = fixnums
+        self._entries = {}
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def commit(self):
+        """Make the constants defined in the current module available to later
+        modules. Must be called after the module is finalized.
+        """
+        self._entries.update(self._pending)
+        self._pending = {}
+
+    def rollback(self):
+        """Forget the constants defined in a module that failed to compile."""
+        self._pending = {}
+
+    def export_pending(self):
+        """Return the constants defined in the current module, in a form that can
+        be pickled.
+        """
+        return dict(self._pending)
+
+    def import_pending(self, entries):
+        """Add constants defined in a module loaded from an object file."""
+        self._pending.update(entries)
+
+    def get(self, node, mod):
+        """Return a constant pointer to an object equal to `node`."""
+        return self._get(node, _constant_key(node), mod)
+
+    def _get(self, node, key, mod):
+        if node.type in (PtType.symbol, PtType.function) or not bool(node):
+            return _external_object(mod, node).bitcast(_obj_ptr_t)
+        if node.type == PtType.integer and self.fixnums and is_fixnum(node.contents.integer):
+            return _i64c(fixnum_tag(node.contents.integer)).inttoptr(_obj_ptr_t)
+
+        entry = self._pending.get(key) or self._entries.get(key)
+        if entry is None:
+            gv = self._define(node, key, mod)
+            self._pending[key] = (gv.name, gv.value_type)
+        else:
+            name, type_ = entry
+            gv = mod.globals.get(name)
+            if gv is None:
+                gv = ir.GlobalVariable(mod, type_, name)
+                gv.global_constant = True
+        return gv.bitcast(_obj_ptr_t)
+
+    def _define(self, node, key, mod):
+        name = '##const##{}'.format(len(self._entries) + len(self._pending))
+        if node.type == PtType.integer:
+            type_ = _constant_type(llvm_types.PtContents_integer)
+            members = [ir.Constant(llvm_types.PtContents_integer, node.contents.integer)]
+        elif node.type == PtType.double:
+            type_ = _constant_type(llvm_types.PtContents_double)
+            members = [ir.Constant(llvm_types.PtContents_double, node.contents.double)]
+        elif node.type == PtType.bytestring:
+            data = node.contents.bytestring + b'\0'
+            buf = ir.GlobalVariable(mod, ir.ArrayType(_i8, len(data)), name + '##data')
+            buf.initializer = ir.Constant.literal_array([_i8c(char) for char in data])
+            buf.global_constant = True
+            buf.linkage = 'private'
+            type_ = _constant_type(llvm_types.PtContents_bytestring)
+            members = [buf.bitcast(llvm_types.PtContents_bytestring)]
+        elif node.type == PtType.cons:
+            type_ = _constant_type(_obj_ptr_t, _obj_ptr_t)
+            members = [
+                self._get(node.car, key[1], mod),
+                self._get(node.cdr, key[2], mod),
+            ]
+            # The car and cdr may have defined new constants, so pick a new name
+            name = '##const##{}'.format(len(self._entries) + len(self._pending))
+
+        gv = ir.GlobalVariable(mod, type_, name)
+        gv.initializer = type_([_i32c(int(node.type))] + members + [type_.elements[-1](None)])
+        gv.global_constant = True
+        return gv
+
+
+class FunctionTable:
+    """A table of compiled functions without captured variables that are bound to
+    global symbols by `define`. Calls to these functions are compiled as direct
+    calls, guarded by a check that the symbol is still bound to the same
+    function object.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._pending = {}
+        self._count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def commit(self):
+        """Make the functions defined in the current module available to later
+        modules. Must be called after the module is finalized.
+        """
+        self._entries.update(self._pending)
+        self._pending = {}
+
+    def rollback(self):
+        """Forget the functions defined in a module that failed to compile."""
+        self._pending = {}
+
+    @property
+    def count(self):
+        """Number of native function names handed out."""
+        return self._count
+
+    def export_pending(self):
+        """Return the functions defined in the current module, in a form that can
+        be pickled.
+        """
+        return {
+            'count': self._count,
+            'entries': {symbol.name.decode('utf-8'): entry for symbol, entry in self._pending.items()},
+        }
+
+    def import_pending(self, state):
+        """Add functions defined in a module loaded from an object file."""
+        self._count = max(self._count, state['count'])
+        for name, entry in state['entries'].items():
+            self._pending[PtObject.intern(name).contents.symbol.contents] = entry
+
+    def new_name(self, name):
+        """Return a unique name for a new native function."""
+        self._count += 1
+        return '##fn##{}##{}'.format(name, self._count)
+
+    def add(self, symbol, function, obj, nparams):
+        """Register `function`, with function object `obj`, as bound to `symbol`."""
+        self._pending[symbol] = (function.name, obj.name, obj.value_type, nparams)
+
+    def get(self, symbol):
+        """Return the entry for the function bound to `symbol`, if any."""
+        return self._pending.get(symbol) or self._entries.get(symbol)
+
+    def declare(self, entry, mod):
+        """Return the native function and the function object of an entry, declared
+        in the given module if necessary.
+        """
+        func_name, obj_name, obj_type, _ = entry
+        func = mod.globals.get(func_name)
+        if func is None:
+            func = ir.Function(mod, llvm_types.PtFunction, func_name)
+        obj = mod.globals.get(obj_name)
+        if obj is None:
+            obj = ir.GlobalVariable(mod, obj_type, obj_name)
+            obj.global_constant = True
+        return func, obj.bitcast(_obj_ptr_t)
+
+
+def _external_name(obj):
+    if obj.type == PtType.cons and not bool(obj):
+        return '##nil'
+    if obj.type == PtType.symbol and ct.addressof(PtObject.intern(str(obj))) == ct.addressof(obj):
+        return '##sym##' + str(obj)
+    return '##obj##{:x}'.format(ct.addressof(obj))
+
+
+def external_address(name, heap):
+    """Return the address of a runtime object referenced by name from compiled
+    code, or None if `name` does not refer to one.
+
+    Compiled code never contains the addresses of runtime objects. They are
+    referenced through external globals, which are resolved when the code is
+    loaded, so that object files stay valid across processes. The exception is
+    objects with no stable name, such as functions defined in Python, which
+    are named by address and make the object file impossible to cache.
+    """
+    if name == '##nil':
+        return ct.addressof(PtObject.nil)
+    if name == '##heap':
+        return ct.addressof(heap.state)
+    if name == '##symtab':
+        return ct.addressof(PtObject.symbol_table.state)
+    if name == '##refill':
+        return ct.cast(heap.refill, ct.c_void_p).value
+    if name == '##callback_error':
+        return ct.addressof(callback_error)
+    if name.startswith(('##cb##', '##cbobj##')):
+        callback = PtObject.typed_callback(name.split('##', 2)[2])
+        if callback is None:
+            return None
+        if name.startswith('##cb##'):
+            return ct.cast(callback.native, ct.c_void_p).value
+        return ct.addressof(callback.function)
+    if name.startswith('##sym##'):
+        return ct.addressof(PtObject.intern(name[len('##sym##'):]))
+    if name.startswith('##bind##'):
+        sym = PtObject.intern(name[len('##bind##'):])
+        return ct.addressof(sym.contents.symbol.contents) + _BINDING
+    if name.startswith('##prim##'):
+        return ct.addressof(runtime.primitives[name[len('##prim##'):]])
+    if name.startswith('##obj##'):
+        return int(name[len('##obj##'):], 16)
+
+
+def _is_declaration(gv):
+    return gv.is_declaration if isinstance(gv, ir.Function) else gv.initializer is None
+
+
+def relocations(mod, heap):
+    """Return the runtime objects referenced by a module, as a dict mapping names
+    to addresses.
+    """
+    ret = {}
+    for gv in mod.global_values:
+        if _is_declaration(gv):
+            addr = external_address(gv.name, heap)
+            if addr is not None:
+                ret[gv.name] = addr
+    return ret
+
+
+def imports(mod, heap):
+    """Return the names of the functions and constants a module uses from modules
+    compiled before it.
+    """
+    return [
+        gv.name for gv in mod.global_values
+        if _is_declaration(gv) and external_address(gv.name, heap) is None
+    ]
+
+
+def is_transient(mod):
+    """Return whether nothing can refer to the code or data of a module once its
+    init functions have returned. That is the case if it defines no functions
+    other than those, and no constants.
+    """
+    return not any(
+        gv.name.startswith(('##fn##', '##const##')) and not _is_declaration(gv)
+        for gv in mod.global_values
+    )
+
+
+def _external(mod, name, type_):
+    gv = mod.globals.get(name)
+    if gv is None:
+        if isinstance(type_, ir.FunctionType):
+            gv = ir.Function(mod, type_, name)
+        else:
+            gv = ir.GlobalVariable(mod, type_, name)
+    return gv
+
+
+def _external_object(mod, obj):
+    return _external(mod, _external_name(obj), llvm_types.PtObject)
+
+
+def _heap_state(bld, lib):
+    return _external(bld.module, '##heap', llvm_types.PtHeap)
+
+
+def _push_root(bld, lib, value):
+    """Push an object on the root stack, keeping it alive until the current
+    function returns.
+    """
+    top_loc = bld.gep(_heap_state(bld, lib), (_i32c(0), _i32c(2)))
+    top = bld.load(top_loc)
+    bld.store(value, bld.inttoptr(top, llvm_types.PtObject.as_pointer().as_pointer()))
+    bld.store(bld.add(top, ir.Constant(lib['size_t'], ct.sizeof(ct.c_void_p))), top_loc)
+
+
+def codegen_prologue(bld, lib):
+    """Emit the function entry code. Must be called before any other code
+    generation in a function.
+    """
+    top_loc = bld.gep(_heap_state(bld, lib), (_i32c(0), _i32c(2)))
+    lib['roots'] = bld.load(top_loc)
+
+
+def codegen_return(bld, lib, value):
+    """Return from the current function, popping its roots."""
+    top_loc = bld.gep(_heap_state(bld, lib), (_i32c(0), _i32c(2)))
+    bld.store(lib['roots'], top_loc)
+    bld.ret(value)
 
 
 def _empty_object(bld, lib, local=False):
     if local:
-        obj = bld.alloca(llvm_types.PtObject)
-    else:
-        obj = bld.call(
-            lib['malloc'],
-            (ir.Constant(lib['size_t'], ct.sizeof(PtObject)),)
-        )
-        return bld.bitcast(obj, llvm_types.PtObject.as_pointer())
+        return bld.alloca(llvm_types.PtObject)
+
+    # Fast path: bump the allocation pointer of the current arena
+    heap = lib['heap']
+    size_t = lib['size_t']
+    size = ir.Constant(size_t, heap.object_size)
+    state = _heap_state(bld, lib)
+    ptr_loc = bld.gep(state, (_i32c(0), _i32c(0)))
+    ptr = bld.load(ptr_loc)
+    new_ptr = bld.add(ptr, size)
+    end = bld.load(bld.gep(state, (_i32c(0), _i32c(1))))
+    fits = bld.icmp_unsigned('<=', new_ptr, end)
+    with bld.if_else(fits, likely=True) as (fast, slow):
+        with fast:
+            bld.store(new_ptr, ptr_loc)
+            fast_blk = bld.block
+        with slow:
+            refill = _external(bld.module, '##refill', llvm_types.PtRefill)
+            slow_ptr = bld.ptrtoint(bld.call(refill, (size,)), size_t)
+            slow_blk = bld.block
+    obj = bld.phi(size_t)
+    obj.add_incoming(ptr, fast_blk)
+    obj.add_incoming(slow_ptr, slow_blk)
+    obj = bld.inttoptr(obj, llvm_types.PtObject.as_pointer())
+    _return_if_zero(bld, lib, obj)
+    _push_root(bld, lib, obj)
+
+    count = bld.load(lib['allocs'])
+    bld.store(bld.add(count, _i64c(1)), lib['allocs'])
     return obj
 
 
@@ -41,79 +388,419 @@ def _set_contents(bld, obj, type_, value):
     bld.store(value, ptr)
 
 
-def _obj_ptr(bld, obj, indirection=1):
-    location = ct.addressof(obj)
-    type_ = llvm_types.PtObject
-    for _ in range(indirection):
-        type_ = type_.as_pointer()
-    return bld.inttoptr(_i64c(location), type_)
+def _set_cons(bld, obj, car, cdr):
+    ptr = bld.gep(obj, (_i32c(0), _i32c(0)))
+    bld.store(ir.Constant(_i32, int(PtType.cons)), ptr)
+    ptr = bld.gep(obj, (_i32c(0), _i32c(1)))
+    ptr = bld.bitcast(ptr, llvm_types.PtCons.as_pointer())
+    bld.store(car, bld.gep(ptr, (_i32c(0), _i32c(0))))
+    bld.store(cdr, bld.gep(ptr, (_i32c(0), _i32c(1))))
+
+
+def _get_cons(bld, obj):
+    ptr = bld.gep(obj, (_i32c(0), _i32c(1)))
+    ptr = bld.bitcast(ptr, llvm_types.PtCons.as_pointer())
+    car = bld.load(bld.gep(ptr, (_i32c(0), _i32c(0))))
+    cdr = bld.load(bld.gep(ptr, (_i32c(0), _i32c(1))))
+    return car, cdr
+
+
+def _set_closure(bld, obj, func, env):
+    ptr = bld.gep(obj, (_i32c(0), _i32c(0)))
+    bld.store(ir.Constant(_i32, int(PtType.function)), ptr)
+    ptr = bld.gep(obj, (_i32c(0), _i32c(1)))
+    ptr = bld.bitcast(ptr, llvm_types.PtClosure.as_pointer())
+    bld.store(bld.bitcast(func, llvm_types.PtContents_function), bld.gep(ptr, (_i32c(0), _i32c(0))))
+    bld.store(env, bld.gep(ptr, (_i32c(0), _i32c(1))))
+
+
+def _entry_alloca(bld, type_):
+    """Allocate stack space in the entry block, so that it is only done once per
+    function call.
+    """
+    block = bld.block
+    bld.position_at_start(bld.function.entry_basic_block)
+    ptr = bld.alloca(type_)
+    bld.position_at_end(block)
+    return ptr
+
+
+def _obj_ptr(bld, obj):
+    return _external_object(bld.module, obj)
 
 
-def _return_if_zero(bld, value):
+def _binding_ptr(bld, symbol):
+    """Return a pointer to the binding of a symbol. Bindings are referenced
+    directly, so that reading one does not go through the symbol object.
+    """
+    return _external(bld.module, '##bind##' + symbol.name.decode('utf-8'), _obj_ptr_t)
+
+
+def _return_if_zero(bld, lib, value):
     zerop = bld.icmp_signed('==', bld.ptrtoint(value, _i64), ir.Constant(_i64, 0))
     with bld.if_then(zerop, likely=False):
-        bld.ret(bld.inttoptr(_i64c(0), llvm_types.PtObject.as_pointer()))
+        codegen_return(bld, lib, bld.inttoptr(_i64c(0), llvm_types.PtObject.as_pointer()))
+
+
+def _type_of(bld, lib, value):
+    if not lib['fixnums']:
+        return bld.load(bld.gep(value, (_i32c(0), _i32c(0))))
 
+    fixnump = bld.trunc(bld.ptrtoint(value, _i64), ir.IntType(1))
+    with bld.if_else(fixnump) as (fixnum, boxed):
+        with fixnum:
+            fixnum_blk = bld.block
+        with boxed:
+            boxed_type = bld.load(bld.gep(value, (_i32c(0), _i32c(0))))
+            boxed_blk = bld.block
+    value_type = bld.phi(_i32)
+    value_type.add_incoming(_i32c(int(PtType.integer)), fixnum_blk)
+    value_type.add_incoming(boxed_type, boxed_blk)
+    return value_type
 
-def _return_if_not_type(bld, value, type_):
-    ptr = bld.gep(value, (_i32c(0), _i32c(0)))
-    value_type = bld.load(ptr)
+
+def _return_if_not_type(bld, lib, value, type_):
+    value_type = _type_of(bld, lib, value)
     zerop = bld.icmp_signed('!=', value_type, _i32c(int(type_)))
     with bld.if_then(zerop, likely=False):
-        bld.ret(bld.inttoptr(_i64c(0), llvm_types.PtObject.as_pointer()))
+        codegen_return(bld, lib, bld.inttoptr(_i64c(0), llvm_types.PtObject.as_pointer()))
 
 
 def _is_truthy(bld, value):
-    zerop = bld.icmp_signed(
-        '!=', bld.ptrtoint(value, _i64), ir.Constant(_i64, ct.addressof(PtObject.nil))
-    )
-    return zerop
+    return bld.icmp_unsigned('!=', value, _obj_ptr(bld, PtObject.nil))
 
 
-def _codegen_integer(node, bld, mod, lib, ns):
-    obj = _empty_object(bld, lib)
-    _set_contents(
-        bld, obj, PtType.integer,
-        ir.Constant(llvm_types.PtContents_integer, node.contents.integer)
-    )
-    return obj
+# Native types of numbers passed to and from Python
+_number_types = {
+    PtType.integer: _i64,
+    PtType.double: llvm_types.PtContents_double,
+}
 
+BatchFunction = ir.FunctionType(
+    _obj_ptr_t, (_obj_ptr_t, _i64, _i8.as_pointer(), _i8.as_pointer(), _i64.as_pointer()),
+)
 
-def _codegen_double(node, bld, mod, lib, ns):
-    obj = _empty_object(bld, lib)
-    _set_contents(
-        bld, obj, PtType.double,
-        ir.Constant(llvm_types.PtContents_double, node.contents.double)
-    )
-    return obj
 
+def codegen_entry(mod, lib, name, types):
+    """Emit a native function calling a function object with native arguments,
+    for calls from Python. The arguments are the function object and one value
+    per type in `types`: an integer or a double for PtType.integer and
+    PtType.double, which are boxed here, or an object for None.
+    """
+    argtypes = [_obj_ptr_t] + [_number_types.get(type_, _obj_ptr_t) for type_ in types]
+    func = ir.Function(mod, ir.FunctionType(_obj_ptr_t, argtypes), name)
+    function, *values = func.args
+    bld = ir.IRBuilder(func.append_basic_block('entry'))
+    lib = dict(lib)
+    codegen_prologue(bld, lib)
+    args = [
+        value if type_ is None else _box_number(bld, lib, type_, value)
+        for type_, value in zip(types, values)
+    ]
+    retval = _call_function(bld, lib, function, args)
+    codegen_return(bld, lib, retval)
+    return func
 
-def _codegen_bytestring(node, bld, mod, lib, ns):
-    type_ = ir.ArrayType(_i8, len(node.contents.bytestring) + 1)
-    buf = ir.GlobalVariable(mod, type_, name='##static')
-    buf.initializer = ir.Constant.literal_array(
-        [_i8c(char) for char in node.contents.bytestring] + [_i8c(0)]
-    )
 
+def codegen_batch(mod, lib, name, nparams, in_type, out_type):
+    """Emit a native loop calling a function object once for each row of an array
+    of numbers, and storing the results in an array of numbers. The element
+    types are PtType.integer or PtType.double.
+
+    The arguments are the function object, the number of rows, the input array
+    with `nparams` elements per row, the output array, and a pointer to which
+    the index of the current row is written. Returns nil, or null if a call
+    fails or returns something other than a number of the output type.
+    Integer results are converted to doubles if necessary.
+    """
+    func = ir.Function(mod, BatchFunction, name)
+    function, count, inputs, outputs, progress = func.args
+    bld = ir.IRBuilder(func.append_basic_block('entry'))
+    lib = dict(lib)
+    codegen_prologue(bld, lib)
+
+    inputs = bld.bitcast(inputs, _number_types[in_type].as_pointer())
+    outputs = bld.bitcast(outputs, _number_types[out_type].as_pointer())
+    arglist = _entry_alloca(bld, ir.ArrayType(_obj_ptr_t, nparams + 1))
+    args_ptr = bld.gep(arglist, (_i32c(0), _i32c(0)))
+    bld.store(function, bld.gep(arglist, (_i32c(0), _i32c(nparams))))
+    func_ptr_loc = bld.gep(function, (_i32c(0), _i32c(1)))
+    callee = bld.load(bld.bitcast(func_ptr_loc, llvm_types.PtFunction.as_pointer().as_pointer()))
+    entry = bld.block
+
+    loop = func.append_basic_block('loop')
+    body = func.append_basic_block('body')
+    done = func.append_basic_block('done')
+    bld.branch(loop)
+    bld.position_at_end(loop)
+    index = bld.phi(_i64)
+    index.add_incoming(_i64c(0), entry)
+    bld.store(index, progress)
+    bld.cbranch(bld.icmp_signed('<', index, count), body, done)
+
+    # The roots of the previous row are popped before boxing the arguments
+    bld.position_at_end(body)
+    bld.store(lib['roots'], bld.gep(_heap_state(bld, lib), (_i32c(0), _i32c(2))))
+    row = bld.mul(index, _i64c(nparams))
+    for i in range(nparams):
+        value = bld.load(bld.gep(inputs, (bld.add(row, _i64c(i)),)))
+        arg = _box_number(bld, lib, in_type, value)
+        bld.store(arg, bld.gep(arglist, (_i32c(0), _i32c(i))))
+    retval = bld.call(callee, (_i32c(nparams), args_ptr))
+    _return_if_zero(bld, lib, retval)
+
+    value_type, ival, dval = _unbox_number(bld, lib, retval)
+    intp = bld.icmp_signed('==', value_type, _i32c(int(PtType.integer)))
+    if out_type == PtType.integer:
+        okp, result = intp, ival
+    else:
+        okp = bld.or_(intp, bld.icmp_signed('==', value_type, _i32c(int(PtType.double))))
+        result = bld.select(intp, bld.sitofp(ival, dval.type), dval)
+    with bld.if_then(bld.not_(okp), likely=False):
+        codegen_return(bld, lib, bld.inttoptr(_i64c(0), _obj_ptr_t))
+    bld.store(result, bld.gep(outputs, (index,)))
+    index.add_incoming(bld.add(index, _i64c(1)), bld.block)
+    bld.branch(loop)
+
+    bld.position_at_end(done)
+    codegen_return(bld, lib, _obj_ptr(bld, PtObject.nil))
+    return func
+
+
+def _cell(bld, lib, block, index):
+    offset = bld.mul(index, _i64c(lib['heap'].object_size))
+    return bld.bitcast(bld.gep(block, (offset,)), _obj_ptr_t)
+
+
+def codegen_fill(mod, lib, name, type_):
+    """Emit a native function building a list of numbers of the given type in a
+    block of cells allocated by the caller, without allocating anything.
+
+    The arguments are the address of the block, an array of numbers and their
+    count, which must be positive. The block must hold twice as many cells: the
+    numbers are stored first, followed by the cons cells. Returns the list.
+    """
+    fill_type = ir.FunctionType(_obj_ptr_t, (_i8.as_pointer(), _i8.as_pointer(), _i64))
+    func = ir.Function(mod, fill_type, name)
+    block, values, count = func.args
+    bld = ir.IRBuilder(func.append_basic_block('entry'))
+    values = bld.bitcast(values, _number_types[type_].as_pointer())
+    nil = _obj_ptr(bld, PtObject.nil)
+    entry = bld.block
+
+    loop = func.append_basic_block('loop')
+    done = func.append_basic_block('done')
+    bld.branch(loop)
+    bld.position_at_end(loop)
+    index = bld.phi(_i64)
+    index.add_incoming(_i64c(0), entry)
+    number = _cell(bld, lib, block, index)
+    _set_contents(bld, number, type_, bld.load(bld.gep(values, (index,))))
+    following = bld.add(index, _i64c(1))
+    lastp = bld.icmp_signed('==', following, count)
+    cdr = bld.select(lastp, nil, _cell(bld, lib, block, bld.add(count, following)))
+    _set_cons(bld, _cell(bld, lib, block, bld.add(count, index)), number, cdr)
+    index.add_incoming(following, bld.block)
+    bld.cbranch(lastp, done, loop)
+
+    bld.position_at_end(done)
+    bld.ret(_cell(bld, lib, block, count))
+    return func
+
+
+def codegen_unpack(mod, lib, name, out_type):
+    """Emit a native function copying the elements of a list of numbers to an
+    array of numbers of the given type. Integers are converted to doubles if
+    necessary.
+
+    The arguments are the list, the output array and its capacity. Elements
+    beyond the capacity are counted but not stored. Returns the length of the
+    list, or -(i + 1) if element i is not a number of the right type or the
+    list is improper at that point.
+    """
+    unpack_type = ir.FunctionType(_i64, (_obj_ptr_t, _i8.as_pointer(), _i64))
+    func = ir.Function(mod, unpack_type, name)
+    node, outputs, capacity = func.args
+    bld = ir.IRBuilder(func.append_basic_block('entry'))
+    outputs = bld.bitcast(outputs, _number_types[out_type].as_pointer())
+    nil = _obj_ptr(bld, PtObject.nil)
+    entry = bld.block
+
+    loop = func.append_basic_block('loop')
+    body = func.append_basic_block('body')
+    improper = func.append_basic_block('improper')
+    bld.branch(loop)
+    bld.position_at_end(loop)
+    index = bld.phi(_i64)
+    index.add_incoming(_i64c(0), entry)
+    cell = bld.phi(_obj_ptr_t)
+    cell.add_incoming(node, entry)
+    failure = bld.sub(_i64c(-1), index)
+    with bld.if_then(bld.icmp_unsigned('==', cell, nil), likely=False):
+        bld.ret(index)
+    conslp = bld.icmp_signed('==', _type_of(bld, lib, cell), _i32c(int(PtType.cons)))
+    bld.cbranch(conslp, body, improper)
+    bld.position_at_end(improper)
+    bld.ret(failure)
+
+    bld.position_at_end(body)
+    car, cdr = _get_cons(bld, cell)
+    value_type, ival, dval = _unbox_number(bld, lib, car)
+    intp = bld.icmp_signed('==', value_type, _i32c(int(PtType.integer)))
+    if out_type == PtType.integer:
+        okp, result = intp, ival
+    else:
+        okp = bld.or_(intp, bld.icmp_signed('==', value_type, _i32c(int(PtType.double))))
+        result = bld.select(intp, bld.sitofp(ival, dval.type), dval)
+    with bld.if_then(bld.not_(okp), likely=False):
+        bld.ret(failure)
+    with bld.if_then(bld.icmp_signed('<', index, capacity)):
+        bld.store(result, bld.gep(outputs, (index,)))
+    index.add_incoming(bld.add(index, _i64c(1)), bld.block)
+    cell.add_incoming(cdr, bld.block)
+    bld.branch(loop)
+    return func
+
+
+def _codegen_lookup(mod):
+    """Emit a private function returning the interned symbol with a given name,
+    as a NUL terminated string, or null if there is none. The hash is the same
+    as symbol_hash.
+    """
+    func = mod.globals.get('##lookup')
+    if func is not None:
+        return func
+    func = ir.Function(mod, ir.FunctionType(_obj_ptr_t, (_i8.as_pointer(),)), '##lookup')
+    func.linkage = 'private'
+    name, = func.args
+    entry = func.append_basic_block('entry')
+    hash_loop, hash_body = func.append_basic_block('hash'), func.append_basic_block('hash_body')
+    probe, check, compare = func.append_basic_block('probe'), func.append_basic_block('check'), func.append_basic_block('compare')
+    compare_next, following = func.append_basic_block('compare_next'), func.append_basic_block('next')
+    found, missing = func.append_basic_block('found'), func.append_basic_block('missing')
+    bld = ir.IRBuilder(entry)
+    table = _external(mod, '##symtab', llvm_types.PtSymbolTable)
+    entries = bld.load(bld.gep(table, (_i32c(0), _i32c(0))))
+    mask = bld.load(bld.gep(table, (_i32c(0), _i32c(1))))
+    bld.branch(hash_loop)
+
+    bld.position_at_end(hash_loop)
+    index = bld.phi(_i64)
+    index.add_incoming(_i64c(0), entry)
+    h = bld.phi(_i64)
+    h.add_incoming(_i64c(FNV_OFFSET - (1 << 64)), entry)
+    char = bld.load(bld.gep(name, (index,)))
+    start = bld.and_(h, mask)
+    bld.cbranch(bld.icmp_unsigned('==', char, _i8c(0)), probe, hash_body)
+    bld.position_at_end(hash_body)
+    index.add_incoming(bld.add(index, _i64c(1)), hash_body)
+    h.add_incoming(bld.mul(bld.xor(h, bld.zext(char, _i64)), _i64c(FNV_PRIME)), hash_body)
+    bld.branch(hash_loop)
+
+    bld.position_at_end(probe)
+    slot = bld.phi(_i64)
+    slot.add_incoming(start, hash_loop)
+    entry_ptr = bld.gep(entries, (slot,))
+    value = bld.load(bld.gep(entry_ptr, (_i32c(0), _i32c(2))))
+    emptyp = bld.icmp_unsigned('==', value, ir.Constant(_obj_ptr_t, None))
+    bld.cbranch(emptyp, missing, check)
+
+    bld.position_at_end(check)
+    samep = bld.icmp_unsigned('==', bld.load(bld.gep(entry_ptr, (_i32c(0), _i32c(0)))), h)
+    other = bld.load(bld.gep(entry_ptr, (_i32c(0), _i32c(1))))
+    bld.cbranch(samep, compare, following)
+
+    bld.position_at_end(compare)
+    offset = bld.phi(_i64)
+    offset.add_incoming(_i64c(0), check)
+    char = bld.load(bld.gep(name, (offset,)))
+    equalp = bld.icmp_unsigned('==', char, bld.load(bld.gep(other, (offset,))))
+    bld.cbranch(equalp, compare_next, following)
+    bld.position_at_end(compare_next)
+    offset.add_incoming(bld.add(offset, _i64c(1)), compare_next)
+    bld.cbranch(bld.icmp_unsigned('==', char, _i8c(0)), found, compare)
+
+    bld.position_at_end(following)
+    slot.add_incoming(bld.and_(bld.add(slot, _i64c(1)), mask), following)
+    bld.branch(probe)
+    bld.position_at_end(found)
+    bld.ret(value)
+    bld.position_at_end(missing)
+    bld.ret(ir.Constant(_obj_ptr_t, None))
+    return func
+
+
+def _single_argument(bld, lib, func, type_):
+    """Return the argument of a runtime function taking one argument of the given
+    type, returning null if it was called with anything else.
+    """
+    nargs, args = func.args
+    with bld.if_then(bld.icmp_signed('!=', nargs, _i32c(1)), likely=False):
+        codegen_return(bld, lib, ir.Constant(_obj_ptr_t, None))
+    arg = bld.load(args)
+    _return_if_not_type(bld, lib, arg, type_)
+    return arg
+
+
+def codegen_intern(mod, lib, name):
+    """Emit a native version of the intern runtime function. Names not yet in the
+    symbol table are interned by calling back into Python.
+    """
+    func = ir.Function(mod, llvm_types.PtFunction, name)
+    bld = ir.IRBuilder(func.append_basic_block('entry'))
+    codegen_prologue(bld, lib)
+    arg = _single_argument(bld, lib, func, PtType.bytestring)
+    string = bld.load(bld.bitcast(bld.gep(arg, (_i32c(0), _i32c(1))), _i8.as_pointer().as_pointer()))
+    symbol = bld.call(_codegen_lookup(mod), (string,))
+    with bld.if_then(bld.icmp_unsigned('==', symbol, ir.Constant(_obj_ptr_t, None)), likely=False):
+        table = _external(mod, '##symtab', llvm_types.PtSymbolTable)
+        create = bld.load(bld.gep(table, (_i32c(0), _i32c(3))))
+        created = bld.call(bld.bitcast(create, llvm_types.PtSymbolCreate.as_pointer()), (string,))
+        codegen_return(bld, lib, created)
+    codegen_return(bld, lib, symbol)
+    return func
+
+
+def codegen_symbol_name(mod, lib, name, fallback):
+    """Emit a native version of the symbol-name runtime function. The string
+    shares its contents with the name of the symbol, which lives as long as the
+    symbol table for interned symbols. Other symbols are passed on to the
+    function object `fallback`.
+    """
+    func = ir.Function(mod, llvm_types.PtFunction, name)
+    bld = ir.IRBuilder(func.append_basic_block('entry'))
+    codegen_prologue(bld, lib)
+    arg = _single_argument(bld, lib, func, PtType.symbol)
+    record = bld.load(bld.bitcast(bld.gep(arg, (_i32c(0), _i32c(1))), llvm_types.PtSymbol.as_pointer().as_pointer()))
+    string = bld.load(bld.gep(record, (_i32c(0), _i32c(0))))
+    internedp = bld.icmp_unsigned('==', bld.call(_codegen_lookup(mod), (string,)), arg)
+    with bld.if_then(bld.not_(internedp), likely=False):
+        function = _obj_ptr(bld, fallback)
+        native_loc = bld.gep(function, (_i32c(0), _i32c(1)))
+        native = bld.load(bld.bitcast(native_loc, llvm_types.PtFunction.as_pointer().as_pointer()))
+        codegen_return(bld, lib, bld.call(native, func.args))
     obj = _empty_object(bld, lib)
-    _set_contents(
-        bld, obj, PtType.bytestring,
-        bld.bitcast(buf, llvm_types.PtContents_bytestring)
-    )
-    return obj
+    _set_contents(bld, obj, PtType.bytestring, string)
+    codegen_return(bld, lib, obj)
+    return func
+
+
+def _codegen_constant(node, bld, mod, lib, ns):
+    return lib['constants'].get(node, mod)
 
 
 def _codegen_symbol(node, bld, mod, lib, ns):
-    symbol = node.contents.symbol
+    symbol = node.contents.symbol.contents
     if symbol in ns:
         return ns[symbol]
 
-    value = bld.load(_obj_ptr(bld, symbol.binding, indirection=2))
-    _return_if_zero(bld, value)
+    value = bld.load(_binding_ptr(bld, symbol))
+    _return_if_zero(bld, lib, value)
+    _push_root(bld, lib, value)
     return value
 
 
-def _codegen_if(node, bld, mod, lib, ns):
+def _codegen_if(node, bld, mod, lib, ns, tailpos=False):
     true_branch = PtObject.nil
     false_branch = []
     cond, tail = node.car, node.cdr
@@ -123,19 +810,23 @@ def _codegen_if(node, bld, mod, lib, ns):
     cond = codegen(cond, bld, mod, lib, ns)
     with bld.if_else(_is_truthy(bld, cond)) as (true, false):
         with true:
-            true_val = codegen(true_branch, bld, mod, lib, ns)
+            true_val = codegen(true_branch, bld, mod, lib, ns, tailpos=tailpos)
             true_blk = bld.block
         with false:
-            for node in false_branch:
-                false_val = codegen(node, bld, mod, lib, ns)
+            for node in false_branch[:-1]:
+                codegen(node, bld, mod, lib, ns)
+            false_val = codegen(false_branch[-1], bld, mod, lib, ns, tailpos=tailpos)
             false_blk = bld.block
+    if tailpos:
+        bld.unreachable()
+        return
     retval = bld.phi(llvm_types.PtObject.as_pointer())
     retval.add_incoming(true_val, true_blk)
     retval.add_incoming(false_val, false_blk)
     return retval
 
 
-def _codegen_let(node, bld, mod, lib, ns):
+def _codegen_let(node, bld, mod, lib, ns, tailpos=False):
     bindings, body = node.car, node.cdr
     sub_ns = dict(ns)
     for binding in bindings:
@@ -146,97 +837,581 @@ def _codegen_let(node, bld, mod, lib, ns):
             name = binding.car
             if binding.cdr:
                 value = binding.cdr.car
-        sub_ns[name.contents.symbol] = codegen(value, bld, mod, lib, ns)
-    retval = None
-    for expr in body:
-        retval = codegen(expr, bld, mod, lib, sub_ns)
-    if retval is None:
-        return codegen(PtObject.nil, bld, mod, lib, ns)
+        sub_ns[name.contents.symbol.contents] = codegen(value, bld, mod, lib, ns)
+    return _codegen_body(list(body), bld, mod, lib, sub_ns, tailpos=tailpos)
+
+
+def _codegen_body(nodes, bld, mod, lib, ns, tailpos=False):
+    """Compile a sequence of expressions, returning the value of the last one."""
+    nodes = nodes or [PtObject.nil]
+    for node in nodes[:-1]:
+        codegen(node, bld, mod, lib, ns)
+    return codegen(nodes[-1], bld, mod, lib, ns, tailpos=tailpos)
+
+
+def _build_list(bld, lib, values, final):
+    retval = final
+    for value in values[::-1]:
+        obj = _empty_object(bld, lib)
+        _set_cons(bld, obj, value, retval)
+        retval = obj
     return retval
 
 
-def _codegen_funcall(node, bld, mod, lib, ns):
-    head, tail = node.car, node.cdr
+def _symbols(node):
+    """Iterate over all symbols occuring in an expression."""
+    if node.type == PtType.symbol:
+        yield node.contents.symbol.contents
+    elif node.type == PtType.cons and bool(node):
+        yield from _symbols(node.car)
+        yield from _symbols(node.cdr)
 
-    function = codegen(head, bld, mod, lib, ns)
-    _return_if_not_type(bld, function, PtType.function)
 
-    args = list(tail)
-    arglist_type = ir.ArrayType(llvm_types.PtObject.as_pointer(), len(args))
-    arglist = bld.alloca(arglist_type)
-    for i, arg in enumerate(args):
-        value = codegen(arg, bld, mod, lib, ns)
+def _codegen_lambda(node, bld, mod, lib, ns, name='lambda', symbol=None):
+    """Compile a function to a native function with the PtFunction signature, and
+    return a function object for it.
+
+    Variables from the enclosing scope used in the body are captured in the
+    environment of the function object. The function object itself is passed to
+    the native function as a hidden argument after the regular ones. Functions
+    without captured variables get a static function object, and if `symbol` is
+    given, they are registered as bound to it.
+
+    The body is a loop, so that self tail calls can jump back to the start.
+    """
+    params, body = node.car, node.cdr
+    params = [param.contents.symbol.contents for param in params]
+    captured = []
+    for sym in _symbols(body):
+        if sym in ns and sym not in params and sym not in captured:
+            captured.append(sym)
+
+    func = ir.Function(mod, llvm_types.PtFunction, lib['functions'].new_name(name))
+    if not captured:
+        type_ = _constant_type(llvm_types.PtContents_function, _obj_ptr_t)
+        obj = ir.GlobalVariable(mod, type_, func.name + '##obj')
+        obj.initializer = type_([
+            _i32c(int(PtType.function)),
+            func.bitcast(llvm_types.PtContents_function),
+            _external_object(mod, PtObject.nil),
+            type_.elements[-1](None),
+        ])
+        obj.global_constant = True
+        if symbol is not None:
+            lib['functions'].add(symbol, func, obj, len(params))
+
+    fbld = ir.IRBuilder(func.append_basic_block('entry'))
+    flib = dict(lib)
+    codegen_prologue(fbld, flib)
+    nargs, argv = func.args
+    with fbld.if_then(fbld.icmp_signed('!=', nargs, _i32c(len(params))), likely=False):
+        codegen_return(fbld, flib, fbld.inttoptr(_i64c(0), _obj_ptr_t))
+
+    # All arguments must be read before anything is pushed on the root stack,
+    # since tail calls pass them there.
+    slots = []
+    for i, param in enumerate(params):
+        slot = _entry_alloca(fbld, _obj_ptr_t)
+        fbld.store(fbld.load(fbld.gep(argv, (_i32c(i),))), slot)
+        slots.append(slot)
+    fns = {}
+    if captured:
+        closure = fbld.load(fbld.gep(argv, (nargs,)))
+        ptr = fbld.bitcast(fbld.gep(closure, (_i32c(0), _i32c(1))), llvm_types.PtClosure.as_pointer())
+        env = fbld.load(fbld.gep(ptr, (_i32c(0), _i32c(1))))
+        for sym in captured:
+            fns[sym], env = _get_cons(fbld, env)
+            _push_root(fbld, flib, fns[sym])
+
+    loop = func.append_basic_block('loop')
+    fbld.branch(loop)
+    fbld.position_at_end(loop)
+    top = fbld.load(fbld.gep(_heap_state(fbld, flib), (_i32c(0), _i32c(2))))
+    for param, slot in zip(params, slots):
+        fns[param] = fbld.load(slot)
+        _push_root(fbld, flib, fns[param])
+    flib['self'] = (func, loop, slots, top)
+
+    _codegen_body(list(body), fbld, mod, flib, fns, tailpos=True)
+
+    if not captured:
+        return obj.bitcast(_obj_ptr_t)
+    env = _build_list(bld, lib, [ns[sym] for sym in captured], _obj_ptr(bld, PtObject.nil))
+    obj = _empty_object(bld, lib)
+    _set_closure(bld, obj, func, env)
+    return obj
+
+
+def _codegen_define(node, bld, mod, lib, ns):
+    target, tail = node.car, node.cdr
+    if target.type == PtType.cons:
+        name = target.car
+        value = _codegen_lambda(
+            PtObject.cons(target.cdr, tail), bld, mod, lib, ns,
+            name=str(name), symbol=name.contents.symbol.contents,
+        )
+    elif tail and tail.car.type == PtType.cons and bool(tail.car) and tail.car.car == PtObject.intern('lambda'):
+        name = target
+        value = _codegen_lambda(
+            tail.car.cdr, bld, mod, lib, ns,
+            name=str(name), symbol=name.contents.symbol.contents,
+        )
+    else:
+        name = target
+        value = codegen(tail.car if tail else PtObject.nil, bld, mod, lib, ns)
+
+    binding = _binding_ptr(bld, name.contents.symbol.contents)
+    bld.store(value, binding)
+    return _obj_ptr(bld, name)
+
+
+def _call_function(bld, lib, function, args, callee=None, tailpos=False):
+    """Call a function object with the given arguments. If the native function is
+    known, it may be given as `callee` to emit a direct call.
+
+    In tail position, the current function returns the result of the call. The
+    call is then emitted as a guaranteed tail call, and since the caller's stack
+    frame is gone when the callee runs, the arguments are passed on the root
+    stack, overwriting the caller's roots.
+    """
+    if callee is None:
+        func_ptr_loc = bld.gep(function, (_i32c(0), _i32c(1)))
+        func_ptr_loc = bld.bitcast(func_ptr_loc, llvm_types.PtFunction.as_pointer().as_pointer())
+        callee = bld.load(func_ptr_loc)
+
+    if tailpos:
+        top_loc = bld.gep(_heap_state(bld, lib), (_i32c(0), _i32c(2)))
+        bld.store(lib['roots'], top_loc)
+        args_ptr = bld.inttoptr(lib['roots'], _obj_ptr_t.as_pointer())
+        for i, value in enumerate(args + [function]):
+            bld.store(value, bld.gep(args_ptr, (_i32c(i),)))
+        retval = bld.call(callee, (_i32c(len(args)), args_ptr), tail='musttail')
+        bld.ret(retval)
+        return
+
+    arglist_type = ir.ArrayType(llvm_types.PtObject.as_pointer(), len(args) + 1)
+    arglist = _entry_alloca(bld, arglist_type)
+    for i, value in enumerate(args + [function]):
         ptr = bld.gep(arglist, (_i32c(0), _i32c(i)))
         bld.store(value, ptr)
-
-    func_ptr_loc = bld.gep(function, (_i32c(0), _i32c(1)))
-    func_ptr_loc = bld.bitcast(func_ptr_loc, llvm_types.PtFunction.as_pointer().as_pointer())
-    func_ptr = bld.load(func_ptr_loc)
     args_ptr = bld.gep(arglist, (_i32c(0), _i32c(0)))
-    retval = bld.call(func_ptr, (_i32c(len(args)), args_ptr))
-    _return_if_zero(bld, retval)
+    retval = bld.call(callee, (_i32c(len(args)), args_ptr))
+    _return_if_zero(bld, lib, retval)
+    _push_root(bld, lib, retval)
     return retval
 
 
-def _codegen_cons(node, bld, mod, lib, ns):
-    if not bool(node):
-        return _obj_ptr(bld, PtObject.nil)
+def _codegen_funcall(node, bld, mod, lib, ns, tailpos=False):
     head, tail = node.car, node.cdr
-    if head == PtObject.intern('quote'):
-        return codegen_copy(tail.car, bld, mod, lib, ns)
-    if head == PtObject.intern('begin'):
-        nodes = list(tail) or [PtObject.nil]
-        for node in nodes:
-            retval = codegen(node, bld, mod, lib, ns)
-        return retval
-    if head == PtObject.intern('if'):
-        return _codegen_if(tail, bld, mod, lib, ns)
-    if head == PtObject.intern('let'):
-        return _codegen_let(tail, bld, mod, lib, ns)
-    return _codegen_funcall(node, bld, mod, lib, ns)
 
+    function = codegen(head, bld, mod, lib, ns)
+    _return_if_not_type(bld, lib, function, PtType.function)
+    args = [codegen(arg, bld, mod, lib, ns) for arg in tail]
+    return _call_function(bld, lib, function, args, tailpos=tailpos)
 
-def _codegen_copy_symbol(node, bld, *args):
-    return _obj_ptr(bld, node)
 
+def _codegen_self_call(bld, lib, args):
+    """Compile a self tail call as a jump back to the start of the function."""
+    func, loop, slots, top = lib['self']
+    for value, slot in zip(args, slots):
+        bld.store(value, slot)
+    bld.store(top, bld.gep(_heap_state(bld, lib), (_i32c(0), _i32c(2))))
+    bld.branch(loop)
 
-def _codegen_copy_cons(node, bld, mod, lib, ns):
-    if not bool(node):
-        return _obj_ptr(bld, PtObject.nil)
 
-    car = codegen_copy(node.car, bld, mod, lib, ns)
-    cdr = codegen_copy(node.cdr, bld, mod, lib, ns)
+def _codegen_direct_call(node, entry, bld, mod, lib, ns, tailpos=False):
+    head, tail = node.car, node.cdr
+    callee, expected = lib['functions'].declare(entry, mod)
+    args = [codegen(arg, bld, mod, lib, ns) for arg in tail]
+    selfp = tailpos and 'self' in lib and lib['self'][0].name == callee.name
+
+    function = bld.load(_binding_ptr(bld, head.contents.symbol.contents))
+    samep = bld.icmp_unsigned('==', bld.ptrtoint(function, _i64), bld.ptrtoint(expected, _i64))
+    with bld.if_else(samep, likely=True) as (direct, indirect):
+        with direct:
+            if selfp:
+                _codegen_self_call(bld, lib, args)
+            else:
+                direct_val = _call_function(bld, lib, expected, args, callee=callee, tailpos=tailpos)
+            direct_blk = bld.block
+        with indirect:
+            _return_if_zero(bld, lib, function)
+            _push_root(bld, lib, function)
+            _return_if_not_type(bld, lib, function, PtType.function)
+            indirect_val = _call_function(bld, lib, function, args, tailpos=tailpos)
+            indirect_blk = bld.block
+    if tailpos:
+        bld.unreachable()
+        return
+    retval = bld.phi(_obj_ptr_t)
+    retval.add_incoming(direct_val, direct_blk)
+    retval.add_incoming(indirect_val, indirect_blk)
+    return retval
+
+
+_native_types = {
+    int: _i64,
+    float: llvm_types.PtContents_double,
+    str: llvm_types.PtContents_bytestring,
+}
+
 
-    cons = bld.alloca(llvm_types.PtCons)
-    ptr = bld.gep(cons, (_i32c(0), _i32c(0)))
-    bld.store(car, ptr)
-    ptr = bld.gep(cons, (_i32c(0), _i32c(1)))
-    bld.store(cdr, ptr)
+def _unbox_argument(bld, lib, value, type_):
+    """Check whether a value can be passed to a typed callback as a parameter of
+    the given type. Returns a condition, and a function emitting the native
+    value, which may only be called where the condition holds.
+    """
+    if type_ is str:
+        okp = bld.icmp_signed('==', _type_of(bld, lib, value), _i32c(int(PtType.bytestring)))
+        def unbox():
+            ptr = bld.gep(value, (_i32c(0), _i32c(1)))
+            return bld.load(bld.bitcast(ptr, llvm_types.PtContents_bytestring.as_pointer()))
+        return okp, unbox
+
+    value_type, ival, dval = _unbox_number(bld, lib, value)
+    intp = bld.icmp_signed('==', value_type, _i32c(int(PtType.integer)))
+    if type_ is int:
+        return intp, lambda: ival
+    doublep = bld.icmp_signed('==', value_type, _i32c(int(PtType.double)))
+    return bld.or_(intp, doublep), lambda: bld.select(intp, bld.sitofp(ival, dval.type), dval)
+
+
+def _codegen_typed_call(node, callback, bld, mod, lib, ns, tailpos=False):
+    """Compile a call to a typed callback. If the symbol is still bound to the
+    callback and the arguments have the declared types, the native entry is
+    called with unboxed values, and otherwise the function bound to the
+    symbol is called as usual.
+    """
+    head, tail = node.car, node.cdr
+    args = [codegen(arg, bld, mod, lib, ns) for arg in tail]
+
+    function = bld.load(_binding_ptr(bld, head.contents.symbol.contents))
+    expected = _external(mod, '##cbobj##' + callback.name, llvm_types.PtObject)
+    okp = bld.icmp_unsigned('==', bld.ptrtoint(function, _i64), bld.ptrtoint(expected, _i64))
+    unboxers = []
+    for arg, type_ in zip(args, callback.params):
+        argp, unbox = _unbox_argument(bld, lib, arg, type_)
+        okp = bld.and_(okp, argp)
+        unboxers.append(unbox)
+
+    numeric = callback.result in (int, float)
+    native_type = ir.FunctionType(
+        _native_types[callback.result] if numeric else _obj_ptr_t,
+        [_native_types[type_] for type_ in callback.params],
+    )
+    with bld.if_else(okp, likely=True) as (direct, indirect):
+        with direct:
+            native = _external(mod, '##cb##' + callback.name, native_type)
+            value = bld.call(native, [unbox() for unbox in unboxers])
+            if numeric:
+                error = _external(mod, '##callback_error', _i32)
+                with bld.if_then(bld.icmp_signed('!=', bld.load(error), _i32c(0)), likely=False):
+                    bld.store(_i32c(0), error)
+                    codegen_return(bld, lib, bld.inttoptr(_i64c(0), _obj_ptr_t))
+                type_ = PtType.integer if callback.result is int else PtType.double
+                direct_val = _box_number(bld, lib, type_, value)
+            else:
+                _return_if_zero(bld, lib, value)
+                _push_root(bld, lib, value)
+                direct_val = value
+            direct_blk = bld.block
+        with indirect:
+            _return_if_zero(bld, lib, function)
+            _push_root(bld, lib, function)
+            _return_if_not_type(bld, lib, function, PtType.function)
+            indirect_val = _call_function(bld, lib, function, args)
+            indirect_blk = bld.block
+
+    retval = bld.phi(_obj_ptr_t)
+    retval.add_incoming(direct_val, direct_blk)
+    retval.add_incoming(indirect_val, indirect_blk)
+    if tailpos:
+        codegen_return(bld, lib, retval)
+        return
+    return retval
+
+
+def _unbox_number(bld, lib, value):
+    """Return the type of a value, and its contents interpreted as an integer
+    and as a double. The contents are only meaningful for the matching type.
+    """
+    ptr = bld.gep(value, (_i32c(0), _i32c(1)))
+    if not lib['fixnums']:
+        value_type = bld.load(bld.gep(value, (_i32c(0), _i32c(0))))
+        ival = bld.load(bld.bitcast(ptr, llvm_types.PtContents_integer.as_pointer()))
+        dval = bld.load(bld.bitcast(ptr, llvm_types.PtContents_double.as_pointer()))
+        return value_type, ival, dval
+
+    fixnump = bld.trunc(bld.ptrtoint(value, _i64), ir.IntType(1))
+    with bld.if_else(fixnump, likely=True) as (fixnum, boxed):
+        with fixnum:
+            fixnum_ival = bld.ashr(bld.ptrtoint(value, _i64), _i64c(1))
+            fixnum_blk = bld.block
+        with boxed:
+            boxed_type = bld.load(bld.gep(value, (_i32c(0), _i32c(0))))
+            boxed_ival = bld.load(bld.bitcast(ptr, llvm_types.PtContents_integer.as_pointer()))
+            boxed_dval = bld.load(bld.bitcast(ptr, llvm_types.PtContents_double.as_pointer()))
+            boxed_blk = bld.block
+
+    value_type = bld.phi(_i32)
+    value_type.add_incoming(_i32c(int(PtType.integer)), fixnum_blk)
+    value_type.add_incoming(boxed_type, boxed_blk)
+    ival = bld.phi(_i64)
+    ival.add_incoming(fixnum_ival, fixnum_blk)
+    ival.add_incoming(boxed_ival, boxed_blk)
+    dval = bld.phi(llvm_types.PtContents_double)
+    dval.add_incoming(ir.Constant(llvm_types.PtContents_double, ir.Undefined), fixnum_blk)
+    dval.add_incoming(boxed_dval, boxed_blk)
+    return value_type, ival, dval
+
+
+def _box_number(bld, lib, type_, value):
+    """Create an object from an integer or double value."""
+    if type_ == PtType.integer and lib['fixnums']:
+        tagged = bld.or_(bld.shl(value, _i64c(1)), _i64c(1))
+        fitsp = bld.icmp_signed('==', bld.ashr(tagged, _i64c(1)), value)
+        with bld.if_else(fitsp, likely=True) as (fixnum, boxed):
+            with fixnum:
+                fixnum_obj = bld.inttoptr(tagged, _obj_ptr_t)
+                fixnum_blk = bld.block
+            with boxed:
+                boxed_obj = _empty_object(bld, lib)
+                _set_contents(bld, boxed_obj, type_, value)
+                boxed_blk = bld.block
+        obj = bld.phi(_obj_ptr_t)
+        obj.add_incoming(fixnum_obj, fixnum_blk)
+        obj.add_incoming(boxed_obj, boxed_blk)
+        return obj
 
     obj = _empty_object(bld, lib)
-    _set_contents(bld, obj, PtType.cons, bld.load(cons))
+    _set_contents(bld, obj, type_, value)
     return obj
 
 
-_node_dispatch = {
-    PtType.integer: _codegen_integer,
-    PtType.double: _codegen_double,
-    PtType.bytestring: _codegen_bytestring,
-    PtType.symbol: _codegen_symbol,
-    PtType.cons: _codegen_cons,
+def _bool_object(bld, cond):
+    return bld.select(
+        cond,
+        _obj_ptr(bld, PtObject.intern('t')),
+        _obj_ptr(bld, PtObject.nil),
+    )
+
+
+def _arith_add(bld, lib, type_, a, b):
+    if type_ == PtType.integer:
+        return _box_number(bld, lib, type_, bld.add(a, b))
+    return _box_number(bld, lib, type_, bld.fadd(a, b))
+
+
+def _arith_sub(bld, lib, type_, a, b):
+    if type_ == PtType.integer:
+        return _box_number(bld, lib, type_, bld.sub(a, b))
+    return _box_number(bld, lib, type_, bld.fsub(a, b))
+
+
+def _arith_mul(bld, lib, type_, a, b):
+    if type_ == PtType.integer:
+        return _box_number(bld, lib, type_, bld.mul(a, b))
+    return _box_number(bld, lib, type_, bld.fmul(a, b))
+
+
+def _arith_div(bld, lib, type_, a, b):
+    if type_ == PtType.integer:
+        return _box_number(bld, lib, type_, bld.sdiv(a, b))
+    return _box_number(bld, lib, type_, bld.fdiv(a, b))
+
+
+def _int_div_safe(bld, a, b):
+    """Integer division traps on zero divisors and on overflow. Such cases are
+    left to the slow path.
+    """
+    nonzero = bld.icmp_signed('!=', b, _i64c(0))
+    overflow = bld.and_(
+        bld.icmp_signed('==', a, _i64c(-(1 << 63))),
+        bld.icmp_signed('==', b, _i64c(-1)),
+    )
+    return bld.and_(nonzero, bld.not_(overflow))
+
+
+def _compare(op):
+    def emit(bld, lib, type_, a, b):
+        if type_ == PtType.integer:
+            return _bool_object(bld, bld.icmp_signed(op, a, b))
+        return _bool_object(bld, bld.fcmp_ordered(op, a, b))
+    return emit
+
+
+# Primitives compiled inline, with the code generator and an optional guard for
+# the integer case. Any other combination of arguments than two integers or two
+# doubles is handled by calling the generic function bound to the symbol. If the
+# symbol has been bound to another function, that is called instead. Calls to
+# cons and list are compiled inline the same way, by allocating the cells.
+_arith_primitives = {
+    '+': (_arith_add, None),
+    '-': (_arith_sub, None),
+    '*': (_arith_mul, None),
+    '/': (_arith_div, _int_div_safe),
 }
 
-def codegen(node, *args):
-    return _node_dispatch[node.type](node, *args)
+_compare_primitives = {
+    '<': (_compare('<'), None),
+    '>': (_compare('>'), None),
+    '<=': (_compare('<='), None),
+    '>=': (_compare('>='), None),
+    '=': (_compare('=='), None),
+}
+
+_primitives = dict(_arith_primitives, **_compare_primitives)
+
 
+def _codegen_binary_primitive(name, function, a, b, bld, mod, lib, ns):
+    emit, guard = _primitives[name]
+    a_type, a_ival, a_dval = _unbox_number(bld, lib, a)
+    b_type, b_ival, b_dval = _unbox_number(bld, lib, b)
 
-_node_copy_dispatch = {
-    PtType.integer: _codegen_integer,
-    PtType.double: _codegen_double,
-    PtType.bytestring: _codegen_bytestring,
-    PtType.symbol: _codegen_copy_symbol,
-    PtType.cons: _codegen_copy_cons,
+    int_type = _i32c(int(PtType.integer))
+    double_type = _i32c(int(PtType.double))
+    intp = bld.and_(bld.icmp_signed('==', a_type, int_type), bld.icmp_signed('==', b_type, int_type))
+    if guard is not None:
+        intp = bld.and_(intp, guard(bld, a_ival, b_ival))
+    doublep = bld.and_(
+        bld.icmp_signed('==', a_type, double_type),
+        bld.icmp_signed('==', b_type, double_type),
+    )
+
+    int_blk = bld.append_basic_block('{}.int'.format(name))
+    not_int_blk = bld.append_basic_block('{}.notint'.format(name))
+    double_blk = bld.append_basic_block('{}.double'.format(name))
+    slow_blk = bld.append_basic_block('{}.slow'.format(name))
+    merge_blk = bld.append_basic_block('{}.merge'.format(name))
+    bld.cbranch(intp, int_blk, not_int_blk)
+    bld.position_at_end(not_int_blk)
+    bld.cbranch(doublep, double_blk, slow_blk)
+
+    results = []
+    for blk, type_, args in [
+            (int_blk, PtType.integer, (a_ival, b_ival)),
+            (double_blk, PtType.double, (a_dval, b_dval))]:
+        bld.position_at_end(blk)
+        results.append((emit(bld, lib, type_, *args), bld.block))
+        bld.branch(merge_blk)
+
+    bld.position_at_end(slow_blk)
+    results.append((_call_function(bld, lib, function, [a, b]), bld.block))
+    bld.branch(merge_blk)
+
+    bld.position_at_end(merge_blk)
+    retval = bld.phi(_obj_ptr_t)
+    for value, blk in results:
+        retval.add_incoming(value, blk)
+    return retval
+
+
+def _codegen_primitive(node, bld, mod, lib, ns):
+    """Compile a call to a primitive: cons, list, or an arithmetic or comparison
+    primitive. Arithmetic with more than two arguments is folded from the left.
+    """
+    name = str(node.car)
+    args = [codegen(arg, bld, mod, lib, ns) for arg in node.cdr]
+    function = _codegen_symbol(node.car, bld, mod, lib, ns)
+    _return_if_not_type(bld, lib, function, PtType.function)
+    generic = _external(mod, '##prim##' + name, llvm_types.PtObject)
+    redefined = bld.icmp_unsigned('!=', function, generic)
+    with bld.if_else(redefined, likely=False) as (then, otherwise):
+        with then:
+            call_val = _call_function(bld, lib, function, args)
+            call_blk = bld.block
+        with otherwise:
+            if name == 'cons':
+                inline_val = _build_list(bld, lib, args[:1], args[1])
+            elif name == 'list':
+                inline_val = _build_list(bld, lib, args, _obj_ptr(bld, PtObject.nil))
+            else:
+                inline_val = args[0]
+                for arg in args[1:]:
+                    inline_val = _codegen_binary_primitive(name, function, inline_val, arg, bld, mod, lib, ns)
+            inline_blk = bld.block
+    retval = bld.phi(_obj_ptr_t)
+    retval.add_incoming(call_val, call_blk)
+    retval.add_incoming(inline_val, inline_blk)
+    return retval
+
+
+def _is_primitive(node, ns):
+    if node.car.type != PtType.symbol or node.car.contents.symbol.contents in ns:
+        return False
+    name = str(node.car)
+    nargs = len(list(node.cdr))
+    if name in _arith_primitives:
+        return nargs >= 2
+    if name == 'list':
+        return True
+    return (name in _compare_primitives or name == 'cons') and nargs == 2
+
+
+def _codegen_cons(node, bld, mod, lib, ns, tailpos=False):
+    if not bool(node):
+        return _obj_ptr(bld, PtObject.nil)
+    head, tail = node.car, node.cdr
+    if head == PtObject.intern('quote'):
+        return _codegen_constant(tail.car, bld, mod, lib, ns)
+    if head == PtObject.intern('begin'):
+        return _codegen_body(list(tail), bld, mod, lib, ns, tailpos=tailpos)
+    if head == PtObject.intern('if'):
+        return _codegen_if(tail, bld, mod, lib, ns, tailpos=tailpos)
+    if head == PtObject.intern('let'):
+        return _codegen_let(tail, bld, mod, lib, ns, tailpos=tailpos)
+    if head == PtObject.intern('lambda'):
+        return _codegen_lambda(tail, bld, mod, lib, ns)
+    if head == PtObject.intern('define'):
+        return _codegen_define(tail, bld, mod, lib, ns)
+    if _is_primitive(node, ns):
+        return _codegen_primitive(node, bld, mod, lib, ns)
+    if head.type == PtType.symbol and head.contents.symbol.contents not in ns:
+        entry = lib['functions'].get(head.contents.symbol.contents)
+        if entry is not None and entry[-1] == len(list(tail)):
+            return _codegen_direct_call(node, entry, bld, mod, lib, ns, tailpos=tailpos)
+        callback = PtObject.typed_callback(str(head))
+        if callback is not None and len(callback.params) == len(list(tail)):
+            return _codegen_typed_call(node, callback, bld, mod, lib, ns, tailpos=tailpos)
+    return _codegen_funcall(node, bld, mod, lib, ns, tailpos=tailpos)
+
+
+# Special forms that handle being in tail position themselves
+_tail_forms = {'begin', 'if', 'let'}
+
+
+def _handles_tailpos(node, ns):
+    if node.type != PtType.cons or not bool(node):
+        return False
+    head = node.car
+    if head.type != PtType.symbol:
+        return True
+    name = str(head)
+    if name in _tail_forms:
+        return True
+    if name in {'quote', 'lambda', 'define'} or _is_primitive(node, ns):
+        return False
+    return True
+
+
+_node_dispatch = {
+    PtType.integer: _codegen_constant,
+    PtType.double: _codegen_constant,
+    PtType.bytestring: _codegen_constant,
+    PtType.symbol: _codegen_symbol,
+    PtType.cons: _codegen_cons,
 }
 
-def codegen_copy(node, *args):
-    return _node_copy_dispatch[node.type](node, *args)
+def codegen(node, bld, mod, lib, ns, tailpos=False):
+    """Compile an expression and return its value. If `tailpos` is true, the
+    expression is in tail position: the generated code returns its value from
+    the current function, calls are compiled as tail calls, and None is
+    returned.
+    """
+    if tailpos and _handles_tailpos(node, ns):
+        return _codegen_cons(node, bld, mod, lib, ns, tailpos=True)
+    value = _node_dispatch[node.type](node, bld, mod, lib, ns)
+    if tailpos:
+        codegen_return(bld, lib, value)
+        return
+    return value
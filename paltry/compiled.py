@@ -0,0 +1,126 @@
+from array import array
+import ctypes as ct
+
+from paltry.convert import to_object, to_python
+from paltry.datatypes import PtType, PtObject, FIXNUM_TAG, fixnum_untag
+from paltry.heap import heap
+from paltry.interpreter import EvalError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Native signature of batch loops, see codegen_batch
+BatchLoop = ct.CFUNCTYPE(
+    ct.c_void_p, ct.c_void_p, ct.c_int64, ct.c_void_p, ct.c_void_p, ct.POINTER(ct.c_int64),
+)
+
+_ctypes = {PtType.integer: ct.c_int64, PtType.double: ct.c_double}
+_typecodes = {PtType.integer: 'q', PtType.double: 'd'}
+_dtypes = {int: PtType.integer, float: PtType.double}
+
+
+def _element_type(values):
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return PtType.integer
+    return PtType.double
+
+
+def entry_type(types):
+    """The native signature of entry points, see codegen_entry."""
+    return ct.CFUNCTYPE(ct.c_void_p, ct.c_void_p, *(_ctypes.get(type_, ct.c_void_p) for type_ in types))
+
+
+def _argument_type(value):
+    # Numbers are passed as native values, and boxed by the entry point
+    if type(value) is int and -1 << 63 <= value < 1 << 63:
+        return PtType.integer
+    if type(value) is float:
+        return PtType.double
+    return None
+
+
+class CompiledFunction:
+    """A Paltry function compiled once and called from Python.
+
+    Calling it converts the arguments with `to_object` and the result with
+    `to_python`. The `map` method calls it for many inputs in a single native
+    loop, without going through Python for each call.
+    """
+
+    def __init__(self, vm, function, params):
+        self.vm = vm
+        self.function = function
+        self.params = tuple(params)
+        self._address = ct.addressof(function)
+
+    def __repr__(self):
+        return '<CompiledFunction ({})>'.format(' '.join(self.params))
+
+    def __call__(self, *args):
+        if len(args) != len(self.params):
+            raise TypeError('Expected {} arguments, got {}'.format(len(self.params), len(args)))
+        types = tuple(_argument_type(arg) for arg in args)
+        objects = [
+            arg if type_ is not None else heap.box(to_object(arg))
+            for arg, type_ in zip(args, types)
+        ]
+        values = [
+            arg if type_ is not None else ct.addressof(arg)
+            for arg, type_ in zip(objects, types)
+        ]
+        address = self.vm.entry_point(types)(self._address, *values)
+        if not address:
+            raise EvalError('Evaluation failed')
+        if address & FIXNUM_TAG:
+            return fixnum_untag(address)
+        return to_python(PtObject.from_address(address))
+
+    def map(self, inputs, dtype=float):
+        """Call the function for each row of inputs and return the results. With
+        one parameter, the inputs are a sequence of numbers, otherwise a sequence
+        of rows with one number per parameter. The results must be numbers, and
+        are converted to `dtype`, which is int or float.
+
+        NumPy arrays are used in place and give a NumPy array of results. Other
+        sequences are copied, and give a list.
+        """
+        nparams = len(self.params)
+        out_type = _dtypes[dtype]
+
+        if numpy is not None and isinstance(inputs, numpy.ndarray):
+            integral = inputs.dtype.kind in 'iub'
+            in_type = PtType.integer if integral else PtType.double
+            data = numpy.ascontiguousarray(inputs, dtype=_ctypes[in_type])
+            if nparams == 1 and data.ndim == 2 and data.shape[1] == 1:
+                data = data.reshape(-1)
+            if data.shape[1:] != ((nparams,) if nparams != 1 else ()):
+                raise ValueError('Expected rows of {} numbers, got shape {}'.format(nparams, data.shape))
+            count = data.shape[0]
+            output = numpy.empty(count, dtype=_ctypes[out_type])
+            self._run(in_type, out_type, count, data.ctypes.data, output.ctypes.data)
+            return output
+
+        rows = list(inputs)
+        if nparams == 1:
+            flat = rows
+        else:
+            flat = []
+            for row in rows:
+                row = list(row)
+                if len(row) != nparams:
+                    raise ValueError('Expected rows of {} numbers, got {}'.format(nparams, len(row)))
+                flat.extend(row)
+        in_type = _element_type(flat)
+        data = array(_typecodes[in_type], flat)
+        output = array(_typecodes[out_type], bytes(8 * len(rows)))
+        self._run(in_type, out_type, len(rows), data.buffer_info()[0], output.buffer_info()[0])
+        return output.tolist()
+
+    def _run(self, in_type, out_type, count, inputs, outputs):
+        loop = self.vm.batch_loop(len(self.params), in_type, out_type)
+        progress = ct.c_int64(0)
+        if not loop(ct.addressof(self.function), count, inputs, outputs, ct.byref(progress)):
+            raise EvalError('Evaluation failed for input {}'.format(progress.value))
@@ -0,0 +1,65 @@
+from array import array
+import ctypes as ct
+
+from paltry.datatypes import PtType, PtObject
+
+
+# Native signatures of the list conversion functions, see codegen_fill and
+# codegen_unpack
+FillList = ct.CFUNCTYPE(ct.c_void_p, ct.c_void_p, ct.c_void_p, ct.c_int64)
+UnpackList = ct.CFUNCTYPE(ct.c_int64, ct.c_void_p, ct.c_void_p, ct.c_int64)
+
+
+def to_object(value):
+    """Convert a Python value to a Paltry object. Integers, floats and strings
+    become numbers and strings, True becomes t, and False and None become nil.
+    Paltry objects are returned unchanged.
+    """
+    if isinstance(value, PtObject):
+        return value
+    if value is True:
+        return PtObject.intern('t')
+    if value is False or value is None:
+        return PtObject.nil
+    if isinstance(value, (int, float, str)):
+        return PtObject(value)
+    raise TypeError('Cannot convert to a Paltry object: {}'.format(type(value)))
+
+
+def to_python(obj):
+    """Convert a Paltry object to a Python value. The reverse of `to_object`:
+    numbers and strings become Python numbers and strings, nil becomes None and
+    t becomes True. Other objects are returned unchanged.
+    """
+    if obj.type == PtType.integer:
+        return obj.contents.integer
+    if obj.type == PtType.double:
+        return obj.contents.double
+    if obj.type == PtType.bytestring:
+        return obj.contents.bytestring.decode('utf-8')
+    if ct.addressof(obj) == ct.addressof(PtObject.nil):
+        return None
+    if ct.addressof(obj) == ct.addressof(PtObject.intern('t')):
+        return True
+    return obj
+
+
+def number_array(values):
+    """Return a sequence of numbers of a single type as an array of int64 or
+    float64 values, or None for other sequences. NumPy arrays are accepted.
+    """
+    if isinstance(values, array) and values.typecode in 'qd':
+        return values
+    dtype = getattr(values, 'dtype', None)
+    if dtype is not None:
+        if dtype.kind in 'iu':
+            return array('q', values.astype('int64').tobytes())
+        if dtype.kind == 'f':
+            return array('d', values.astype('float64').tobytes())
+        return None
+    types = set(map(type, values))
+    if types == {int}:
+        return array('q', values)
+    if types == {float}:
+        return array('d', values)
+    return None
@@ -15,6 +15,29 @@ class PtType(enum.IntEnum):
     cons = enum.auto()
     function = enum.auto()
 
+# Pointers to PtObjects with the lowest bit set are not pointers at all, but
+# tagged fixnums: small integers stored in the remaining bits.
+FIXNUM_TAG = 1
+FIXNUM_BITS = 63
+
+
+def is_fixnum(value):
+    """Checks whether an integer fits in a tagged fixnum."""
+    return -(1 << (FIXNUM_BITS - 1)) <= value < (1 << (FIXNUM_BITS - 1))
+
+
+def fixnum_tag(value):
+    """Converts an integer to a tagged fixnum, as a signed 64-bit value."""
+    assert is_fixnum(value)
+    return (value << 1) | FIXNUM_TAG
+
+
+def fixnum_untag(address):
+    """Converts a tagged fixnum, as an unsigned 64-bit address, to an integer."""
+    if address >= 1 << 63:
+        address -= 1 << 64
+    return address >> 1
+
 # Since many of the fields of these types are self-referential, we set the
 # fields after declaring the classes.
 
@@ -22,6 +45,11 @@ class PtCons(ct.Structure):
     """A PtCons is a pair with two pointers to PtObjects: the car and the cdr."""
     pass
 
+class PtClosure(ct.Structure):
+    """A function pointer together with its environment: a list of the values
+    captured by the function."""
+    pass
+
 class PtContents(ct.Union):
     """A union covering all the possible fundamental data types. Corresponds to the
     PtType enum.
@@ -31,11 +59,13 @@ class PtContents(ct.Union):
         super(PtContents, self).__init__()
         if kwargs:
             key, value = next(iter(kwargs.items()))
-            assert key in {'integer', 'double', 'symbol', 'bytestring', 'cons', 'function'}
+            assert key in {'integer', 'double', 'symbol', 'bytestring', 'cons', 'function', 'closure'}
             setattr(self, key, value)
 
 class PtSymbol(ct.Structure):
-    """A symbol is a pair of a name and a binding."""
+    """A symbol is a pair of a name and a binding. Symbol objects refer to it by
+    pointer, so that it does not make every object larger.
+    """
 
     def __init__(self, name, ident, binding=None):
         buffer = name.encode('utf-8')
@@ -53,15 +83,106 @@ class PtSymbol(ct.Structure):
         return self.ident == other.ident
 
 
+class PtSymbolEntry(ct.Structure):
+    """A slot in the symbol table: the hash of a name, the name and the interned
+    symbol, or a null symbol if the slot is empty.
+    """
+    pass
+
+class PtSymbolTable(ct.Structure):
+    """The table of interned symbols, in native memory so that compiled code can
+    look up symbols by name. Collisions are resolved by linear probing, and
+    the number of slots is a power of two. Native code calls `create` with a
+    name that is not in the table, and gets back the newly interned symbol.
+    """
+    pass
+
+PtSymbolCreate = ct.CFUNCTYPE(ct.c_void_p, ct.c_char_p)
+
+
+# 64-bit FNV-1a, also computed by native code
+FNV_OFFSET = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+
+
+def symbol_hash(name):
+    """Hash a symbol name, as UTF-8 encoded bytes."""
+    h = FNV_OFFSET
+    for byte in name:
+        h = ((h ^ byte) * FNV_PRIME) & 0xffffffffffffffff
+    return h
+
+
+class SymbolTable:
+    """Maintains a PtSymbolTable. Symbols are only ever added, and the table is
+    grown when it is half full.
+    """
+
+    def __init__(self, capacity=256):
+        self.state = PtSymbolTable(None, 0, 0, None)
+        self._entries = None
+
+        # The names referred to by the entries, and what they were inserted with
+        self._names = []
+        self._items = []
+        self._resize(capacity)
+
+    def _resize(self, capacity):
+        self._entries = (PtSymbolEntry * capacity)()
+        self.state.entries = self._entries
+        self.state.mask = capacity - 1
+        self.state.count = 0
+        for item in self._items:
+            self._place(*item)
+
+    def _place(self, h, name, obj):
+        entries, mask = self._entries, self.state.mask
+        index = h & mask
+        while entries[index].value:
+            index = (index + 1) & mask
+        entries[index] = PtSymbolEntry(h, name, obj)
+        self.state.count += 1
+
+    def insert(self, name, obj):
+        """Add a symbol under a name, given as bytes. The name must not be in the
+        table already.
+        """
+        if 2 * (self.state.count + 1) > self.state.mask + 1:
+            self._resize(2 * (self.state.mask + 1))
+        self._names.append(name)
+        item = (symbol_hash(name), ct.cast(ct.c_char_p(name), ct.c_void_p).value, ct.pointer(obj))
+        self._items.append(item)
+        self._place(*item)
+
+    def lookup(self, name):
+        """Return the address of the symbol with the given name, as bytes, or
+        None if it is not interned.
+        """
+        h = symbol_hash(name)
+        entries, mask = self._entries, self.state.mask
+        index = h & mask
+        while entries[index].value:
+            entry = entries[index]
+            if entry.hash == h and ct.string_at(entry.name) == name:
+                return ct.cast(entry.value, ct.c_void_p).value
+            index = (index + 1) & mask
+        return None
+
+
 class PtObject(ct.Structure):
     """The primary structure representing a lisp object. It has a type field (see
     the PtType enum) and a contents field (see the PtContents union).
     """
 
-    # Table of interned symbols
+    # Interned symbols by name. Also kept in native memory, see SymbolTable.
     __intern = {}
+    symbol_table = None
     __symbol_id = 0
 
+    # Typed callbacks, by name and by the address of their generic entry
+    __typed = {}
+    __typed_entries = {}
+
     def __init__(self, *args):
         """Create a lisp object from one of the fundamental data types (integers,
         floats or strings).
@@ -90,7 +211,8 @@ class PtObject(ct.Structure):
     @staticmethod
     def symbol(name):
         """Creates an uninterned symbol with the given name."""
-        obj = PtObject(PtType.symbol, PtContents(symbol=PtSymbol(name, PtObject.__symbol_id)))
+        record = PtSymbol(name, PtObject.__symbol_id)
+        obj = PtObject(PtType.symbol, PtContents(symbol=ct.pointer(record)))
         PtObject.__symbol_id += 1
         return obj
 
@@ -102,8 +224,22 @@ class PtObject(ct.Structure):
         except KeyError:
             symbol = PtObject.symbol(name)
             PtObject.__intern[name] = symbol
+            PtObject.symbol_table.insert(name.encode('utf-8'), symbol)
             return symbol
 
+    @staticmethod
+    def deref(ptr):
+        """Dereferences a pointer to a PtObject. Tagged fixnums are boxed."""
+        address = ct.c_void_p.from_buffer(ptr).value or 0
+        if address & FIXNUM_TAG:
+            return PtObject(fixnum_untag(address))
+        return ptr.contents
+
+    @staticmethod
+    def interned():
+        """Returns a list of all interned symbols."""
+        return list(PtObject.__intern.values())
+
     @staticmethod
     def cons(car, cdr):
         """Creates a cons cell from two objects."""
@@ -131,13 +267,17 @@ class PtObject(ct.Structure):
     @staticmethod
     def initialize():
         """Initializes the interned symbol table."""
+        table = PtObject.symbol_table = SymbolTable()
+        table.create = PtSymbolCreate(_create_symbol)
+        table.state.create = ct.cast(table.create, ct.c_void_p)
 
         # nil
         nil = PtObject(PtType.cons, PtContents(cons=PtCons(None, None)))
+        table.insert(b'nil', nil)
 
         # t
         t = PtObject.intern('t')
-        t.contents.symbol.binding = ct.pointer(t)
+        t.contents.symbol.contents.binding = ct.pointer(t)
 
         PtObject.__intern.update({
             'nil': nil,
@@ -147,16 +287,29 @@ class PtObject(ct.Structure):
         PtObject.nil = nil
 
     @staticmethod
-    def callback(name=None):
+    def callback(name=None, params=None, result=None):
         """Create a Paltry function accessible under the symbol `name`
         which, when called, assembles the arguments and calls the backing
         Python callable.
+
+        If `params` is given, the callback is typed: it is a sequence of int,
+        float or str, and the Python callable receives plain Python values
+        instead of PtObjects. Its return value is converted according to
+        `result`, which is int, float, str, or None for nil. See
+        TypedCallback.
         """
         def decorator(py_function):
             in_name = name or py_function.__name__.replace('_', '-')
             sym = PtObject.intern(in_name)
+            if params is not None:
+                callback = TypedCallback(in_name, py_function, params, result)
+                PtObject.__typed[in_name] = callback
+                PtObject.__typed_entries[callback.function.contents.function] = callback
+                sym.contents.symbol.contents.binding = ct.pointer(callback.function)
+                py_function.callback = callback
+                return py_function
             def llvm_callable(nargs, ptr):
-                arglist = [ptr[i].contents for i in range(nargs)]
+                arglist = [PtObject.deref(ptr[i]) for i in range(nargs)]
                 try:
                     retval = py_function(*arglist)
                     return ct.addressof(retval)
@@ -166,10 +319,23 @@ class PtObject(ct.Structure):
             py_function.callback = callback
             py_function.llvm_callable = llvm_callable
             func_obj = PtObject(PtType.function, PtContents(function=callback))
-            sym.contents.symbol.binding = ct.pointer(func_obj)
+            py_function.function = func_obj
+            sym.contents.symbol.contents.binding = ct.pointer(func_obj)
             return py_function
         return decorator
 
+    @staticmethod
+    def typed_callback(name):
+        """Returns the typed callback registered under a name, or None."""
+        return PtObject.__typed.get(name)
+
+    @staticmethod
+    def typed_callback_at(address):
+        """Returns the typed callback whose function object points to the given
+        native function, or None.
+        """
+        return PtObject.__typed_entries.get(address)
+
     def __bool__(self):
         """All PtObjects except nil are truthy."""
         if self.type != PtType.cons:
@@ -179,25 +345,27 @@ class PtObject(ct.Structure):
         return False
 
     def __iter__(self):
-        assert self.type == PtType.cons
-        if not bool(self):
-            return
-        yield self.car
-        yield from self.cdr
+        node = self
+        while True:
+            assert node.type == PtType.cons
+            if not bool(node):
+                return
+            yield node.car
+            node = node.cdr
 
     @property
     def car(self):
         """Accesses the car of a cons cell."""
         assert self.type == PtType.cons
         assert bool(self)
-        return self.contents.cons.car.contents
+        return PtObject.deref(self.contents.cons.car)
 
     @property
     def cdr(self):
         """Accesses the cdr of a cons cell."""
         assert self.type == PtType.cons
         assert bool(self)
-        return self.contents.cons.cdr.contents
+        return PtObject.deref(self.contents.cons.cdr)
 
     @property
     def string(self):
@@ -211,7 +379,7 @@ class PtObject(ct.Structure):
         elif self.type == PtType.double:
             return str(self.contents.double)
         elif self.type == PtType.symbol:
-            return self.contents.symbol.name.decode('utf-8')
+            return self.contents.symbol.contents.name.decode('utf-8')
         elif self.type == PtType.bytestring:
             return '"{}"'.format(self.string.replace('"', '\\"'))
         elif self.type == PtType.function:
@@ -247,33 +415,141 @@ class PtObject(ct.Structure):
         elif self.type == PtType.function:
             return self.contents.function == other.contents.function
         elif self.type == PtType.symbol:
-            return self.contents.symbol.ident == other.contents.symbol.ident
+            return self.contents.symbol.contents.ident == other.contents.symbol.contents.ident
         elif self.type == PtType.cons:
             if not bool(self) and not bool(other):
                 return True
             return self.car == other.car and self.cdr == other.cdr
 
 
+def _create_symbol(name):
+    try:
+        return ct.addressof(PtObject.intern(name.decode('utf-8')))
+    except:
+        return 0
+
+
 PtFunction = ct.CFUNCTYPE(ct.c_void_p, ct.c_int32, ct.POINTER(ct.POINTER(PtObject)))
 
+
+# Native types of the parameters and results of typed callbacks. Other results
+# are returned as object pointers.
+_native_types = {int: ct.c_int64, float: ct.c_double, str: ct.c_char_p}
+
+# Set by the native entry of a typed callback with a numeric result when it
+# fails, since there is no value to signal that. The caller clears it.
+callback_error = ct.c_int32(0)
+
+
+class TypedCallback:
+    """A Python function callable from Paltry with declared parameter and result
+    types, each of which is int, float or str, and None for a nil result.
+
+    The function object bound to the symbol goes through the generic calling
+    convention, converting PtObjects to Python values and back. Compiled
+    code calling the symbol instead passes unboxed values to `native`, a
+    function taking int64, double and char pointer arguments and returning
+    an int64 or double, or an object pointer for other result types.
+    Integers are also accepted for float arguments.
+    """
+
+    def __init__(self, name, py_function, params, result):
+        params = tuple(params)
+        assert all(param in _native_types for param in params)
+        assert result in (int, float, str, None)
+        self.name = name
+        self.py_function = py_function
+        self.params = params
+        self.result = result
+
+        restype = _native_types[result] if result in (int, float) else ct.c_void_p
+        self.native = ct.CFUNCTYPE(restype, *(_native_types[param] for param in params))(self._native)
+        self.generic = PtFunction(self._generic)
+        self.function = PtObject(PtType.function, PtContents(
+            function=ct.cast(self.generic, ct.c_void_p),
+        ))
+
+    def __call__(self, *args):
+        """Call the function with PtObject arguments, returning a PtObject."""
+        if len(args) != len(self.params):
+            raise TypeError('{} takes {} arguments'.format(self.name, len(self.params)))
+        return self._to_object(self.py_function(*(
+            self._from_object(arg, param) for arg, param in zip(args, self.params)
+        )))
+
+    @staticmethod
+    def _from_object(obj, type_):
+        if type_ is int and obj.type == PtType.integer:
+            return obj.contents.integer
+        if type_ is float and obj.type == PtType.double:
+            return obj.contents.double
+        if type_ is float and obj.type == PtType.integer:
+            return float(obj.contents.integer)
+        if type_ is str and obj.type == PtType.bytestring:
+            return obj.contents.bytestring.decode('utf-8')
+        raise TypeError('Expected {}: {}'.format(type_.__name__, obj))
+
+    def _to_object(self, value):
+        from paltry.heap import heap
+        if self.result is None:
+            return PtObject.nil
+        return heap.box(PtObject(self.result(value)))
+
+    def _generic(self, nargs, ptr):
+        try:
+            args = [PtObject.deref(ptr[i]) for i in range(nargs)]
+            return ct.addressof(self(*args))
+        except:
+            return 0
+
+    def _native(self, *args):
+        try:
+            value = self.py_function(*(
+                arg.decode('utf-8') if param is str else arg
+                for arg, param in zip(args, self.params)
+            ))
+            if self.result in (int, float):
+                return self.result(value)
+            return ct.addressof(self._to_object(value))
+        except:
+            if self.result in (int, float):
+                callback_error.value = 1
+            return 0
+
 # Initialize the structure fields
 PtCons._fields_ = [
     ('car', ct.POINTER(PtObject)),
     ('cdr', ct.POINTER(PtObject)),
 ]
+PtClosure._fields_ = [
+    ('function', ct.c_void_p),
+    ('env', ct.POINTER(PtObject)),
+]
 PtSymbol._fields_ = [
     ('name', ct.c_char_p),
     ('ident', ct.c_int64),
     ('binding', ct.POINTER(PtObject)),
 ]
+PtSymbolEntry._fields_ = [
+    ('hash', ct.c_uint64),
+    ('name', ct.c_void_p),
+    ('value', ct.POINTER(PtObject)),
+]
+PtSymbolTable._fields_ = [
+    ('entries', ct.POINTER(PtSymbolEntry)),
+    ('mask', ct.c_size_t),
+    ('count', ct.c_size_t),
+    ('create', ct.c_void_p),
+]
 PtContents._fields_ = [
     ('pointer', ct.c_void_p),
     ('integer', ct.c_longlong),
     ('double', ct.c_double),
     ('bytestring', ct.c_char_p),
-    ('symbol', PtSymbol),
+    ('symbol', ct.POINTER(PtSymbol)),
     ('cons', PtCons),
     ('function', ct.c_void_p),
+    ('closure', PtClosure),
 ]
 PtObject._fields_ = [
     ('type', ct.c_int32),
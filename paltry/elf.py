@@ -0,0 +1,109 @@
+"""Just enough of the ELF64 format to find the symbols and dynamic relocations
+of the object files and shared libraries produced by LLVM.
+"""
+
+import struct
+
+
+# File types
+ET_REL = 1
+
+# Section types
+SHT_SYMTAB = 2
+SHT_RELA = 4
+SHT_DYNSYM = 11
+
+# Symbol types
+STT_FUNC = 2
+
+# Machines, and the relocation types storing the absolute address of a symbol
+_ABSOLUTE_RELOCATIONS = {
+    62: {1, 6, 7},              # x86-64: R_X86_64_64, GLOB_DAT, JUMP_SLOT
+    183: {257, 1025, 1026},     # AArch64: R_AARCH64_ABS64, GLOB_DAT, JUMP_SLOT
+}
+
+
+def is_elf(data):
+    """Check whether data is a little-endian ELF64 file."""
+    return data[:4] == b'\x7fELF' and data[4] == 2 and data[5] == 1
+
+
+def is_relocatable(data):
+    """Check whether an ELF file is a relocatable object file."""
+    return struct.unpack_from('<H', data, 0x10)[0] == ET_REL
+
+
+def _sections(data):
+    shoff, = struct.unpack_from('<Q', data, 0x28)
+    shentsize, shnum = struct.unpack_from('<HH', data, 0x3a)
+    return [
+        struct.unpack_from('<IIQQQQIIQQ', data, shoff + i * shentsize)
+        for i in range(shnum)
+    ]
+
+
+def _symbol_table(data, sections, index):
+    _, _, _, _, offset, size, link, _, _, entsize = sections[index]
+    strtab = sections[link][4]
+    ret = []
+    for pos in range(offset, offset + size, entsize):
+        name, info, _, shndx, value, size_ = struct.unpack_from('<IBBHQQ', data, pos)
+        end = data.index(b'\0', strtab + name)
+        ret.append((data[strtab + name:end].decode('utf-8'), info, shndx, value, size_))
+    return ret
+
+
+def symbols(data, section_type=SHT_SYMTAB):
+    """Return the symbols of an ELF64 file as (name, info, section index, value,
+    size) tuples, from the static or the dynamic symbol table. Returns an
+    empty list for other formats.
+    """
+    if not is_elf(data):
+        return []
+    sections = _sections(data)
+    ret = []
+    for index, section in enumerate(sections):
+        if section[1] == section_type:
+            ret.extend(_symbol_table(data, sections, index))
+    return ret
+
+
+def function_symbols(data):
+    """Return the functions defined in an ELF64 file, as a dict mapping names to
+    sizes in bytes.
+    """
+    return {
+        name: size for name, info, shndx, _, size in symbols(data)
+        if info & 0xf == STT_FUNC and shndx != 0
+    }
+
+
+def undefined_symbols(data, section_type=SHT_SYMTAB):
+    """Return the names of the symbols an ELF64 file refers to but does not
+    define.
+    """
+    return [name for name, _, shndx, _, _ in symbols(data, section_type) if name and shndx == 0]
+
+
+def import_relocations(data):
+    """Return the dynamic relocations of a shared library that store the address
+    of an undefined symbol plus an addend, as (offset, symbol name, addend)
+    tuples. Raises ValueError for unsupported machines.
+    """
+    machine, = struct.unpack_from('<H', data, 0x12)
+    if machine not in _ABSOLUTE_RELOCATIONS:
+        raise ValueError('Unsupported machine: {}'.format(machine))
+    types = _ABSOLUTE_RELOCATIONS[machine]
+
+    sections = _sections(data)
+    ret = []
+    for _, type_, _, _, offset, size, link, _, _, entsize in sections:
+        if type_ != SHT_RELA or sections[link][1] != SHT_DYNSYM:
+            continue
+        table = _symbol_table(data, sections, link)
+        for pos in range(offset, offset + size, entsize):
+            r_offset, r_info, r_addend = struct.unpack_from('<QQq', data, pos)
+            name, _, shndx, _, _ = table[r_info >> 32]
+            if r_info & 0xffffffff in types and r_info >> 32 and shndx == 0:
+                ret.append((r_offset, name, r_addend))
+    return ret
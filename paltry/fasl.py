@@ -0,0 +1,254 @@
+"""A binary format for forms that have already been read, so that large bundles
+of code or data can be loaded without tokenizing them again. Files made by
+`dump` are conventionally named .pfasl, and are read transparently by
+read_file.
+
+Trees are stored in postfix order as a sequence of one-byte operations: atoms
+are pushed on a stack, and list operations pop their elements off it. The
+operands are kept in separate arrays by type, so that they are decoded in
+bulk instead of one at a time. Symbols are stored by index into a table of
+names, and are interned when loaded.
+"""
+
+from array import array
+import ctypes as ct
+import struct
+
+from paltry.datatypes import PtType, PtObject
+
+
+MAGIC = b'PFASL\0\r\n'
+FASL_VERSION = 1
+
+# Magic and version, then the number of forms, cons cells, operations, list
+# lengths and symbol indices, integers, doubles and strings, the total length
+# of the strings, and the number and total length of symbol names
+_HEADER = struct.Struct('<8sI10Q')
+
+# Operations
+_END, _NIL, _INTEGER, _DOUBLE, _STRING, _SYMBOL, _LIST, _DOTTED = range(8)
+
+
+def is_fasl(data):
+    """Check whether some data starts like a FASL file."""
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+class _Writer:
+
+    def __init__(self):
+        self.ops = bytearray()
+        self.args = array('I')
+        self.integers = array('q')
+        self.doubles = array('d')
+        self.strings = []
+        self.symbols = {}
+        self.forms = 0
+        self.conses = 0
+
+    def add(self, form):
+        ops, args = self.ops, self.args
+
+        # Objects to write, or operations to emit after the elements of a list
+        # have been written, as ints
+        stack = [form]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, int):
+                args.append(obj >> 1)
+                ops.append(_DOTTED if obj & 1 else _LIST)
+            elif obj.type == PtType.cons:
+                if not bool(obj):
+                    ops.append(_NIL)
+                    continue
+                elements = []
+                while obj.type == PtType.cons and bool(obj):
+                    elements.append(obj.car)
+                    obj = obj.cdr
+                dotted = bool(obj)
+                self.conses += len(elements)
+                stack.append(len(elements) << 1 | dotted)
+                if dotted:
+                    stack.append(obj)
+                stack.extend(reversed(elements))
+            elif obj.type == PtType.integer:
+                self.integers.append(obj.contents.integer)
+                ops.append(_INTEGER)
+            elif obj.type == PtType.double:
+                self.doubles.append(obj.contents.double)
+                ops.append(_DOUBLE)
+            elif obj.type == PtType.bytestring:
+                self.strings.append(obj.contents.bytestring)
+                ops.append(_STRING)
+            elif obj.type == PtType.symbol:
+                name = str(obj)
+                if ct.addressof(PtObject.intern(name)) != ct.addressof(obj):
+                    raise ValueError('Can not write an uninterned symbol: {}'.format(name))
+                args.append(self.symbols.setdefault(name, len(self.symbols)))
+                ops.append(_SYMBOL)
+            else:
+                raise ValueError('Can not write object: {}'.format(obj))
+        ops.append(_END)
+        self.forms += 1
+
+    def dumps(self):
+        names = [name.encode('utf-8') for name in self.symbols]
+        string_lengths = array('I', map(len, self.strings))
+        symbol_lengths = array('I', map(len, names))
+        header = _HEADER.pack(
+            MAGIC, FASL_VERSION, self.forms, self.conses, len(self.ops), len(self.args),
+            len(self.integers), len(self.doubles), len(self.strings),
+            sum(string_lengths), len(names), sum(symbol_lengths),
+        )
+        return b''.join([
+            header, self.integers.tobytes(), self.doubles.tobytes(), self.args.tobytes(),
+            string_lengths.tobytes(), symbol_lengths.tobytes(), bytes(self.ops),
+            b''.join(self.strings), b''.join(names),
+        ])
+
+
+def dumps(forms):
+    """Serialize a sequence of forms to bytes. Forms may contain integers,
+    doubles, strings, interned symbols and cons cells.
+    """
+    writer = _Writer()
+    for form in forms:
+        writer.add(form)
+    return writer.dumps()
+
+
+def dump(forms, filename):
+    """Write a sequence of forms to a file."""
+    data = dumps(forms)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+def _split(blob, lengths):
+    ret, offset = [], 0
+    for length in lengths:
+        ret.append(blob[offset:offset + length])
+        offset += length
+    return ret
+
+
+def load(data):
+    """Generate the forms in FASL data, such as bytes or an mmap.
+
+    All objects are created at once in a single block of memory owned by
+    Python, which stays alive as long as any of the forms do. Building them
+    one at a time with PtObject.cons is much slower, as ctypes keeps track of
+    the objects each pointer refers to.
+    """
+    if len(data) < _HEADER.size or not is_fasl(data):
+        raise ValueError('Not a FASL file')
+    (_, version, nforms, nconses, nops, nargs, nintegers, ndoubles,
+     nstrings, string_size, nsymbols, symbol_size) = _HEADER.unpack_from(data)
+    if version != FASL_VERSION:
+        raise ValueError('Unsupported FASL version: {}'.format(version))
+
+    offset = _HEADER.size
+    def section(typecode, count):
+        nonlocal offset
+        ret = array(typecode)
+        end = offset + count * ret.itemsize
+        ret.frombytes(data[offset:end])
+        offset = end
+        return ret
+
+    integers = section('q', nintegers)
+    doubles = section('d', ndoubles)
+    args = section('I', nargs)
+    string_lengths = section('I', nstrings)
+    symbol_lengths = section('I', nsymbols)
+    ops = data[offset:offset + nops]
+    offset += nops
+    strings = _split(data[offset:offset + string_size], string_lengths)
+    offset += string_size
+    names = _split(data[offset:offset + symbol_size], symbol_lengths)
+    if offset + symbol_size != len(data) or len(ops) != nops:
+        raise ValueError('Truncated or corrupt FASL file')
+
+    # The block holds the integers, doubles, strings and cons cells, in that
+    # order. Its fields are written through views as 32 and 64-bit words.
+    ncells = nintegers + ndoubles + nstrings + nconses
+    block = (PtObject * max(ncells, 1))()
+    size = ct.sizeof(PtObject)
+    base = ct.addressof(block)
+    raw = memoryview(block).cast('B')
+    types, words, signed, floats = raw.cast('i'), raw.cast('Q'), raw.cast('q'), raw.cast('d')
+    stride = size // words.itemsize
+    type_stride = size // types.itemsize
+
+    def set_types(first, count, type_):
+        types[first * type_stride:(first + count) * type_stride:type_stride] = array('i', [type_]) * count
+
+    # Strings are copied into a single NUL terminated buffer
+    buffer = ct.create_string_buffer(b'\0'.join(strings))
+    block.buffer = buffer
+    pointers, position = array('Q'), ct.addressof(buffer)
+    for string in strings:
+        pointers.append(position)
+        position += len(string) + 1
+
+    first_string = nintegers + ndoubles
+    set_types(0, nintegers, PtType.integer)
+    signed[1:nintegers * stride:stride] = integers
+    set_types(nintegers, ndoubles, PtType.double)
+    floats[nintegers * stride + 1:first_string * stride:stride] = doubles
+    set_types(first_string, nstrings, PtType.bytestring)
+    words[first_string * stride + 1:(first_string + nstrings) * stride:stride] = pointers
+    set_types(first_string + nstrings, nconses, PtType.cons)
+
+    # Objects outside the block that forms may consist of, by address
+    outside = {ct.addressof(PtObject.nil): PtObject.nil}
+    symbols = []
+    for name in names:
+        sym = PtObject.intern(name.decode('utf-8'))
+        symbols.append(ct.addressof(sym))
+        outside[symbols[-1]] = sym
+
+    # The stack holds addresses, and atoms are taken from the block in order
+    nil = ct.addressof(PtObject.nil)
+    integer, double, string = base, base + nintegers * size, base + first_string * size
+    cons = base + (first_string + nstrings) * size
+    args = iter(args)
+
+    stack = []
+    push = stack.append
+    for op in ops:
+        if op == _SYMBOL:
+            push(symbols[next(args)])
+        elif op == _LIST or op == _DOTTED:
+            count = next(args)
+            if op == _LIST:
+                tail = nil
+            else:
+                tail = stack.pop()
+            split = len(stack) - count
+            first = (cons - base) // size
+            words[first * stride + 1:(first + count) * stride:stride] = array('Q', stack[split:])
+            cdrs = array('Q', range(cons + size, cons + count * size, size))
+            cdrs.append(tail)
+            words[first * stride + 2:(first + count) * stride:stride] = cdrs
+            del stack[split:]
+            push(cons)
+            cons += count * size
+        elif op == _INTEGER:
+            push(integer)
+            integer += size
+        elif op == _DOUBLE:
+            push(double)
+            double += size
+        elif op == _STRING:
+            push(string)
+            string += size
+        elif op == _NIL:
+            push(nil)
+        else:
+            address, = stack
+            stack.clear()
+            if address in outside:
+                yield outside[address]
+            else:
+                yield block[(address - base) // size]
@@ -0,0 +1,365 @@
+from bisect import bisect_right, insort
+import ctypes as ct
+import gc
+import mmap
+import re
+from time import perf_counter
+
+from paltry.datatypes import (
+    PtType, PtObject, PtContents, PtCons, PtSymbol, PtClosure, FIXNUM_TAG,
+)
+
+
+# Size of a freshly mapped arena
+ARENA_SIZE = 1 << 20
+
+# All allocations are rounded up to this alignment
+ALIGNMENT = 8
+
+# Number of bytes allocated between collections
+GC_THRESHOLD = 64 << 20
+
+# Number of slots on the root stack
+ROOT_STACK_SIZE = 1 << 20
+
+
+class PtHeap(ct.Structure):
+    """The allocation pointer and limit of the current free run, and the top of
+    the root stack. JIT code bumps the allocation pointer inline and only calls
+    the refill callback when the run is exhausted.
+    """
+    _fields_ = [
+        ('ptr', ct.c_size_t),
+        ('end', ct.c_size_t),
+        ('top', ct.c_size_t),
+    ]
+
+
+PtRefill = ct.CFUNCTYPE(ct.c_void_p, ct.c_size_t)
+
+
+def _align(size):
+    return (size + ALIGNMENT - 1) & ~(ALIGNMENT - 1)
+
+
+# Offsets of the pointer fields traced by the collector
+_CAR = PtObject.contents.offset + PtContents.cons.offset + PtCons.car.offset
+_CDR = PtObject.contents.offset + PtContents.cons.offset + PtCons.cdr.offset
+_SYMBOL = PtObject.contents.offset + PtContents.symbol.offset
+_BINDING = PtSymbol.binding.offset
+_ENV = PtObject.contents.offset + PtContents.closure.offset + PtClosure.env.offset
+
+
+class GCStats:
+    """Statistics collected by the garbage collector. Times are in seconds."""
+
+    def __init__(self):
+        self.collections = 0
+        self.total_pause = 0.0
+        self.max_pause = 0.0
+        self.last_pause = 0.0
+        self.bytes_freed = 0
+        self.live_bytes = 0
+
+    def record(self, pause, freed, live):
+        self.collections += 1
+        self.total_pause += pause
+        self.max_pause = max(self.max_pause, pause)
+        self.last_pause = pause
+        self.bytes_freed += freed
+        self.live_bytes = live
+
+    def __repr__(self):
+        return (
+            '<GCStats collections={} total_pause={:.3f}s max_pause={:.3f}s '
+            'live_bytes={} bytes_freed={}>'
+        ).format(
+            self.collections, self.total_pause, self.max_pause,
+            self.live_bytes, self.bytes_freed,
+        )
+
+
+class Heap:
+    """A garbage collected heap of fixed size object cells.
+
+    Memory is taken from large anonymous mappings (arenas) and handed out by a
+    bump-pointer allocator running over runs of free cells. Once more than
+    `gc_threshold` bytes have been allocated since the last collection, the
+    next refill runs a non-moving mark-sweep collection, which turns the
+    unreachable cells back into free runs.
+
+    The roots are the bindings of all interned symbols, every PtObject alive on
+    the Python side, and the root stack, on which JIT code pushes every heap
+    object it holds on to.
+
+    Finding the PtObjects alive on the Python side takes a scan of all objects
+    tracked by the Python garbage collector, and marking runs in Python, so the
+    pause of a collection grows with the size of the whole process, not just
+    with the heap. The objects can not be tracked as they are created instead,
+    since ctypes makes the objects it returns for pointer contents, fields
+    and from_address without calling their constructors. Programs holding
+    many Python objects should raise `gc_threshold` accordingly.
+    """
+
+    def __init__(self, arena_size=ARENA_SIZE, gc_threshold=GC_THRESHOLD):
+        self.arena_size = arena_size
+        self.gc_threshold = gc_threshold
+        self.object_size = _align(ct.sizeof(PtObject))
+        self.stats = GCStats()
+        self.state = PtHeap(0, 0, 0)
+        self.arenas = []
+        self.refill = PtRefill(self._refill)
+
+        # Arena start addresses, sorted, and the cell count of each
+        self._starts = []
+        self._cells = {}
+
+        # Python-owned objects referenced by heap cells, by cell address
+        self._pins = {}
+
+        # Free runs of cells, as (start, end) address pairs
+        self._runs = []
+        self._run_start = 0
+        self._retired = 0
+        self._since_gc = 0
+
+        self._root_stack = self._map_root_stack()
+        self.root_base = self.state.top = ct.addressof(ct.c_char.from_buffer(self._root_stack))
+
+    @property
+    def arena_count(self):
+        return len(self.arenas)
+
+    @property
+    def bytes_allocated(self):
+        """Total number of bytes handed out, from JIT code and Python alike."""
+        return self._retired + self.state.ptr - self._run_start
+
+    @property
+    def heap_size(self):
+        return sum(len(arena) for arena in self.arenas)
+
+    def _map_root_stack(self):
+        # The page after the root stack is made inaccessible, so that an overflow
+        # crashes instead of corrupting memory.
+        size = ROOT_STACK_SIZE * ct.sizeof(ct.c_void_p)
+        stack = mmap.mmap(-1, size + mmap.PAGESIZE)
+        guard = ct.addressof(ct.c_char.from_buffer(stack)) + size
+        ct.CDLL(None).mprotect(ct.c_void_p(guard), ct.c_size_t(mmap.PAGESIZE), 0)
+        return stack
+
+    def _refill(self, size):
+        try:
+            self._next_run()
+            ptr = self.state.ptr
+            self.state.ptr = ptr + size
+            return ptr
+        except:
+            return 0
+
+    def _next_run(self):
+        """Point the allocator at the next free run, collecting garbage or mapping
+        a new arena if there are none left.
+        """
+        used = self.state.ptr - self._run_start
+        self._retired += used
+        self._since_gc += used
+        self.state.ptr = self.state.end = self._run_start = 0
+
+        if not self._runs and self.gc_threshold is not None and self._since_gc >= self.gc_threshold:
+            self.collect()
+        if not self._runs:
+            self._map_arena()
+        start, end = self._runs.pop()
+        self.state.ptr = self._run_start = start
+        self.state.end = end
+
+    def _map_arena(self, size=0):
+        size = max(self.arena_size, -(-size // mmap.PAGESIZE) * mmap.PAGESIZE)
+        arena = mmap.mmap(-1, size)
+        start = ct.addressof(ct.c_char.from_buffer(arena))
+        self.arenas.append(arena)
+        insort(self._starts, start)
+        self._cells[start] = size // self.object_size
+        self._runs.append((start, start + self._cells[start] * self.object_size))
+
+    def allocate(self):
+        """Allocate a single object cell and return the address."""
+        size = self.object_size
+        if self.state.ptr + size > self.state.end:
+            self._next_run()
+        ptr = self.state.ptr
+        self.state.ptr = ptr + size
+        return ptr
+
+    def allocate_block(self, count):
+        """Allocate `count` contiguous object cells and return the address of the
+        first. The block is taken from the first free run large enough, or from a
+        new arena, which is larger than usual if need be.
+        """
+        size = count * self.object_size
+        ptr = self.state.ptr
+        if ptr + size <= self.state.end:
+            self.state.ptr = ptr + size
+            return ptr
+
+        if self.gc_threshold is not None and self._since_gc + size >= self.gc_threshold:
+            self.collect()
+        for index, (start, end) in enumerate(self._runs):
+            if end - start >= size:
+                break
+        else:
+            self._map_arena(size)
+            index = len(self._runs) - 1
+            start, end = self._runs[index]
+
+        if end - start > size:
+            self._runs[index] = (start + size, end)
+        else:
+            del self._runs[index]
+        self._retired += size
+        self._since_gc += size
+        return start
+
+    def new(self, type_, contents):
+        """Create an object on the heap from a type and a PtContents union."""
+        obj = PtObject.from_address(self.allocate())
+        obj.type = type_
+        obj.contents = contents
+        return obj
+
+    def cons(self, car, cdr):
+        """Create a cons cell on the heap. If the car or cdr live outside the heap,
+        they are kept alive for as long as the cell is.
+        """
+        obj = self.new(PtType.cons, PtContents(cons=PtCons(ct.pointer(car), ct.pointer(cdr))))
+        pinned = tuple(o for o in (car, cdr) if self._cell(ct.addressof(o)) is None)
+        if pinned:
+            self._pins[ct.addressof(obj)] = pinned
+        return obj
+
+    def box(self, obj):
+        """Return an object that can safely be handed to JIT code. Objects living
+        outside the heap, such as freshly created numbers or parts of a tree
+        made by the reader, are copied into the heap, and the original is kept
+        alive for as long as the copy is. Lists are copied along with their
+        elements, as JIT code may hold on to parts of them.
+
+        Heap objects, symbols and nil are returned unchanged, and so are
+        functions outside the heap, which are defined in Python and never
+        freed, so that they keep their identity.
+        """
+        if obj.type in (PtType.symbol, PtType.function) or not bool(obj):
+            return obj
+        if self._cell(ct.addressof(obj)) is not None:
+            return obj
+        if obj.type == PtType.cons:
+            elements = []
+            while obj.type == PtType.cons and bool(obj) and self._cell(ct.addressof(obj)) is None:
+                elements.append(self.box(obj.car))
+                obj = obj.cdr
+            return self.list(elements, self.box(obj))
+        copy = self.new(obj.type, obj.contents)
+        self._pins[ct.addressof(copy)] = (obj,)
+        return copy
+
+    def attach(self, obj, *values):
+        """Keep Python values alive for as long as a heap object is. They can be
+        retrieved with `attachments`.
+        """
+        self._pins[ct.addressof(obj)] = values
+
+    def attachments(self, obj):
+        """Return the values attached to a heap object, or an empty tuple."""
+        return self._pins.get(ct.addressof(obj), ())
+
+    def list(self, elements, final=None):
+        """Create a list on the heap."""
+        ret = PtObject.nil if final is None else final
+        for element in list(elements)[::-1]:
+            ret = self.cons(element, ret)
+        return ret
+
+    def _roots(self):
+        nslots = (self.state.top - self.root_base) // ct.sizeof(ct.c_void_p)
+        yield from (ct.c_size_t * nslots).from_address(self.root_base)
+        for sym in PtObject.interned():
+            yield ct.addressof(sym)
+        for obj in gc.get_objects():
+            if isinstance(obj, PtObject):
+                yield ct.addressof(obj)
+
+    def _cell(self, addr):
+        """Return the arena start and cell index of an address, or None if it is
+        not in the heap.
+        """
+        index = bisect_right(self._starts, addr) - 1
+        if index < 0:
+            return None
+        start = self._starts[index]
+        cell = (addr - start) // self.object_size
+        if cell < self._cells[start]:
+            return start, cell
+
+    def _mark(self):
+        """Mark all reachable cells. Returns a mark table per arena."""
+        marks = {start: bytearray(ncells) for start, ncells in self._cells.items()}
+        visited = set()
+        stack = list(self._roots())
+        while stack:
+            addr = stack.pop()
+            if not addr or addr & FIXNUM_TAG:
+                continue
+
+            location = self._cell(addr)
+            if location is not None:
+                start, cell = location
+                if marks[start][cell]:
+                    continue
+                marks[start][cell] = 1
+            elif addr in visited:
+                continue
+            else:
+                visited.add(addr)
+
+            type_ = ct.c_int32.from_address(addr).value
+            if type_ == PtType.cons:
+                stack.append(ct.c_size_t.from_address(addr + _CAR).value)
+                stack.append(ct.c_size_t.from_address(addr + _CDR).value)
+            elif type_ == PtType.symbol:
+                record = ct.c_size_t.from_address(addr + _SYMBOL).value
+                stack.append(ct.c_size_t.from_address(record + _BINDING).value)
+            elif type_ == PtType.function:
+                stack.append(ct.c_size_t.from_address(addr + _ENV).value)
+        return marks
+
+    def collect(self):
+        """Run a full collection. The current free run is abandoned."""
+        begin = perf_counter()
+        self._retired += self.state.ptr - self._run_start
+        self.state.ptr = self.state.end = self._run_start = 0
+        self._since_gc = 0
+
+        marks = self._mark()
+        for addr in list(self._pins):
+            start, cell = self._cell(addr)
+            if not marks[start][cell]:
+                del self._pins[addr]
+
+        size = self.object_size
+        runs, live = [], 0
+        for start, table in marks.items():
+            live += sum(table)
+            for match in re.finditer(b'\x00+', table):
+                runs.append((start + match.start() * size, start + match.end() * size))
+
+        # Pop from the lowest addresses first
+        runs.sort(reverse=True)
+        free = sum(end - start for start, end in self._runs)
+        freed = sum(end - start for start, end in runs) - free
+        self._runs = runs
+        self.stats.record(perf_counter() - begin, freed, live * size)
+
+
+# The heap shared by all VMs and runtime functions
+heap = Heap()
@@ -0,0 +1,261 @@
+"""Heap images: snapshots of the global state of a VM, from which a fresh process
+can start without reading or compiling anything, like the core images of
+other Lisps.
+
+An image holds the object files of the modules compiled by a VM, the interned
+symbols, and their bindings together with all the data reachable from them.
+Nothing is loaded at the same address twice, so pointers are stored as
+references: to other objects in the image, to globals defined by the modules,
+such as constants and function objects, or to symbols. Python callbacks are
+not stored. A reference to a function bound to a symbol from Python is
+stored as such, and refers to whatever that symbol is bound to when the image
+is loaded.
+"""
+
+import ctypes as ct
+import mmap
+import pickle
+import struct
+
+from paltry.datatypes import PtType, PtObject, FIXNUM_TAG, fixnum_tag, fixnum_untag
+from paltry.heap import heap
+from paltry.interpreter import is_interpreted
+
+
+MAGIC = b'PALTRYIM'
+IMAGE_VERSION = 1
+
+# Magic, version and length of the pickled metadata, followed by the metadata
+# and the object files of the modules
+_HEADER = struct.Struct('<8sIQ')
+
+
+def _binding(sym):
+    if sym.type != PtType.symbol:
+        return None
+    return ct.cast(sym.contents.symbol.contents.binding, ct.c_void_p).value
+
+
+def _pointer(address):
+    return ct.cast(address, ct.POINTER(PtObject))
+
+
+def _children(obj):
+    """Return the addresses of the objects referred to by a cons cell or a
+    function object.
+    """
+    if obj.type == PtType.cons and bool(obj):
+        cons = obj.contents.cons
+        return [ct.cast(cons.car, ct.c_void_p).value or 0, ct.cast(cons.cdr, ct.c_void_p).value or 0]
+    if obj.type == PtType.function:
+        return [ct.cast(obj.contents.closure.env, ct.c_void_p).value or 0]
+    return []
+
+
+def interpreted_functions():
+    """Return the interpreted functions reachable from the bindings of interned
+    symbols.
+    """
+    stack = [_binding(sym) for sym in PtObject.interned()]
+    seen, ret = set(), []
+    while stack:
+        address = stack.pop()
+        if not address or address & FIXNUM_TAG or address in seen:
+            continue
+        seen.add(address)
+        obj = PtObject.from_address(address)
+        if is_interpreted(obj):
+            ret.append(obj)
+        stack.extend(_children(obj))
+    return ret
+
+
+class _Encoder:
+    """Turns the objects reachable from symbol bindings into a list of cells,
+    given the names of the globals defined by compiled modules, by address.
+    """
+
+    def __init__(self, globals_):
+        self.globals = globals_
+        self.cells = []
+        self._indices = {}
+        self._pending = []
+
+        # Functions defined in Python, by the symbols they are bound to
+        self._owners = {}
+        for sym in PtObject.interned():
+            address = _binding(sym)
+            if address and self._is_python_function(address):
+                self._owners.setdefault(address, str(sym))
+
+    def _is_python_function(self, address):
+        return (
+            not address & FIXNUM_TAG
+            and address not in self.globals
+            and heap._cell(address) is None
+            and PtObject.from_address(address).type == PtType.function
+        )
+
+    def ref(self, address):
+        """Return a reference to an object, and queue it for encoding if needed."""
+        if not address:
+            return ('null',)
+        if address & FIXNUM_TAG:
+            return ('fixnum', fixnum_untag(address))
+        if address == ct.addressof(PtObject.nil):
+            return ('nil',)
+        if address in self.globals:
+            return ('global', self.globals[address])
+        if address in self._indices:
+            return self._indices[address]
+
+        obj = PtObject.from_address(address)
+        if obj.type == PtType.symbol and ct.addressof(PtObject.intern(str(obj))) == address:
+            return ('symbol', str(obj))
+        if self._is_python_function(address):
+            if address not in self._owners:
+                raise ValueError('Can not save a function defined in Python: {}'.format(obj))
+            return ('binding', self._owners[address])
+
+        index = self._indices[address] = len(self.cells)
+        self.cells.append(None)
+        self._pending.append((index, obj))
+        return index
+
+    def encode(self):
+        """Encode all queued objects, and those they refer to."""
+        while self._pending:
+            index, obj = self._pending.pop()
+            if obj.type == PtType.integer:
+                cell = ('integer', obj.contents.integer)
+            elif obj.type == PtType.double:
+                cell = ('double', obj.contents.double)
+            elif obj.type == PtType.bytestring:
+                cell = ('bytestring', obj.contents.bytestring)
+            elif obj.type == PtType.symbol:
+                cell = ('symbol', str(obj))
+            elif obj.type == PtType.cons:
+                cell = ('cons',) + tuple(self.ref(address) for address in _children(obj))
+            elif is_interpreted(obj):
+                raise ValueError('Can not save an interpreted function: {}'.format(obj))
+            else:
+                code = self.globals.get(obj.contents.closure.function)
+                if code is None:
+                    raise ValueError('Can not save a function without compiled code: {}'.format(obj))
+                cell = ('function', code, self.ref(_children(obj)[0]))
+            self.cells[index] = cell
+
+
+def save(path, header, modules, globals_):
+    """Write an image. The header is a dict describing the VM, the modules are
+    (name, object file, metadata) tuples, and `globals_` maps the addresses of
+    the globals they define to their names.
+    """
+    encoder = _Encoder(globals_)
+    bindings = []
+    for sym in PtObject.interned():
+        address = _binding(sym)
+        if not address:
+            continue
+        ref = encoder.ref(address)
+        if ref != ('binding', str(sym)):
+            bindings.append((str(sym), ref))
+    encoder.encode()
+
+    meta = pickle.dumps(dict(
+        header,
+        symbols=[str(sym) for sym in PtObject.interned()],
+        modules=[(name, len(obj), module_meta) for name, obj, module_meta in modules],
+        cells=encoder.cells,
+        bindings=bindings,
+    ), protocol=pickle.HIGHEST_PROTOCOL)
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, IMAGE_VERSION, len(meta)))
+        f.write(meta)
+        for _, obj, _ in modules:
+            f.write(obj)
+
+
+def read(path):
+    """Read an image through a memory map, which is closed once the parts have
+    been copied out. Returns the metadata, and the modules as (name, object
+    file, metadata) tuples.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if len(data) < _HEADER.size:
+            raise ValueError('Not an image: {}'.format(path))
+        magic, version, size = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != IMAGE_VERSION:
+            raise ValueError('Not an image, or made by another version: {}'.format(path))
+
+        offset = _HEADER.size + size
+        meta = pickle.loads(data[_HEADER.size:offset])
+        modules = []
+        for name, length, module_meta in meta['modules']:
+            modules.append((name, data[offset:offset + length], module_meta))
+            offset += length
+    return meta, modules
+
+
+def restore(meta, address_of):
+    """Recreate the objects in an image on the heap and bind the symbols, given a
+    function returning the address of a global defined by its modules.
+    """
+    for name in meta['symbols']:
+        PtObject.intern(name)
+
+    cells = meta['cells']
+    size = heap.object_size
+    base = heap.allocate_block(len(cells)) if cells else 0
+
+    def ref(ref):
+        if isinstance(ref, int):
+            return base + ref * size
+        kind = ref[0]
+        if kind == 'null':
+            return 0
+        if kind == 'fixnum':
+            return fixnum_tag(ref[1]) & ((1 << 64) - 1)
+        if kind == 'nil':
+            return ct.addressof(PtObject.nil)
+        if kind == 'global':
+            return address_of(ref[1])
+        if kind == 'symbol':
+            return ct.addressof(PtObject.intern(ref[1]))
+        address = _binding(PtObject.intern(ref[1]))
+        if not address:
+            raise ValueError('Symbol not bound to a function: {}'.format(ref[1]))
+        return address
+
+    # Nothing is allocated until all cells are filled in, so the collector never
+    # sees a partially restored block
+    for index, cell in enumerate(cells):
+        obj = PtObject.from_address(base + index * size)
+        kind = cell[0]
+        if kind == 'integer':
+            obj.type = PtType.integer
+            obj.contents.integer = cell[1]
+        elif kind == 'double':
+            obj.type = PtType.double
+            obj.contents.double = cell[1]
+        elif kind == 'bytestring':
+            obj.type = PtType.bytestring
+            obj.contents.bytestring = cell[1]
+            heap.attach(obj, cell[1])
+        elif kind == 'symbol':
+            sym = PtObject.symbol(cell[1])
+            obj.type = PtType.symbol
+            obj.contents.symbol = sym.contents.symbol
+            heap.attach(obj, sym)
+        elif kind == 'cons':
+            obj.type = PtType.cons
+            obj.contents.cons.car = _pointer(ref(cell[1]))
+            obj.contents.cons.cdr = _pointer(ref(cell[2]))
+        else:
+            obj.type = PtType.function
+            obj.contents.closure.function = address_of(cell[1])
+            obj.contents.closure.env = _pointer(ref(cell[2]))
+
+    for name, value in meta['bindings']:
+        PtObject.intern(name).contents.symbol.contents.binding = _pointer(ref(value))
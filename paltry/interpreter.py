@@ -0,0 +1,509 @@
+import ctypes as ct
+import math
+import operator
+import struct
+
+from paltry.datatypes import PtType, PtObject, PtContents, PtClosure, PtFunction
+from paltry.heap import heap
+import paltry.runtime as runtime
+
+
+# Number of calls of a function, or evaluations of a toplevel form, after which
+# it is compiled
+PROMOTE_THRESHOLD = 50
+
+# Maximal number of toplevel forms whose evaluations are counted
+FORM_TABLE_SIZE = 1 << 14
+
+
+class EvalError(Exception):
+    """Raised when evaluation fails when called from Python, where compiled code
+    would return a null pointer.
+    """
+
+
+def _ident(name):
+    return PtObject.intern(name).contents.symbol.contents.ident
+
+
+_NIL_ADDRESS = ct.addressof(PtObject.nil)
+
+# Special forms, by symbol identifier
+_special = {
+    _ident(name): name
+    for name in ('quote', 'begin', 'if', 'let', 'lambda', 'define')
+}
+
+
+def _wrap(value):
+    """Wrap an integer to 64 bits, like the integer instructions of compiled code."""
+    return ((value + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+
+
+def _int_div(a, b):
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def _float_div(a, b):
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+def _int_div_safe(a, b):
+    return b != 0 and not (a == -(1 << 63) and b == -1)
+
+
+# Primitives evaluated directly for two integers or two doubles, with the integer
+# operation, the double operation, and an optional guard for the integer case.
+# As in compiled code, any other arguments are passed to the generic function
+# bound to the symbol, and calls are only evaluated directly while the symbol is
+# not shadowed by a local variable, and is bound to the generic function.
+_arith_primitives = {
+    '+': (lambda a, b: _wrap(a + b), operator.add, None),
+    '-': (lambda a, b: _wrap(a - b), operator.sub, None),
+    '*': (lambda a, b: _wrap(a * b), operator.mul, None),
+    '/': (lambda a, b: _wrap(_int_div(a, b)), _float_div, _int_div_safe),
+}
+
+_compare_primitives = {
+    '<': (operator.lt, operator.lt, None),
+    '>': (operator.gt, operator.gt, None),
+    '<=': (operator.le, operator.le, None),
+    '>=': (operator.ge, operator.ge, None),
+    '=': (operator.eq, operator.eq, None),
+}
+
+# Constructors evaluated directly under the same conditions, with no operations
+_primitives = {
+    _ident(name): (name, ops, name in _compare_primitives, ct.addressof(runtime.primitives[name]))
+    for name, ops in dict(_arith_primitives, **_compare_primitives, cons=None, list=None).items()
+}
+
+
+def _bound_to(sym, address):
+    """Check whether a symbol is bound to the object at an address."""
+    return ct.cast(sym.contents.symbol.contents.binding, ct.c_void_p).value == address
+
+
+# Code is never made of tagged fixnums, so the interpreter reads its cons cells
+# directly, without the checks done by PtObject.car and PtObject.cdr
+def _car(node):
+    return node.contents.cons.car.contents
+
+
+def _cdr(node):
+    return node.contents.cons.cdr.contents
+
+
+def _is_nil(node):
+    return ct.addressof(node) == _NIL_ADDRESS
+
+
+def _is_pair(node):
+    return node.type == PtType.cons and not _is_nil(node)
+
+
+def _check(okp, form):
+    """Raise an error for a malformed special form, as the code generator would
+    fail to compile it.
+    """
+    if not okp:
+        raise EvalError('Malformed {}'.format(form))
+
+
+def _is_params(node):
+    return node.type == PtType.cons and all(param.type == PtType.symbol for param in _elements(node))
+
+
+def _elements(node):
+    ret = []
+    while node.type == PtType.cons and not _is_nil(node):
+        ret.append(_car(node))
+        node = _cdr(node)
+    return ret
+
+
+def _form_key(node):
+    """Return a hashable key identifying an expression by its contents."""
+    if node.type == PtType.cons:
+        key = [PtType.cons]
+        while node.type == PtType.cons and not _is_nil(node):
+            key.append(_form_key(_car(node)))
+            node = _cdr(node)
+        if node.type != PtType.cons:
+            key.extend((None, _form_key(node)))
+        return tuple(key)
+    if node.type == PtType.symbol:
+        return (PtType.symbol, node.contents.symbol.contents.ident)
+    if node.type == PtType.integer:
+        return (PtType.integer, node.contents.integer)
+    if node.type == PtType.double:
+        return (PtType.double, struct.pack('<d', node.contents.double))
+    if node.type == PtType.bytestring:
+        return (PtType.bytestring, node.contents.bytestring)
+    return (node.type, ct.addressof(node))
+
+
+def _symbols(node):
+    """Iterate over all symbols occuring in an expression."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.type == PtType.symbol:
+            yield node
+        elif node.type == PtType.cons and not _is_nil(node):
+            stack.extend((_cdr(node), _car(node)))
+
+
+class _Closure:
+    """An interpreted function: the parameters and body of a lambda, and the local
+    variables in scope where it was created. Attached to the heap function
+    object representing it.
+    """
+
+    __slots__ = ('interpreter', 'params', 'body', 'env', 'calls')
+
+    def __init__(self, interpreter, params, body, env):
+        self.interpreter = interpreter
+        self.params = params
+        self.body = body
+        self.env = env
+        self.calls = 0
+
+
+def _entry(nargs, argv):
+    """The native function of all interpreted function objects, through which
+    compiled code calls them.
+    """
+    try:
+        function = argv[nargs].contents
+        args = [PtObject.deref(argv[i]) for i in range(nargs)]
+        closure, = heap.attachments(function)
+        value = closure.interpreter.apply(closure, function, args)
+        return ct.addressof(heap.box(value))
+    except:
+        return 0
+
+_entry = PtFunction(_entry)
+_ENTRY_ADDRESS = ct.cast(_entry, ct.c_void_p).value
+
+
+def is_interpreted(function):
+    """Check whether a function object is an interpreted function."""
+    return function.type == PtType.function and function.contents.function == _ENTRY_ADDRESS
+
+
+class Interpreter:
+    """A tree-walking interpreter over PtObject trees, used as the first tier of
+    execution. It supports the same special forms and primitives as the code
+    generator, with the same semantics, so that interpreted and compiled code
+    can call each other freely.
+
+    Interpreted functions are ordinary function objects on the heap, whose
+    native function calls back into the interpreter. After `threshold` calls,
+    a function is compiled, and its function object is updated in place to
+    point to the compiled code. Likewise, a toplevel form evaluated `threshold`
+    times is compiled into a function, which is called from then on.
+
+    Tail calls in interpreted code run in constant Python stack space.
+    """
+
+    def __init__(self, vm, threshold=PROMOTE_THRESHOLD):
+        self.vm = vm
+        self.threshold = threshold
+        self.functions_promoted = 0
+        self.forms_promoted = 0
+
+        # Evaluation counts of toplevel forms, by contents, or the compiled
+        # function once a form has been promoted, or None if that failed
+        self._forms = {}
+
+    def eval(self, forms):
+        """Evaluate toplevel forms in order and return the value of the last one,
+        or None if one of them fails.
+        """
+        value = PtObject.nil
+        for form in forms:
+            thunk = self._hot_form(form)
+            try:
+                if thunk is not None:
+                    value = self._call_native(thunk, [])
+                else:
+                    value = self._eval(form, {})
+            except (EvalError, RecursionError):
+                return None
+        return value
+
+    def apply(self, closure, function, args):
+        """Call an interpreted function."""
+        env = self._enter(closure, function, args)
+        if env is None:
+            return self._call_native(function, args)
+        return self._eval(self._body(closure.body, env), env)
+
+    def _hot_form(self, form):
+        """Count an evaluation of a toplevel form, and return the compiled function
+        to call instead of interpreting it, if any.
+        """
+        if form.type != PtType.cons or _is_nil(form):
+            return None
+        key = _form_key(form)
+        count = self._forms.get(key, 0)
+        if not isinstance(count, int):
+            return count
+        if count + 1 < self.threshold:
+            if key not in self._forms and len(self._forms) >= FORM_TABLE_SIZE:
+                self._forms = {k: v for k, v in self._forms.items() if not isinstance(v, int)}
+            self._forms[key] = count + 1
+            return None
+
+        thunk = self._compile(PtObject.list([PtObject.intern('lambda'), PtObject.nil, form]))
+        if thunk is None:
+            self._forms[key] = None
+            return None
+        self.forms_promoted += 1
+        self._forms[key] = thunk
+        return thunk
+
+    def _compile(self, form):
+        """Compile and run a form evaluating to a function. Returns None if that
+        fails.
+        """
+        try:
+            return self.vm.eval_compiled([form])
+        except Exception:
+            return None
+
+    def promote(self, function):
+        """Compile an interpreted function now, however often it has been called.
+        Returns whether that succeeded. Compiled functions are left alone.
+        """
+        if not is_interpreted(function):
+            return True
+        closure, = heap.attachments(function)
+        return closure.interpreter._promote(closure, function)
+
+    def _promote(self, closure, function):
+        """Compile an interpreted function and point its function object to the
+        compiled code. The captured variables are bound to their values with a
+        surrounding let. Returns whether that succeeded.
+        """
+        params = {param.contents.symbol.contents.ident for param in closure.params}
+        captured = {}
+        for node in closure.body:
+            for sym in _symbols(node):
+                ident = sym.contents.symbol.contents.ident
+                if ident in closure.env and ident not in params and ident not in captured:
+                    captured[ident] = sym
+
+        form = PtObject.cons(
+            PtObject.intern('lambda'),
+            PtObject.cons(PtObject.list(closure.params), PtObject.list(closure.body)),
+        )
+        if captured:
+            form = PtObject.list([PtObject.intern('let'), PtObject.list([
+                PtObject.list([sym, PtObject.list([PtObject.intern('quote'), closure.env[ident]])])
+                for ident, sym in captured.items()
+            ]), form])
+
+        compiled = self._compile(form)
+        if compiled is None:
+            return False
+        function.contents.closure.function = compiled.contents.closure.function
+        function.contents.closure.env = compiled.contents.closure.env
+        self.functions_promoted += 1
+        return True
+
+    def _enter(self, closure, function, args):
+        """Bind the arguments of a call to an interpreted function. Returns the new
+        scope, or None if the function has been compiled and should be called
+        natively.
+        """
+        if len(args) != len(closure.params):
+            raise EvalError('Wrong number of arguments')
+        closure.calls += 1
+        if closure.calls == self.threshold and self._promote(closure, function):
+            return None
+        env = dict(closure.env)
+        for param, arg in zip(closure.params, args):
+            env[param.contents.symbol.contents.ident] = arg
+        return env
+
+    def _call(self, function, args):
+        if function.type == PtType.function and function.contents.function == _ENTRY_ADDRESS:
+            closure, = heap.attachments(function)
+            return closure.interpreter.apply(closure, function, args)
+        return self._call_native(function, args)
+
+    def _call_native(self, function, args):
+        if function.type != PtType.function:
+            raise EvalError('Not a function: {}'.format(function))
+
+        # Typed callbacks are called directly, without going through ctypes
+        callback = PtObject.typed_callback_at(function.contents.function)
+        if callback is not None:
+            try:
+                return callback(*args)
+            except Exception as err:
+                raise EvalError(str(err))
+
+        objects = [heap.box(arg) for arg in args] + [function]
+        argv = (ct.POINTER(PtObject) * len(objects))(*(ct.pointer(obj) for obj in objects))
+        value = PtFunction(function.contents.function)(len(args), argv)
+        if not value:
+            raise EvalError('Function call failed')
+        return PtObject.deref(ct.cast(value, ct.POINTER(PtObject)))
+
+    def _body(self, nodes, env):
+        """Evaluate all but the last of a sequence of expressions, and return the
+        last one, to be evaluated in tail position.
+        """
+        if not nodes:
+            return PtObject.nil
+        for node in nodes[:-1]:
+            self._eval(node, env)
+        return nodes[-1]
+
+    def _lookup(self, node, env):
+        ident = node.contents.symbol.contents.ident
+        if ident in env:
+            return env[ident]
+        binding = node.contents.symbol.contents.binding
+        if not binding:
+            raise EvalError('Unbound symbol: {}'.format(node))
+        return PtObject.deref(binding)
+
+    def _eval(self, node, env):
+        # Expressions in tail position are evaluated by the loop, instead of by a
+        # recursive call
+        while True:
+            if node.type == PtType.symbol:
+                return self._lookup(node, env)
+            # Literals and quoted data are parts of the tree being evaluated,
+            # which is owned by Python. They are copied into the heap by
+            # heap.box when they end up in bindings, cells or compiled code.
+            if node.type != PtType.cons:
+                return node
+            if _is_nil(node):
+                return PtObject.nil
+
+            head, tail = _car(node), _cdr(node)
+            form = primitive = None
+            if head.type == PtType.symbol:
+                ident = head.contents.symbol.contents.ident
+                form = _special.get(ident)
+                if ident not in env:
+                    primitive = _primitives.get(ident)
+
+            if form is not None and form != 'begin':
+                _check(_is_pair(tail), form)
+
+            if form == 'quote':
+                return _car(tail)
+            elif form == 'begin':
+                node = self._body(_elements(tail), env)
+                continue
+            elif form == 'if':
+                cond, tail = _car(tail), _cdr(tail)
+                _check(_is_pair(tail), form)
+                if not _is_nil(self._eval(cond, env)):
+                    node = _car(tail)
+                else:
+                    node = self._body(_elements(_cdr(tail)), env)
+                continue
+            elif form == 'let':
+                _check(_car(tail).type == PtType.cons, form)
+                scope = dict(env)
+                for binding in _elements(_car(tail)):
+                    value = PtObject.nil
+                    if binding.type == PtType.symbol:
+                        name = binding
+                    else:
+                        _check(_is_pair(binding) and _car(binding).type == PtType.symbol, form)
+                        name, rest = _car(binding), _cdr(binding)
+                        if not _is_nil(rest):
+                            _check(_is_pair(rest), form)
+                            value = self._eval(_car(rest), env)
+                    scope[name.contents.symbol.contents.ident] = value
+                env = scope
+                node = self._body(_elements(_cdr(tail)), env)
+                continue
+
+            args = _elements(tail)
+            if form == 'lambda':
+                return self._lambda(tail, env)
+            elif form == 'define':
+                return self._define(tail, env)
+            elif primitive is not None and _bound_to(head, primitive[3]):
+                name, ops, compare, _ = primitive
+                if name == 'cons' and len(args) == 2:
+                    car = heap.box(self._eval(args[0], env))
+                    return heap.cons(car, heap.box(self._eval(args[1], env)))
+                elif name == 'list':
+                    return heap.list([heap.box(self._eval(arg, env)) for arg in args])
+                elif ops is not None and (len(args) == 2 if compare else len(args) >= 2):
+                    return self._primitive(name, ops, compare, [self._eval(arg, env) for arg in args])
+
+            function = self._eval(head, env)
+            args = [self._eval(arg, env) for arg in args]
+            if function.type != PtType.function or function.contents.function != _ENTRY_ADDRESS:
+                return self._call_native(function, args)
+            closure, = heap.attachments(function)
+            if closure.interpreter is not self:
+                return closure.interpreter.apply(closure, function, args)
+            env = self._enter(closure, function, args)
+            if env is None:
+                return self._call_native(function, args)
+            node = self._body(closure.body, env)
+
+    def _lambda(self, node, env):
+        _check(_is_params(_car(node)), 'lambda')
+        closure = _Closure(self, _elements(_car(node)), _elements(_cdr(node)), env)
+        function = heap.new(PtType.function, PtContents(
+            closure=PtClosure(_ENTRY_ADDRESS, ct.pointer(PtObject.nil)),
+        ))
+        heap.attach(function, closure)
+        return function
+
+    def _define(self, node, env):
+        target, tail = _car(node), _cdr(node)
+        _check(_is_nil(tail) or _is_pair(tail), 'define')
+        if target.type == PtType.cons:
+            _check(_is_pair(target) and _car(target).type == PtType.symbol, 'define')
+            name = _car(target)
+            value = self._lambda(PtObject.cons(_cdr(target), tail), env)
+        else:
+            _check(target.type == PtType.symbol, 'define')
+            name = target
+            value = self._eval(PtObject.nil if _is_nil(tail) else _car(tail), env)
+        name.contents.symbol.contents.binding = ct.pointer(heap.box(value))
+        return name
+
+    def _primitive(self, name, ops, compare, args):
+        """Evaluate a call to an arithmetic or comparison primitive. Arithmetic with
+        more than two arguments is folded from the left.
+        """
+        int_op, double_op, guard = ops
+        value = args[0]
+        for arg in args[1:]:
+            if value.type == arg.type == PtType.integer:
+                a, b = value.contents.integer, arg.contents.integer
+                if guard is None or guard(a, b):
+                    value = self._result(int_op(a, b), compare)
+                    continue
+            elif value.type == arg.type == PtType.double:
+                value = self._result(double_op(value.contents.double, arg.contents.double), compare)
+                continue
+            value = self._call(self._lookup(PtObject.intern(name), {}), [value, arg])
+        return value
+
+    @staticmethod
+    def _result(value, compare):
+        if compare:
+            return PtObject.intern('t') if value else PtObject.nil
+        return PtObject(value)
@@ -5,6 +5,7 @@ import paltry.datatypes as datatypes
 
 
 _ptr = ir.IntType(8).as_pointer()
+_size_t = ir.IntType(8 * ct.sizeof(ct.c_size_t))
 
 
 PtContents = ir.IntType(8 * ct.sizeof(datatypes.PtContents))
@@ -25,6 +26,26 @@ PtSymbol = ir.LiteralStructType((
     PtObject.as_pointer(),      # binding
 ))
 
+PtClosure = ir.LiteralStructType((
+    _ptr,                       # function
+    PtObject.as_pointer(),      # env
+))
+
+PtSymbolEntry = ir.LiteralStructType((
+    ir.IntType(64),             # hash
+    _ptr,                       # name
+    PtObject.as_pointer(),      # value
+))
+
+PtSymbolTable = ir.LiteralStructType((
+    PtSymbolEntry.as_pointer(), # entries
+    _size_t,                    # mask
+    _size_t,                    # count
+    _ptr,                       # create
+))
+
+PtSymbolCreate = ir.FunctionType(PtObject.as_pointer(), (_ptr,))
+
 PtContents_integer = ir.IntType(8 * ct.sizeof(ct.c_longlong))
 PtContents_double = ir.DoubleType()
 PtContents_bytestring = _ptr
@@ -33,3 +54,11 @@ PtContents_function = _ptr
 PtFunction = ir.FunctionType(
     PtObject.as_pointer(), (ir.IntType(32), PtObject.as_pointer().as_pointer()),
 )
+
+PtHeap = ir.LiteralStructType((
+    _size_t,                    # ptr
+    _size_t,                    # end
+    _size_t,                    # top
+))
+
+PtRefill = ir.FunctionType(_ptr, (_size_t,))
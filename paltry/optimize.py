@@ -0,0 +1,55 @@
+from collections import namedtuple
+
+import llvmlite.binding as llvm
+
+
+OptLevel = namedtuple('OptLevel', ['name', 'ir_level', 'codegen_level', 'inline_threshold'])
+OptLevel.__doc__ = """An optimization preset. The IR level selects the pass
+pipeline run on each module before it is handed to MCJIT, and the codegen
+level is given to the target machine that emits machine code.
+"""
+
+# The fast compile preset skips the full pass manager builder pipeline, and
+# instead runs a handful of cheap cleanup passes that remove most of the
+# redundant GEP, bitcast and load chains emitted by codegen.
+OPT_LEVELS = {
+    '0': OptLevel('0', 0, 0, None),
+    '1': OptLevel('1', 1, 1, None),
+    '2': OptLevel('2', 2, 2, 225),
+    '3': OptLevel('3', 3, 3, 275),
+    'fast': OptLevel('fast', None, 0, None),
+}
+
+
+def get_opt_level(level):
+    """Look up an optimization preset by name. Integers are accepted as well."""
+    if isinstance(level, OptLevel):
+        return level
+    try:
+        return OPT_LEVELS[str(level)]
+    except KeyError:
+        raise ValueError('Invalid optimization level: {}'.format(level))
+
+
+def create_pass_manager(level):
+    """Create a module pass manager implementing the given preset. Returns None if
+    no passes should be run.
+    """
+    level = get_opt_level(level)
+    if level.ir_level == 0:
+        return None
+
+    pm = llvm.create_module_pass_manager()
+    if level.ir_level is None:
+        pm.add_sroa_pass()
+        pm.add_instruction_combining_pass()
+        pm.add_cfg_simplification_pass()
+        pm.add_dead_code_elimination_pass()
+        return pm
+
+    builder = llvm.create_pass_manager_builder()
+    builder.opt_level = level.ir_level
+    if level.inline_threshold is not None:
+        builder.inlining_threshold = level.inline_threshold
+    builder.populate(pm)
+    return pm
@@ -0,0 +1,50 @@
+import os
+import re
+
+from paltry.elf import function_symbols
+
+
+def readable_name(name):
+    """Turn the name of a native function into a name for profilers. Module init
+    functions are named after the module, and compiled functions after the
+    symbol they were defined as, or numbered if they are anonymous.
+    """
+    match = re.fullmatch(r'##fn##(.*)##(\d+)', name)
+    if match:
+        fname, index = match.groups()
+        return 'paltry:' + (fname if fname != 'lambda' else 'lambda#' + index)
+    match = re.fullmatch(r'##(.*)##init(?:##(\d+))?', name)
+    if match:
+        module, index = match.groups()
+        return 'paltry:{}:init'.format(module) + (':' + index if index else '')
+    return 'paltry:' + name
+
+
+class PerfMap:
+    """A symbol map for JIT compiled code in the format read by Linux perf, by
+    default /tmp/perf-<pid>.map. With it, perf report shows compiled functions
+    by name instead of as anonymous addresses.
+
+    The map has no way to record that code has been unloaded, so samples in
+    the memory of freed scratch engines may be attributed to old entries.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or '/tmp/perf-{}.map'.format(os.getpid())
+        self._file = open(self.path, 'a')
+
+    def add(self, address, size, name):
+        self._file.write('{:x} {:x} {}\n'.format(address, size, name))
+        self._file.flush()
+
+    def add_object(self, obj, get_address):
+        """Add the functions defined in an object file, given a function returning
+        the address at which a function was loaded, by name.
+        """
+        for name, size in function_symbols(obj).items():
+            address = get_address(name)
+            if address:
+                self.add(address, size, readable_name(name))
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,236 @@
+import codecs
+from contextlib import closing
+import mmap
+import re
+
+from paltry.datatypes import PtObject
+from paltry.fasl import is_fasl, load as load_fasl
+
+
+# Number of bytes or characters read from a stream at a time
+CHUNK_SIZE = 1 << 16
+
+
+# A single regular expression matching leading whitespace and comments followed
+# by one token. The alternatives are in the same order as in the grammar, since
+# like the PEG parser, the first matching alternative wins. Whitespace and
+# comments are skipped atomically, by capturing them in a lookahead and
+# matching the capture, so a failing token never backtracks into them.
+_token = re.compile(r'''
+    (?=(?P<skip>(?:\s+|;[^\n]*)*))(?P=skip)
+    (?:
+        (?P<open>\()
+      | (?P<close>\))
+      | (?P<double>[-+]?[0-9]*(?:[0-9]\.|\.[0-9])[0-9]*(?:[eE][+-]?[0-9]+)?)
+      | (?P<bin_integer>[-+]?0b[0-1]+)
+      | (?P<oct_integer>[-+]?0o[0-7]+)
+      | (?P<hex_integer>[-+]?0x[0-9a-f]+)
+      | (?P<dec_integer>[-+]?[0-9]+)
+      | (?P<symbol>[^\\"'`,\n\t() ]+)
+      | (?P<string>"(?:\\[\s\S]|[^"\\])*")
+      | (?P<quote>,@|['`,])
+      | (?P<end>\Z)
+    )
+''', re.VERBOSE)
+
+
+def _radix_integer(base):
+    def convert(value):
+        sign = ''
+        if value[0] in '+-':
+            sign, value = value[0], value[1:]
+        return PtObject(int(sign + value[2:], base))
+    return convert
+
+
+def _string(value):
+    value = value[1:-1]
+    if '\\' in value:
+        value = codecs.escape_decode(bytes(value, 'utf-8'))[0].decode('utf-8')
+    return PtObject(value)
+
+
+_converters = {
+    'double': lambda value: PtObject(float(value)),
+    'bin_integer': _radix_integer(2),
+    'oct_integer': _radix_integer(8),
+    'hex_integer': _radix_integer(16),
+    'dec_integer': lambda value: PtObject(int(value)),
+    'symbol': PtObject.intern,
+    'string': _string,
+}
+
+_quotes = {
+    "'": 'quote',
+    '`': 'backquote',
+    ',': 'unquote',
+    ',@': 'unquote-splice',
+}
+
+
+class ReadError(Exception):
+    """Raised on malformed input. The position is a character offset."""
+
+    def __init__(self, message, position):
+        super(ReadError, self).__init__('{} at position {}'.format(message, position))
+        self.position = position
+
+
+def _make_list(elements, position):
+    if len(elements) > 1 and elements[-2] == PtObject.intern('.'):
+        if len(elements) == 2:
+            raise ReadError('Missing car in dotted list', position)
+        return PtObject.list(elements[:-2], elements[-1])
+    return PtObject.list(elements)
+
+
+# Returned by Reader._read when the buffer ends in the middle of a form
+_incomplete = object()
+
+# A token may be the prefix of a longer one, up to this many characters away
+# (as in 1.5 and 1.5e-3, or 0 and 0x1), so a form ending closer than this to
+# the end of a partial buffer is read again once more text has arrived, unless
+# it ends in a closing parenthesis or is followed by whitespace
+_LOOKAHEAD = 3
+
+
+class Reader:
+    """A single-pass reader producing the same objects as the TatSu grammar with
+    PaltrySemantics, without backtracking or memoization. Iterating over a
+    reader yields the toplevel forms in order.
+
+    The source is either a string or a stream with a read method returning
+    strings or UTF-8 encoded bytes, such as a file object or an mmap. Streams
+    are read in chunks as forms are requested, and text is discarded once it
+    has been read, so only the form being read is held in memory. Streams with
+    a read1 method, such as binary pipes, are read without waiting for whole
+    chunks, so that forms are produced as soon as they have arrived.
+    """
+
+    def __init__(self, source, chunk_size=CHUNK_SIZE):
+        if isinstance(source, str):
+            self.text, self._stream = source, None
+        else:
+            self.text, self._stream = '', source
+            self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.chunk_size = chunk_size
+
+        # Number of characters discarded from the start of the text
+        self._offset = 0
+        self._pos = 0
+
+    @property
+    def position(self):
+        """Character offset of the end of the last form read."""
+        return self._offset + self._pos
+
+    def __iter__(self):
+        while True:
+            form = self.read()
+            if form is None:
+                return
+            yield form
+
+    def _fill(self):
+        """Read the next chunk from the stream. Forms are read again from the start
+        when more text arrives, so chunks grow with the size of the unfinished
+        form to keep the total work linear. Streams with a read1 method may
+        return less, as soon as any text is available.
+        """
+        read = getattr(self._stream, 'read1', self._stream.read)
+        data = read(max(self.chunk_size, len(self.text) - self._pos))
+        chunk = data
+        if isinstance(data, bytes):
+            chunk = self._decoder.decode(data, final=not data)
+        if not data:
+            self._stream = None
+        self.text = self.text[self._pos:] + chunk
+        self._offset += self._pos
+        self._pos = 0
+
+    def read(self):
+        """Read the next toplevel form, or return None at the end of the input."""
+        while True:
+            form = self._read()
+            if form is not _incomplete:
+                return form
+            self._fill()
+
+    def _read(self):
+        text, match, pos = self.text, _token.match, self._pos
+        complete = self._stream is None
+
+        # Open lists are Python lists of elements, pending quotes are symbols
+        stack = []
+        while True:
+            token = match(text, pos)
+
+            # A token running into the end of the text may continue in the next
+            # chunk, so the whole form is read again once it has arrived. Closing
+            # parentheses are never part of a longer token.
+            if not complete and (token is None or token.end() == len(text) and token.lastgroup != 'close'):
+                return _incomplete
+            if token is None:
+                raise ReadError('Invalid syntax', self._offset + pos)
+            kind = token.lastgroup
+            pos = token.end()
+
+            if kind == 'open':
+                stack.append([])
+                continue
+            elif kind == 'quote':
+                stack.append(PtObject.intern(_quotes[token.group(kind)]))
+                continue
+            elif kind == 'close':
+                if not stack or not isinstance(stack[-1], list):
+                    raise ReadError("Unexpected ')'", self._offset + token.start(kind))
+                obj = _make_list(stack.pop(), self._offset + token.start(kind))
+            elif kind == 'end':
+                if stack:
+                    raise ReadError('Unexpected end of input', self._offset + pos)
+                self._pos = pos
+                return None
+            else:
+                obj = _converters[kind](token.group(kind))
+
+            while stack and not isinstance(stack[-1], list):
+                obj = PtObject.list([stack.pop(), obj])
+            if not stack:
+                if (not complete and kind != 'close' and len(text) - pos < _LOOKAHEAD
+                        and not text[pos:pos + 1].isspace()):
+                    return _incomplete
+                self._pos = pos
+                return obj
+            stack[-1].append(obj)
+
+
+def read(text):
+    """Read a single form from a string."""
+    form = Reader(text).read()
+    if form is None:
+        raise ReadError('Unexpected end of input', len(text))
+    return form
+
+
+def read_all(text):
+    """Read all toplevel forms from a string and return them as a list."""
+    return list(Reader(text))
+
+
+def read_file(filename, chunk_size=CHUNK_SIZE):
+    """Generate the toplevel forms in a file. The file is memory mapped, so that
+    pages are only loaded as the reader reaches them. Files written by
+    paltry.fasl are recognized and loaded without reading them as text.
+    """
+    with open(filename, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and pipes can not be mapped
+            yield from Reader(f, chunk_size=chunk_size)
+            return
+        with closing(mapped):
+            if is_fasl(mapped):
+                yield from load_fasl(mapped)
+            else:
+                yield from Reader(mapped, chunk_size=chunk_size)
@@ -1,6 +1,43 @@
 import ctypes as ct
+from functools import reduce
+import math
+import operator
 
-from paltry.datatypes import PtObject
+from paltry.datatypes import PtType, PtObject
+from paltry.heap import heap
+
+
+def _number(obj):
+    if obj.type == PtType.integer:
+        return obj.contents.integer
+    elif obj.type == PtType.double:
+        return obj.contents.double
+    raise TypeError('Not a number: {}'.format(obj))
+
+
+def _truncating_div(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        quotient = abs(a) // abs(b)
+        return quotient if (a < 0) == (b < 0) else -quotient
+    return a / b
+
+
+def _arithmetic(op, identity):
+    def function(*args):
+        args = [_number(arg) for arg in args]
+        if len(args) < 2:
+            args = [identity] + args
+        return heap.box(PtObject(reduce(op, args)))
+    return function
+
+
+def _comparison(op):
+    def function(*args):
+        args = [_number(arg) for arg in args]
+        if all(op(a, b) for a, b in zip(args, args[1:])):
+            return PtObject.intern('t')
+        return PtObject.nil
+    return function
 
 
 @PtObject.callback()
@@ -9,6 +46,75 @@ def display(*args):
     return PtObject.nil
 
 
+# Replaced by native versions once a VM has been created, see codegen_intern
+# and codegen_symbol_name
 @PtObject.callback()
 def intern(name):
     return PtObject.intern(name.string)
+
+
+@PtObject.callback(name='symbol-name')
+def symbol_name(sym):
+    if sym.type != PtType.symbol:
+        raise TypeError('Not a symbol: {}'.format(sym))
+    return heap.box(PtObject(str(sym)))
+
+
+@PtObject.callback()
+def cons(car, cdr):
+    return heap.cons(car, cdr)
+
+
+@PtObject.callback()
+def car(obj):
+    return heap.box(obj.car)
+
+
+@PtObject.callback()
+def cdr(obj):
+    return heap.box(obj.cdr)
+
+
+@PtObject.callback(name='list')
+def list_(*args):
+    return heap.list(args)
+
+
+@PtObject.callback()
+def garbage_collect():
+    heap.collect()
+    return PtObject.nil
+
+
+# Generic arithmetic and comparison functions. Calls with two integers or two
+# doubles are compiled inline, and only other cases end up here.
+add = PtObject.callback(name='+')(_arithmetic(operator.add, 0))
+sub = PtObject.callback(name='-')(_arithmetic(operator.sub, 0))
+mul = PtObject.callback(name='*')(_arithmetic(operator.mul, 1))
+div = PtObject.callback(name='/')(_arithmetic(_truncating_div, 1))
+lt = PtObject.callback(name='<')(_comparison(operator.lt))
+gt = PtObject.callback(name='>')(_comparison(operator.gt))
+le = PtObject.callback(name='<=')(_comparison(operator.le))
+ge = PtObject.callback(name='>=')(_comparison(operator.ge))
+num_eq = PtObject.callback(name='=')(_comparison(operator.eq))
+
+# The function objects of the generic functions, by name. Calls are only
+# handled inline while the symbols are still bound to them.
+primitives = {
+    name: function.function for name, function in [
+        ('+', add), ('-', sub), ('*', mul), ('/', div),
+        ('<', lt), ('>', gt), ('<=', le), ('>=', ge), ('=', num_eq),
+        ('cons', cons), ('list', list_),
+    ]
+}
+
+
+# Typed callbacks, called from compiled code with unboxed arguments
+@PtObject.callback(params=(float,), result=float)
+def sqrt(x):
+    return math.sqrt(x)
+
+
+@PtObject.callback(name='string-length', params=(str,), result=int)
+def string_length(string):
+    return len(string)
@@ -14,6 +14,9 @@ setup(
         'llvmlite',
         'tatsu',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'paltry=paltry.__main__:main',
@@ -0,0 +1,102 @@
+import pytest
+
+from paltry import PaltryVM, EvalError
+from paltry.datatypes import PtObject
+from paltry.heap import heap
+from paltry.reader import read_all
+
+
+@pytest.fixture(params=[False, True], ids=['boxed', 'fixnums'])
+def vm(request):
+    return PaltryVM(fixnums=request.param)
+
+
+def test_call(vm):
+    f = vm.compile('(+ (* x x) y)', params=['x', 'y'])
+    assert f(3, 4) == 13
+    assert f(1.5, 0.25) == 2.5
+    assert f(1 << 40, 0) == 0
+
+    g = vm.compile('(if (< x 0) "negative" x)', params=['x'])
+    assert g(-1) == 'negative'
+    assert g(5) == 5
+    assert vm.compile('(list x y)', params=['x', 'y'])('a', 1.0) == PtObject.list([PtObject('a'), PtObject(1.0)])
+    assert vm.compile('(< x y)', params=['x', 'y'])(1, 2) is True
+    assert vm.compile('(< x y)', params=['x', 'y'])(2, 1) is None
+    assert vm.compile('42')() == 42
+
+    with pytest.raises(EvalError):
+        f(1, 'a')
+    with pytest.raises(TypeError):
+        f(1)
+    assert heap.state.top == heap.root_base
+
+
+def test_map(vm):
+    f = vm.compile('(+ (* x x) y)', params=['x', 'y'])
+    assert f.map([(1, 2), (3, 4), (5, 6)]) == [3.0, 13.0, 31.0]
+    assert f.map([(1, 2), (3, 4)], dtype=int) == [3, 13]
+    assert f.map([(0.5, 1)]) == [1.25]
+    assert f.map([]) == []
+
+    g = vm.compile('(if (< x 3) x "big")', params=['x'])
+    assert g.map(range(3), dtype=int) == [0, 1, 2]
+    with pytest.raises(EvalError, match='input 3'):
+        g.map(range(5))
+    with pytest.raises(EvalError, match='input 0'):
+        vm.compile('(* x 0.5)', params=['x']).map([1], dtype=int)
+    with pytest.raises(ValueError):
+        f.map([(1, 2, 3)])
+    assert heap.state.top == heap.root_base
+
+
+def test_map_numpy(vm):
+    numpy = pytest.importorskip('numpy')
+    f = vm.compile('(- x y)', params=['x', 'y'])
+    values = f.map(numpy.arange(10).reshape(5, 2))
+    assert values.dtype == numpy.float64
+    assert list(values) == [-1.0] * 5
+    values = vm.compile('(* x 2)', params=['x']).map(numpy.linspace(0, 1, 5))
+    assert list(values) == [0.0, 0.5, 1.0, 1.5, 2.0]
+
+
+def test_lists(vm):
+    ints = vm.to_list(range(1000))
+    assert str(vm.to_list([1, 2, 3])) == '(1 2 3)'
+    assert str(vm.to_list([0.5, -1.0])) == '(0.5 -1.0)'
+    assert str(vm.to_list(['a', 1, None, True])) == '("a" 1 nil t)'
+    assert vm.to_list([]) == PtObject.nil
+    assert list(vm.to_list([4, 5])) == [PtObject(4), PtObject(5)]
+
+    total = vm.compile('(define (sum l acc) (if l (sum (cdr l) (+ acc (car l))) acc)) (sum l 0)', params=['l'])
+    heap.collect()
+    assert total(ints) == 499500
+    assert vm.from_list(ints, dtype=int) == list(range(1000))
+    assert vm.from_list(ints) == [float(i) for i in range(1000)]
+    assert vm.from_list(vm.to_list([1, 2.5])) == [1.0, 2.5]
+    assert vm.from_list(vm.eval_code(read_all('(list 1 2 3)')), dtype=int) == [1, 2, 3]
+    assert vm.from_list(PtObject.nil) == []
+    assert list(vm.from_list(ints, dtype=int, as_array=True)) == list(range(1000))
+
+    # Larger than an arena
+    big = vm.to_list([0.25] * (heap.arena_size // heap.object_size))
+    heap.collect()
+    assert total(big) == heap.arena_size // heap.object_size / 4
+
+    with pytest.raises(TypeError, match='Element 1'):
+        vm.from_list(vm.to_list([1, 2.5]), dtype=int)
+    with pytest.raises(TypeError, match='Element 2'):
+        vm.from_list(vm.eval_code(read_all("'(1 2 . 3)")), dtype=int)
+    with pytest.raises(TypeError, match='Element 0'):
+        vm.from_list(PtObject(1))
+
+
+def test_lists_numpy(vm):
+    numpy = pytest.importorskip('numpy')
+    values = numpy.linspace(0, 1, 11)
+    obj = vm.to_list(values)
+    assert str(obj).startswith('(0.0 0.1 0.2')
+    result = vm.from_list(obj, as_array=True)
+    assert isinstance(result, numpy.ndarray)
+    assert (result == values).all()
+    assert vm.from_list(vm.to_list(numpy.arange(5)), dtype=int) == [0, 1, 2, 3, 4]
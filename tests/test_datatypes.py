@@ -1,3 +1,5 @@
+import ctypes as ct
+
 from paltry.datatypes import PtObject, PtSymbol
 
 import pytest
@@ -42,6 +44,22 @@ def test_symbol():
     assert ns[PtSymbol('a', 1)] == 'b'
     assert ns[PtSymbol('b', 0)] == 'a'
 
+    # Symbol records are out of line, so no member is larger than a cons cell
+    assert ct.sizeof(PtObject) == 3 * ct.sizeof(ct.c_void_p)
+    sym = PtObject.symbol('abc')
+    sym.contents.symbol.contents.binding = ct.pointer(PtObject(1))
+    assert PtObject.deref(sym.contents.symbol.contents.binding) == PtObject(1)
+
+    # Interned symbols are also in the native symbol table, which grows as needed
+    table = PtObject.symbol_table
+    names = ['table-{}'.format(i) for i in range(2 * (table.state.mask + 1))]
+    for name in names:
+        PtObject.intern(name)
+    assert 2 * table.state.count <= table.state.mask + 1
+    assert all(table.lookup(name.encode('utf-8')) == ct.addressof(PtObject.intern(name)) for name in names)
+    assert table.lookup(b'nil') == ct.addressof(PtObject.nil)
+    assert table.lookup(b'abcd') is None
+
 
 def test_cons():
     assert str(PtObject.nil) == 'nil'
@@ -1,7 +1,15 @@
+import ctypes as ct
+
+import pytest
+
+from paltry.aot import link_shared
 from paltry.datatypes import PtObject
 from paltry.codegen import codegen
+import paltry
 from paltry import PaltryVM
+from paltry.heap import heap
 from paltry.parser import PaltryParser, PaltrySemantics
+from paltry.reader import read_all
 
 
 _vm = PaltryVM()
@@ -69,3 +77,436 @@ def test_if():
 
 def test_runtime():
     check_result('(intern "alpha")', PtObject.intern('alpha'))
+
+    # Symbols are interned natively, and created through Python if they are new
+    table = PtObject.symbol_table
+    assert table.lookup(b'runtime-new-symbol') is None
+    for fixnums in (False, True):
+        vm = PaltryVM(fixnums=fixnums)
+        check = lambda code: vm.eval_code(_parser.parse(code, 'toplevel'))
+        assert check('(intern "runtime-new-symbol")') == PtObject.intern('runtime-new-symbol')
+        assert table.lookup(b'runtime-new-symbol') == ct.addressof(PtObject.intern('runtime-new-symbol'))
+        assert check('(list (intern "nil") (intern "λ") (symbol-name \'alpha))') == PtObject.list([
+            PtObject.nil, PtObject.intern('λ'), PtObject('alpha'),
+        ])
+        assert check('(intern 1)') is None
+        assert check('(symbol-name "alpha")') is None
+
+    # Uninterned symbols are named by the Python fallback
+    sym = PtObject.intern('runtime-uninterned')
+    sym.contents.symbol.contents.binding = ct.pointer(PtObject.symbol('alpha'))
+    check_result('(symbol-name runtime-uninterned)', PtObject('alpha'))
+    heap.collect()
+
+
+def test_opt_levels():
+    for level in ['0', '1', '2', '3', 'fast']:
+        vm = PaltryVM(opt_level=level)
+        ast = _parser.parse('(let ((a 1)) (if a (begin "x" a) 2))', 'toplevel')
+        assert vm.eval_code(ast) == PtObject(1)
+        assert vm.last_timings['finalize'] > 0
+        assert vm.compile_time >= vm.last_timings['codegen']
+
+
+def test_constant_pool():
+    vm = PaltryVM()
+    code = '\'(a 1 2.5 "x" "y" (b . 3))'
+    first = vm.eval_code(_parser.parse(code, 'toplevel'))
+    nconstants = len(vm.constants)
+    second = vm.eval_code(_parser.parse(code, 'toplevel'))
+    assert first == second
+    assert ct.addressof(first) == ct.addressof(second)
+    assert len(vm.constants) == nconstants
+
+    assert vm.eval_code(_parser.parse('(begin 2.5)', 'toplevel')) == PtObject(2.5)
+    assert len(vm.constants) == nconstants
+    assert vm.eval_code(_parser.parse('-0.0', 'toplevel')) == PtObject(-0.0)
+    assert len(vm.constants) == nconstants + 1
+
+
+def test_lists():
+    check_result('(cons 1 2)', PtObject.cons(PtObject(1), PtObject(2)))
+    check_result('(cons 1 (cons 2 nil))', PtObject.list([PtObject(1), PtObject(2)]))
+    check_result('(list)', PtObject.nil)
+    check_result('(list 1 "a" \'b)', PtObject.list([
+        PtObject(1), PtObject('a'), PtObject.intern('b'),
+    ]))
+    check_result('(car (list 1 2))', PtObject(1))
+    check_result('(cdr (cons 1 2))', PtObject(2))
+    check_result('(let ((f list)) (f 1 2))', PtObject.list([PtObject(1), PtObject(2)]))
+
+    # Constructors shadowed by local variables, or bound to other functions
+    check_result('(let ((list (lambda (x) (+ x 1)))) (list 1))', PtObject(2))
+    check_result('(let ((cons (lambda (a b) b))) (cons 1 2))', PtObject(2))
+    check_result('((lambda (list) (list 3)) car)', None)
+    check_result('((lambda (list) (list \'(3 4))) car)', PtObject(3))
+    check_result('(define (pair x) (cons x x)) (define old-cons cons) (define cons +) (pair 4)', PtObject(8))
+    check_result('(define old-list list) (define list +) (list 7 8 9)', PtObject(24))
+    check_result('(define cons old-cons) (define list old-list) (list (pair 4) (cons 1 2))', PtObject.list([
+        PtObject.cons(PtObject(4), PtObject(4)), PtObject.cons(PtObject(1), PtObject(2)),
+    ]))
+
+
+def test_heap():
+    vm = PaltryVM()
+    before = vm.heap.bytes_allocated
+    ast = _parser.parse('(list 1 2 3) (cons 1 2)', 'toplevel')
+    vm.eval_code(ast)
+    assert vm.last_allocations == 4
+    assert vm.heap.bytes_allocated - before == 4 * vm.heap.object_size
+    assert vm.heap.arena_count >= 1
+
+
+def test_gc():
+    kept = _vm.eval_code(_parser.parse('(list 1 (list 2.5 "x") \'y)', 'toplevel'))
+    for _ in range(10):
+        _vm.eval_code(_parser.parse('(list 1 2 3 4 5)', 'toplevel'))
+
+    stats = _vm.gc_stats
+    collections = stats.collections
+    check_result('(garbage-collect)', PtObject.nil)
+    assert stats.collections == collections + 1
+    assert stats.bytes_freed >= 50 * heap.object_size
+    assert str(kept) == '(1 (2.5 "x") y)'
+
+    check_result(
+        '(let ((a (list 1 2))) (list (cons 3 4) (garbage-collect) a))',
+        PtObject.list([
+            PtObject.cons(PtObject(3), PtObject(4)),
+            PtObject.nil,
+            PtObject.list([PtObject(1), PtObject(2)]),
+        ])
+    )
+
+    threshold = heap.gc_threshold
+    heap.gc_threshold = 0
+    try:
+        collections = stats.collections
+        while stats.collections == collections:
+            heap.cons(PtObject.nil, PtObject.nil)
+    finally:
+        heap.gc_threshold = threshold
+    assert str(kept) == '(1 (2.5 "x") y)'
+
+
+def test_box():
+    form, = read_all('(12345 "hello world" (1 2 3))')
+    number, string, numbers = form.car, form.cdr.car, form.cdr.cdr.car
+    boxed = [heap.box(obj) for obj in (number, string, numbers)]
+    for obj in boxed:
+        assert heap._cell(ct.addressof(obj)) is not None
+        assert ct.addressof(heap.box(obj)) == ct.addressof(obj)
+
+    car = PtObject.intern('car').contents.symbol.contents.binding.contents
+    assert ct.addressof(heap.box(car)) == ct.addressof(car)
+
+    sym = PtObject.intern('test-box')
+    sym.contents.symbol.contents.binding = ct.pointer(heap.cons(boxed[0], heap.list(boxed[1:])))
+    del form, number, string, numbers, boxed
+    for _ in range(10):
+        _vm.eval_code(_parser.parse('(list 1 2.5 "garbage" (list 3 4))', 'toplevel'))
+    heap.collect()
+    assert str(sym.contents.symbol.contents.binding.contents) == '(12345 "hello world" (1 2 3))'
+
+
+def test_fixnums():
+    vm = PaltryVM(fixnums=True)
+    check = lambda code, value: vm.eval_code(_parser.parse(code, 'toplevel')) == value
+
+    assert check('0', PtObject(0))
+    assert check('-17', PtObject(-17))
+    assert check('4611686018427387903', PtObject(4611686018427387903))
+    assert check('4611686018427387904', PtObject(4611686018427387904))
+    assert check('-4611686018427387905', PtObject(-4611686018427387905))
+    assert check("'(1 2 . 3)", PtObject.cons(
+        PtObject(1), PtObject.cons(PtObject(2), PtObject(3))
+    ))
+    assert check('(let ((a 1)) (list a 2.0 a))', PtObject.list([
+        PtObject(1), PtObject(2.0), PtObject(1),
+    ]))
+    assert check('(car (cdr (list 1 2 3)))', PtObject(2))
+    assert check('(cons 1 (cons 2 nil))', PtObject.list([PtObject(1), PtObject(2)]))
+    assert vm.eval_code(_parser.parse('(1 2)', 'toplevel')) is None
+
+    kept = vm.eval_code(_parser.parse('(cons 1 (list 1 2))', 'toplevel'))
+    vm.eval_code(_parser.parse('(garbage-collect)', 'toplevel'))
+    assert str(kept) == '(1 1 2)'
+
+
+def test_arithmetic():
+    for vm in [PaltryVM(), PaltryVM(fixnums=True)]:
+        check = lambda code: vm.eval_code(_parser.parse(code, 'toplevel'))
+
+        assert check('(+ 1 2)') == PtObject(3)
+        assert check('(- 1 2)') == PtObject(-1)
+        assert check('(* 3 -4)') == PtObject(-12)
+        assert check('(/ 7 2)') == PtObject(3)
+        assert check('(/ -7 2)') == PtObject(-3)
+        assert check('(+ 1 2 3 4)') == PtObject(10)
+        assert check('(- 10 1 2)') == PtObject(7)
+        assert check('(+ 1.5 2.25)') == PtObject(3.75)
+        assert check('(/ 1.0 4.0)') == PtObject(0.25)
+        assert check('(+ 1 2.5)') == PtObject(3.5)
+        assert check('(* 2.0 3)') == PtObject(6.0)
+        assert check('(- 5)') == PtObject(-5)
+        assert check('(+)') == PtObject(0)
+        assert check('(/ 1 0)') is None
+        assert check('(+ 1 "a")') is None
+        assert check('(+ 4611686018427387903 1)') == PtObject(4611686018427387904)
+        assert check('(- -4611686018427387904 4611686018427387904)') == PtObject(-(1 << 63))
+        assert check('(+ (car (list 1)) 2)') == PtObject(3)
+
+        assert check('(< 1 2)') == PtObject.intern('t')
+        assert check('(< 2 1)') == PtObject.nil
+        assert check('(>= 2.0 2.0)') == PtObject.intern('t')
+        assert check('(= 1 1.0)') == PtObject.intern('t')
+        assert check('(> 3 2 1)') == PtObject.intern('t')
+        assert check('(if (< 1 2) (+ 1 1) 0)') == PtObject(2)
+        assert check('(let ((f +)) (f 1 2))') == PtObject(3)
+
+        # Primitives shadowed by local variables, or bound to other functions
+        assert check('(let ((+ list)) (+ 1 2))') == PtObject.list([PtObject(1), PtObject(2)])
+        assert check('(define (apply-op < a b) (< a b)) (apply-op - 3 1)') == PtObject(2)
+        assert check('(define (inc x) (+ x 1)) (define old+ +) (define + list) (inc 5)') == PtObject.list([
+            PtObject(5), PtObject(1),
+        ])
+        assert check('(+ 1 2 3)') == PtObject.list([PtObject(1), PtObject(2), PtObject(3)])
+        assert check('(define + old+) (list (inc 5) (+ 1 2.5))') == PtObject.list([
+            PtObject(6), PtObject(3.5),
+        ])
+
+
+def test_functions():
+    vm = PaltryVM()
+    check = lambda code: vm.eval_code(_parser.parse(code, 'toplevel'))
+
+    assert check('((lambda (x) (* x x)) 5)') == PtObject(25)
+    assert check('((lambda ()))') == PtObject.nil
+    assert check('((lambda (x) x))') is None
+    assert check('(define (square x) (* x x))') == PtObject.intern('square')
+    assert check('(square 7)') == PtObject(49)
+    assert check('(define add (lambda (a b) (+ a b))) (add 1 2)') == PtObject(3)
+    assert check('(define (fact n) (if (< n 2) 1 (* n (fact (- n 1))))) (fact 10)') == PtObject(3628800)
+    assert check('(let ((n 10)) ((lambda (x) (+ x n)) 5))') == PtObject(15)
+
+    # Closures
+    assert check('(define (adder n) (lambda (x) (+ x n)))') == PtObject.intern('adder')
+    assert check('(let ((f (adder 3)) (g (adder 4))) (list (f 1) (g 1)))') == PtObject.list([
+        PtObject(4), PtObject(5),
+    ])
+    assert check('(((lambda (a) (lambda (b) (lambda (c) (list a b c)))) 1) 2)') is not None
+    assert check('((((lambda (a) (lambda (b) (lambda (c) (list a b c)))) 1) 2) 3)') == PtObject.list([
+        PtObject(1), PtObject(2), PtObject(3),
+    ])
+    closure = check('(adder 10)')
+    check('(garbage-collect)')
+    assert check('(define plus-ten (adder 10)) (plus-ten 5)') == PtObject(15)
+
+    # Redefinition is seen by previously compiled callers
+    assert check('(define (call-square x) (square x)) (call-square 3)') == PtObject(9)
+    assert check('(define (square x) (+ x x)) (call-square 3)') == PtObject(6)
+    assert check('(define square (lambda (x y) x)) (call-square 3)') is None
+
+
+def test_tail_calls():
+    for opt_level in ('0', '2'):
+        vm = PaltryVM(opt_level=opt_level)
+        check = lambda code: vm.eval_code(_parser.parse(code, 'toplevel'))
+
+        # Self tail calls through if, begin and let
+        assert check('''
+            (define (count n acc)
+              (if (= n 0)
+                  acc
+                  (begin (let ((m (- n 1))) (count m (+ acc 1))))))
+        ''') == PtObject.intern('count')
+        assert check('(count 1000000 0)') == PtObject(1000000)
+
+        # Mutual recursion
+        assert check('''
+            (define (is-even n) (if (= n 0) 'yes (is-odd (- n 1))))
+            (define (is-odd n) (if (= n 0) 'no (is-even (- n 1))))
+        ''') == PtObject.intern('is-odd')
+        assert check('(is-even 1000001)') == PtObject.intern('no')
+
+        # Tail calls through closures and unknown functions
+        assert check('''
+            (define (loop f n) (if (= n 0) 'done (f f (- n 1))))
+            (loop loop 1000000)
+        ''') == PtObject.intern('done')
+        assert check('((lambda (x) (count x 1)) 10)') == PtObject(11)
+        assert heap.state.top == heap.root_base
+
+
+def test_object_cache(tmp_path):
+    prelude = '''
+        (define (fact n) (if (< n 2) 1 (* n (fact (- n 1)))))
+        (define greeting "hello")
+        '(1 2.5 "x" sym)
+    '''
+    expected = PtObject.list([PtObject(1), PtObject(2.5), PtObject('x'), PtObject.intern('sym')])
+
+    cold = PaltryVM(cache_dir=str(tmp_path))
+    assert cold.eval_code(_parser.parse(prelude, 'toplevel')) == expected
+    assert cold.cache.hits == 0
+    assert len(list(tmp_path.glob('*.o'))) == 1
+
+    warm = PaltryVM(cache_dir=str(tmp_path))
+    assert warm.eval_code(_parser.parse(prelude, 'toplevel')) == expected
+    assert warm.cache.hits == 1
+    assert warm.last_timings['codegen'] == 0.0
+
+    # Later modules see the constants and functions of cached ones
+    code = "(list (fact 5) greeting '(1 2.5 \"x\" sym))"
+    assert warm.eval_code(_parser.parse(code, 'toplevel')) == PtObject.list([
+        PtObject(120), PtObject('hello'), expected,
+    ])
+    assert warm.cache.hits == 1
+    assert len(warm.constants) == len(cold.constants) + 1
+
+    # A different history gives a different key
+    other = PaltryVM(cache_dir=str(tmp_path))
+    other.eval_code(_parser.parse('1', 'toplevel'))
+    other.eval_code(_parser.parse(prelude, 'toplevel'))
+    assert other.cache.hits == 0
+
+
+def test_batch():
+    vm = PaltryVM()
+    forms = _parser.parse('(define (f x) (* x 2)) (f 4) "s" (car 1) (f 5)', 'toplevel')
+    result = vm.eval_batch(forms)
+    assert result.forms == 5
+    assert result.values == [PtObject.intern('f'), PtObject(8), PtObject('s'), None]
+    assert result.overhead_saved == 4 * vm.module_overhead > 0
+    assert len(vm.module_allocations) == 1
+    assert vm.eval_batch([]).values == []
+
+
+def test_unloading(monkeypatch):
+    monkeypatch.setattr(paltry, 'SCRATCH_MODULES', 2)
+    vm = PaltryVM()
+    check = lambda code: vm.eval_code(_parser.parse(code, 'toplevel'))
+
+    # Modules defining functions or constants are kept
+    assert check('(define (inc x) (+ x 1)) (define y "str")') == PtObject.intern('y')
+    assert vm.code_stats.modules == 1
+    assert vm.code_stats.transient_modules == 0
+
+    for i in range(5):
+        assert check('(list (inc (inc 1)) y)') == PtObject.list([PtObject(3), PtObject('str')])
+    assert vm.code_stats.modules == 1
+    assert vm.code_stats.transient_modules == 5
+    assert vm.code_stats.engines_freed == 2
+    assert 0 < vm.code_stats.freed_bytes < vm.code_stats.transient_bytes
+    assert vm.memory_usage['code'] == vm.code_stats.live_bytes
+    assert vm.last_allocations == 2
+    assert vm.transient_allocations == 10
+    assert len(vm.module_allocations) == 1
+
+    # Unloaded modules do not affect later ones
+    assert check('(inc 41)') == PtObject(42)
+    assert vm.eval_batch(_parser.parse('(inc 1) (inc 2)', 'toplevel')).values == [PtObject(2), PtObject(3)]
+
+
+def test_stats():
+    vm = PaltryVM()
+    forms = list(vm.read(read_all('(define (f x) (list x x)) (f 1)')))
+    assert vm.timings['read'] > 0
+    vm.eval_code(forms[:1])
+    vm.eval_batch(forms[1:] * 2)
+
+    stats = vm.stats
+    assert stats.forms == 3
+    assert stats.modules + stats.transient_modules == 2
+    assert stats.ir_instructions > stats.last_ir_instructions > 0
+    assert stats.allocations == 4
+    assert stats.timings['codegen'] > stats.last_timings['codegen'] > 0
+    assert stats.as_dict()['time_run'] == stats.timings['run']
+    assert 'ir_instructions' in str(stats)
+
+    # Stats are snapshots
+    vm.eval_code(forms[1:])
+    assert vm.stats.forms == stats.forms + 1
+
+
+def test_perf_map(tmp_path):
+    path = tmp_path / 'perf.map'
+    vm = PaltryVM(perf_map=str(path))
+    vm.eval_code(read_all('(define (square x) (* x x)) (square ((lambda (x) x) 2))'))
+    vm.perf_map.close()
+
+    entries = {}
+    for line in path.read_text().splitlines():
+        address, size, name = line.split(' ', 2)
+        entries[name] = (int(address, 16), int(size, 16))
+    assert set(entries) == {'paltry:anonymous_0:init', 'paltry:square', 'paltry:lambda#2'}
+    assert entries['paltry:anonymous_0:init'][0] == vm.engine.get_function_address('##anonymous_0##init')
+    assert all(size > 0 for _, size in entries.values())
+
+
+def test_typed_callbacks(tmp_path):
+    calls = []
+
+    @PtObject.callback(name='typed-scale', params=(int, float, str), result=float)
+    def typed_scale(n, x, unit):
+        calls.append((n, x, unit))
+        return n * x
+
+    assert typed_scale.callback.params == (int, float, str)
+    for vm in [PaltryVM(), PaltryVM(fixnums=True), PaltryVM(tiered=True)]:
+        check = lambda code: vm.eval_code(_parser.parse(code, 'toplevel'))
+        del calls[:]
+
+        assert check('(typed-scale 3 1.5 "m")') == PtObject(4.5)
+        assert check('(typed-scale 3 2 "m")') == PtObject(6.0)
+        assert calls == [(3, 1.5, 'm'), (3, 2.0, 'm')]
+        assert check('(typed-scale 1.5 1.5 "m")') is None
+        assert check('(typed-scale 1 1.5)') is None
+        assert check('(string-length "héllo")') == PtObject(5)
+        assert check('(sqrt -1.0)') is None
+        assert check('(sqrt 4)') == PtObject(2.0)
+
+        # The generic function object is still bound to the symbol
+        assert check('(let ((f sqrt)) (f 9.0))') == PtObject(3.0)
+        assert check('(define (root x) (sqrt x)) (list (root 16) (root 1.0))') == PtObject.list([
+            PtObject(4.0), PtObject(1.0),
+        ])
+
+    vm = PaltryVM(cache_dir=str(tmp_path))
+    assert vm.eval_code(_parser.parse('(sqrt 4.0)', 'toplevel')) == PtObject(2.0)
+    vm = PaltryVM(cache_dir=str(tmp_path))
+    assert vm.eval_code(_parser.parse('(sqrt 4.0)', 'toplevel')) == PtObject(2.0)
+    assert vm.cache.hits == 1
+
+
+def test_ahead_of_time(tmp_path):
+    code = '''
+        (define (fact n) (if (< n 2) 1 (* n (fact (- n 1)))))
+        (define aot-greeting "hello")
+        (list (fact 10) (sqrt 2.25) '(1 2.5 "x" sym))
+    '''
+    expected = PtObject.list([
+        PtObject(3628800), PtObject(1.5),
+        PtObject.list([PtObject(1), PtObject(2.5), PtObject('x'), PtObject.intern('sym')]),
+    ])
+
+    for fixnums in (False, True):
+        vm = PaltryVM(fixnums=fixnums)
+        obj = vm.compile_object(_parser.parse(code, 'toplevel'))
+        assert vm.code_stats.modules == 0
+        # Shared libraries are only loaded once per path
+        (tmp_path / 'code.o').write_bytes(obj)
+        link_shared(obj, str(tmp_path / 'code-{}.so'.format(fixnums)))
+
+        for path in ('code.o', 'code-{}.so'.format(fixnums)):
+            other = PaltryVM(fixnums=fixnums)
+            assert other.load_compiled(str(tmp_path / path)) == expected
+            assert other.last_timings['codegen'] == 0.0
+            assert other.eval_code(_parser.parse('(list (fact 5) aot-greeting)', 'toplevel')) == PtObject.list([
+                PtObject(120), PtObject('hello'),
+            ])
+
+    # Objects defined in Python have no name to link against
+    form = PtObject.list([PtObject.intern('quote'), PtObject.intern('display').contents.symbol.contents.binding.contents])
+    with pytest.raises(ValueError):
+        PaltryVM().compile_object([form])
@@ -0,0 +1,128 @@
+import ctypes as ct
+
+from paltry import PaltryVM
+from paltry.datatypes import PtObject
+from paltry.heap import heap
+from paltry.reader import read_all
+
+
+_programs = [
+    '0', '-2.5', '"alpha"', "'symbol", "'(a . b)", 'nil', 't',
+    '(begin 1 2 3)', '(begin)', '(if nil 1 2 3)', '(if t 1 2)', '(if nil 1)',
+    '(let (a (b) (c 3)) (list a b c))', '(let ((x 1)) (let ((x 2) (y x)) (cons x y)))',
+    '(+ 1 2 3 4)', '(- 10 1 2)', '(/ -7 2)', '(/ 1 0)', '(+ 1 "a")', '(+ 1 2.5)', '(- 5)', '(+)',
+    '(+ 4611686018427387903 4611686018427387903 4611686018427387903)', '(/ 1.0 0.0)',
+    '(< 1 2)', '(>= 2.0 2.0)', '(= 1 1.0)', '(> 3 2 1)', '(let ((f +)) (f 1 2))',
+    '(let ((+ list)) (+ 1 2))', '(define (apply-op < a b) (< a b)) (apply-op - 3 1)',
+    '(define (inc x) (* x 2)) (define old* *) (define * list) (list (inc 5) (* 1 2 3))',
+    '(define * old*) (list (inc 5) (* 2 2.5))',
+    '(let ((list (lambda (x) (+ x 1)))) (list 1))', '(let ((cons (lambda (a b) b))) (cons 1 2))',
+    "((lambda (list) (list '(3 4))) car)", '(define (pair x) (cons x x)) (pair 1)',
+    '(define old-cons cons) (define cons +) (list (pair 4) (cons 1 2))', '(define cons old-cons) (pair 4)',
+    '((lambda (x) (* x x)) 5)', '((lambda ()))', '((lambda (x) x))', '(1 2)', 'unbound-symbol',
+    '(define (fact n) (if (< n 2) 1 (* n (fact (- n 1))))) (fact 20)',
+    '(define (adder n) (lambda (x) (+ x n))) (let ((f (adder 3)) (g (adder 4))) (list (f 1) (g 1)))',
+    '((((lambda (a) (lambda (b) (lambda (c) (list a b c)))) 1) 2) 3)',
+    '(define x 10) (define y) (list x y)', '(car (list 1 2)) (car 1) (display 3)',
+]
+
+
+def test_same_results():
+    compiled = PaltryVM()
+    results = [(code, compiled.eval_code(read_all(code))) for code in _programs]
+    for threshold in (1, 3, 1000):
+        tiered = PaltryVM(tiered=True, promote_threshold=threshold)
+        for _ in range(4):
+            for code, expected in results:
+                value = tiered.eval_code(read_all(code))
+                assert (value is None) == (expected is None), code
+                assert value is None or value == expected, code
+
+
+def test_promotion():
+    vm = PaltryVM(tiered=True, promote_threshold=10)
+    check = lambda code: vm.eval_code(read_all(code))
+
+    # Cold code is not compiled at all
+    assert check('(define (square x) (* x x)) (define (adder n) (lambda (x) (+ x n)))') == PtObject.intern('adder')
+    assert check('(square 3)') == PtObject(9)
+    assert vm.code_stats.modules == vm.code_stats.transient_modules == 0
+    assert vm.last_timings['codegen'] == 0.0
+
+    # Hot functions are compiled, and keep their captured variables
+    assert check('(define plus-ten (adder 10))') == PtObject.intern('plus-ten')
+    assert check('(define (sum f n acc) (if (= n 0) acc (sum f (- n 1) (+ acc (f n)))))') == PtObject.intern('sum')
+    assert check('(list (sum square 100 0) (sum plus-ten 100 0))') == PtObject.list([
+        PtObject(338350), PtObject(6050),
+    ])
+    assert vm.interpreter.functions_promoted == 3
+    heap.collect()
+    assert check('(list (square 5) (plus-ten 5))') == PtObject.list([PtObject(25), PtObject(15)])
+
+    # Hot toplevel forms are compiled
+    for _ in range(10):
+        assert check('(square 4)') == PtObject(16)
+    assert vm.interpreter.forms_promoted == 1
+
+    # Compiled code calls interpreted functions
+    assert check('(sum (lambda (x) 1) 1000 0)') == PtObject(1000)
+    assert check('(sum (lambda (x) (car x)) 10 0)') is None
+    assert heap.state.top == heap.root_base
+
+
+def test_tail_calls():
+    vm = PaltryVM(tiered=True, promote_threshold=1 << 30)
+    check = lambda code: vm.eval_code(read_all(code))
+
+    assert check('''
+        (define (is-even n) (if (= n 0) 'yes (is-odd (- n 1))))
+        (define (is-odd n) (if (= n 0) 'no (let ((m (- n 1))) (begin (is-even m)))))
+        (is-even 100001)
+    ''') == PtObject.intern('no')
+    assert vm.code_stats.modules == 0
+
+
+def test_literals_outlive_source():
+    vm = PaltryVM(tiered=True)
+    check = lambda code: vm.eval_code(read_all(code))
+
+    check('(define x 12345)')
+    check('(define s "hello world")')
+    check("(define q '(1 2 3))")
+    for i in range(50):
+        check('(list 7.5 "garbage {}" \'(4 5 6 7))'.format(i))
+        heap.collect()
+    assert str(check('(list x s q)')) == '(12345 "hello world" (1 2 3))'
+
+    # The bindings, and the elements of lists, must not point into the freed trees
+    for name in ('x', 's', 'q'):
+        obj = PtObject.intern(name).contents.symbol.contents.binding.contents
+        assert heap._cell(ct.addressof(obj)) is not None
+    assert heap._cell(ct.addressof(obj.cdr.car)) is not None
+
+
+def test_shadowed_primitives():
+    vm = PaltryVM(tiered=True, promote_threshold=1 << 30)
+    check = lambda code: vm.eval_code(read_all(code))
+
+    assert check('(let ((+ list)) (+ 1 2))') == PtObject.list([PtObject(1), PtObject(2)])
+    assert check('(define old- -) (define - list) (- 3 1)') == PtObject.list([PtObject(3), PtObject(1)])
+    assert check('(define - old-) (- 3 1)') == PtObject(2)
+    assert check('(let ((list (lambda (x) (+ x 1)))) (list 1))') == PtObject(2)
+    assert check('(let ((cons (lambda (a b) b))) (cons 1 2))') == PtObject(2)
+    assert check('(define old-list list) (define list +) (list 1 2)') == PtObject(3)
+    assert check('(define list old-list) (list 1 2)') == PtObject.list([PtObject(1), PtObject(2)])
+    assert vm.code_stats.modules == 0
+
+
+def test_malformed_forms():
+    vm = PaltryVM(tiered=True)
+    for code in [
+        '(if)', '(if 1)', '(if . 1)', '(if 1 . 2)', '(quote)', '(let)', '(let x)', '(let (1) 2)',
+        '(let ((x . 1)) x)', '(lambda)', '(lambda 1 2)', '(lambda (1) 2)', '(define)', '(define 1 2)',
+        '(define (1 x) x)', '(define (f . 1) 2)',
+    ]:
+        assert vm.eval_code(read_all(code)) is None, code
+    assert vm.eval_code(read_all('(let (a (b) (c 3)) (list a b c))')) == PtObject.list([
+        PtObject.nil, PtObject.nil, PtObject(3),
+    ])
@@ -0,0 +1,116 @@
+import os
+import select
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from paltry.__main__ import main
+
+
+def test_run(tmp_path):
+    path = tmp_path / 'script.pt'
+    path.write_text('(define (square x) (* x x))\n(display (square 12))\n')
+    result = CliRunner().invoke(main, ['run', str(path)])
+    assert result.exit_code == 0
+    assert result.output == '144\n'
+
+    result = CliRunner().invoke(main, ['run', '-'], input='(display 1) (car 1) (display 2)')
+    assert result.exit_code == 1
+    lines = result.output.splitlines()
+    assert '1' in lines and '2' not in lines
+    assert 'Error: Error in toplevel form 2' in lines
+
+
+def test_run_stdin():
+    # Forms are run as soon as they arrive on a pipe, before it is closed
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'paltry', 'run', '-'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=root,
+        env=dict(os.environ, PYTHONPATH=root, PYTHONUNBUFFERED='1'),
+    )
+    try:
+        for i in range(3):
+            proc.stdin.write('(display (* {} {}))\n'.format(i, i).encode())
+            proc.stdin.flush()
+            assert select.select([proc.stdout], [], [], 30)[0]
+            assert proc.stdout.readline() == '{}\n'.format(i * i).encode()
+        proc.stdin.close()
+        assert proc.wait(timeout=30) == 0
+    finally:
+        proc.kill()
+        proc.stdout.close()
+
+
+def test_run_batch(tmp_path):
+    path = tmp_path / 'script.pt'
+    path.write_text(''.join('(display {})\n'.format(i) for i in range(5)) + '(car 1)\n(display 5)')
+    for batch_size in ('0', '2'):
+        result = CliRunner().invoke(main, ['run', '--batch-size', batch_size, str(path)])
+        lines = result.output.splitlines()
+        assert result.exit_code == 1
+        assert 'Error: Error in toplevel form 6' in lines
+        lines.remove('Error: Error in toplevel form 6')
+        assert lines == ['0', '1', '2', '3', '4']
+
+
+def test_stats(tmp_path):
+    path = tmp_path / 'script.pt'
+    path.write_text('(display (+ 1 2))\n')
+    result = CliRunner().invoke(main, ['--stats', 'run', str(path)])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert lines[0] == '3'
+    assert any(line.split()[:2] == [';', 'forms'] and line.split()[-1] == '1' for line in lines)
+
+
+def test_compile(tmp_path):
+    path = tmp_path / 'script.pt'
+    path.write_text('(define (square x) (* x x))\n(display (square 12))\n(display (sqrt 2.25))\n')
+    for output in ('script.so', 'script.o'):
+        result = CliRunner().invoke(main, ['compile', '-o', str(tmp_path / output), str(path)])
+        assert result.exit_code == 0
+        result = CliRunner().invoke(main, ['run', str(tmp_path / output)])
+        assert result.exit_code == 0
+        assert result.output == '144\n1.5\n'
+
+
+def test_fasl(tmp_path):
+    path = tmp_path / 'script.pt'
+    path.write_text('(define (square x) (* x x))\n(display (list (square 12) "s" \'(a . 2.5)))\n')
+    result = CliRunner().invoke(main, ['write-fasl', str(path)])
+    assert result.exit_code == 0
+    for args in (['run'], ['run', '--batch-size', '0']):
+        result = CliRunner().invoke(main, args + [str(tmp_path / 'script.pfasl')])
+        assert result.exit_code == 0
+        assert result.output == '(144 "s" (a . 2.5))\n'
+
+
+def test_image(tmp_path):
+    path = tmp_path / 'prelude.pt'
+    path.write_text('''
+        (define (image-fact n) (if (< n 2) 1 (* n (image-fact (- n 1)))))
+        (define (image-adder n) (lambda (x) (+ x n)))
+        (define image-plus-ten (image-adder 10))
+        (define image-data (list 1 2.5 "str" 'sym (cons 1 (* 1000000 1000000))))
+        (define image-show display)
+        (define (image-root x) (sqrt x))
+    ''')
+    # Symbol bindings are global, so the image is saved from a fresh process
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(
+        [sys.executable, '-m', 'paltry', 'save-image', str(path)],
+        check=True, cwd=root, env=dict(os.environ, PYTHONPATH=root),
+    )
+
+    script = tmp_path / 'script.pt'
+    script.write_text('''
+        (image-show (list (image-fact 10) (image-plus-ten 5) image-data (image-root 2.25)))
+    ''')
+    result = CliRunner().invoke(main, ['--image', str(tmp_path / 'prelude.image'), 'run', str(script)])
+    assert result.exit_code == 0
+    assert result.output == '(3628800 15 (1 2.5 "str" sym (1 . 1000000000000)) 1.5)\n'
+
+    result = CliRunner().invoke(main, ['--image', str(path), 'run', str(script)])
+    assert result.exit_code == 1
@@ -0,0 +1,118 @@
+import io
+import random
+
+import pytest
+
+from paltry.datatypes import PtObject
+from paltry.fasl import dump, dumps, load
+from paltry.parser import PaltryParser, PaltrySemantics
+from paltry.reader import Reader, ReadError, read, read_all, read_file
+
+
+_parser = PaltryParser(semantics=PaltrySemantics())
+
+_atoms = [
+    'quux', 'a-b', '+', '-', '...', 'x1', 'λ', '"alpha"', '""', '"a\\"b"', '"tab\\there"',
+    '"new\nline"', '120', '-2', '+7', '120.0e1', '-3.14', '.5', '5.', '1.5e-3', '0xf', '-0xf',
+    '0o7', '-0o7', '0b1', '-0b1', '12abc', '0x1g', '0b12', '1.5.3',
+]
+
+
+def _random_form(rng, depth=0):
+    choice = rng.random()
+    if depth > 4 or choice < 0.5:
+        return rng.choice(_atoms)
+    if choice < 0.6:
+        return rng.choice(["'", '`', ',', ',@']) + _random_form(rng, depth + 1)
+    elements = [_random_form(rng, depth + 1) for _ in range(rng.randrange(5))]
+    if len(elements) > 1 and rng.random() < 0.2:
+        elements[-1:-1] = ['.']
+    return '(' + rng.choice([' ', '\n', '  ; comment\n']).join(elements) + ')'
+
+
+def test_matches_grammar():
+    rng = random.Random(0)
+    for _ in range(200):
+        text = ' '.join(_random_form(rng) for _ in range(rng.randrange(1, 5)))
+        assert read_all(text) == list(_parser.parse(text, 'toplevel')), text
+
+
+def test_reader():
+    assert read('quux') == PtObject.intern('quux')
+    assert read('  ; comment\n (a . b) c') == PtObject.cons(PtObject.intern('a'), PtObject.intern('b'))
+    assert read_all('') == []
+    assert read_all('; only a comment') == []
+    assert read_all('1 "two" three') == [PtObject(1), PtObject('two'), PtObject.intern('three')]
+
+    reader = Reader('(a) (b)')
+    assert reader.read() == PtObject.list([PtObject.intern('a')])
+    assert reader.position == 3
+    assert list(reader) == [PtObject.list([PtObject.intern('b')])]
+    assert reader.read() is None
+
+    # Deep nesting does not hit the recursion limit
+    assert read('(' * 10000 + ')' * 10000) is not None
+
+    for text in ['(a b', 'a)', '"unterminated', '\\', "'", '(. a)']:
+        with pytest.raises(ReadError):
+            read_all(text)
+
+
+def test_streaming(tmp_path):
+    rng = random.Random(1)
+    text = '\n'.join(_random_form(rng) for _ in range(50)) + ' "λ" ; end'
+    expected = read_all(text)
+    for chunk_size in (1, 2, 7, 64):
+        assert list(Reader(io.StringIO(text), chunk_size=chunk_size)) == expected
+        assert list(Reader(io.BytesIO(text.encode('utf-8')), chunk_size=chunk_size)) == expected
+
+    # Forms are available before the whole stream is read
+    stream = io.BytesIO(('(a)' + ' (b)' * 1000).encode('utf-8'))
+    reader = Reader(stream, chunk_size=16)
+    assert reader.read() == PtObject.list([PtObject.intern('a')])
+    assert stream.tell() < 100
+
+    # Complete forms are read without waiting for more text from a pipe
+    class Pipe(io.BytesIO):
+        def read(self, size=-1):
+            data = super().read(size)
+            assert data, 'Blocked waiting for more input'
+            return data
+        read1 = read
+    reader = Reader(Pipe(b'(a)'))
+    assert reader.read() == PtObject.list([PtObject.intern('a')])
+    reader = Reader(Pipe(b'12\n'))
+    assert reader.read() == PtObject(12)
+
+    path = tmp_path / 'forms.pt'
+    path.write_text(text, encoding='utf-8')
+    assert list(read_file(str(path), chunk_size=64)) == expected
+    path.write_text('')
+    assert list(read_file(str(path))) == []
+
+    with pytest.raises(ReadError):
+        list(Reader(io.StringIO('(a (b) c'), chunk_size=2))
+
+
+def test_fasl(tmp_path):
+    rng = random.Random(2)
+    text = '\n'.join(_random_form(rng) for _ in range(200)) + ' nil () (nil . nil) -9223372036854775808 ""'
+    expected = read_all(text)
+    assert list(load(dumps(expected))) == expected
+    assert list(load(dumps([]))) == []
+
+    # Forms outlive the others loaded with them
+    form = list(load(dumps(read_all('(a (1 "b") . 2.5) c'))))[0]
+    assert form.cdr.car == read('(1 "b")')
+
+    deep = read('(' * 10000 + 'x' + ')' * 10000)
+    assert dumps(load(dumps([deep]))) == dumps([deep])
+
+    path = tmp_path / 'forms.pfasl'
+    dump(expected, str(path))
+    assert list(read_file(str(path))) == expected
+
+    with pytest.raises(ValueError):
+        dumps([PtObject.symbol('uninterned')])
+    with pytest.raises(ValueError):
+        list(load(dumps(expected)[:-1]))